@@ -9,7 +9,6 @@ import tensorflow as tf
 
 from scipy import special
 from scipy.stats import entropy
-from scipy.stats import gaussian_kde
 # from scipy.stats import dirichlet
 import functools
 
@@ -24,20 +23,70 @@ if (platform.system() == "Windows"):
 import os
 import itertools
 import time
-import random
 
 import networks
+import profiling
+import rng
+import rollout
+import pipeline
+import lstd
+import population
+import codec
+import preprocess
+import dataset
+import density
+import figures
+import summaries
+import remote
+import shared_data
 
 class AC_IRL:
 
-    def __init__(self, theta=8.64, shift=0, alpha_scale=1e4, d=15, lr_reward=1e-4, num_policies=10, c=2e11, reg='dropout_l1l2', n_fc3=8, n_fc4=4, saved_network=None, use_tf=True, summarize=False):
+    def __init__(self, theta=8.64, shift=0, alpha_scale=1e4, d=15, lr_reward=1e-4, num_policies=10, c=2e11, reg='dropout_l1l2', n_fc3=8, n_fc4=4, saved_network=None, use_tf=True, summarize=False, profile=False, profile_file='results/profile.csv', profile_iteration=-1, seed=None, eval_subsample=0, eval_batch_size=2048, action_codec='uint16', demo_cache=None, dataset_file=None, arch='conv', ensemble_size=1, summary_every=100, summary_secs=None, log_dir='./log', shared=None, sampler='exact', sampler_threshold=rollout.NORMAL_THRESHOLD):
         """
         reg - 'none', 'dropout', 'l1l2', 'dropout_l1l2'
+        arch - reward network architecture, 'conv' for convolutions over P (networks.r_net*),
+        'rows' for shared weights over the rows of P (networks.r_net_rows), whose size does not grow with d
+        ensemble_size - if > 1, train this many independently initialized conv reward networks
+        together in one graph (networks.r_net_ensemble), and use their mean as the reward
         use_tf - if True, create tensorflow graphs as usual, else do not instantiate graph
+        profile - if True, record per-phase timings of each outerloop iteration into profile_file (.csv or .json)
+        profile_iteration - outerloop iteration to capture with cProfile, -1 for none
+        seed - root seed of all random streams, None for fresh entropy
+        eval_subsample - if > 0, monitor reward on a fixed subsample of this many transitions per hour, else on all transitions
+        eval_batch_size - number of transitions per sess.run when monitoring reward
+        action_codec - storage of actions in demonstration and generated sets, 'uint16', 'float16' or 'none'
+        demo_cache - if not None, directory in which parsed demonstrations are cached
+        dataset_file - if not None, read start states and demonstrations from this dataset.build() file
+        instead of the day files
+        summary_every - if summarize, write summaries every this many reward updates
+        summary_secs - if summarize and not None, also write summaries when this many seconds passed since the last
+        log_dir - directory of summary event files
+        shared - handle returned by share_data() of another instance, to attach to its start states
+        and demonstrations in shared memory instead of reading them
+        sampler - 'exact' Dirichlet sampling of actions, or 'normal' for the moment-matched normal
+        approximation of rows whose parameters are all at least sampler_threshold (see rollout.sample_dirichlet).
+        'normal' speeds up generated trajectories, which are sampled in batches, but not the
+        single actions of forward training
         """
         self.summarize = summarize
+        self.sampler = sampler
+        self.sampler_threshold = sampler_threshold
+        # decides which reward updates also evaluate summaries
+        self.summary_schedule = summaries.summary_scheduler(every_steps=summary_every, every_secs=summary_secs)
+        # number of reward updates run so far
+        self.reward_step = 0
+        # named timers and counters, no-ops unless profile is True
+        self.prof = profiling.profiler(enabled=profile, outfile=profile_file, profile_iteration=profile_iteration)
+        # independent random streams for episodes, rollouts and minibatches
+        self.streams = rng.rng_manager(seed)
+        # counters that select the stream of the next episode, rollout, minibatch and evaluation rollout
+        self.episode_count = 0
+        self.rollout_count = 0
+        self.minibatch_count = 0
+        self.eval_count = 0
         if (platform.system() == "Windows"):
-            self.var = var.var(d=d)
+            self.var = var.var(d=d, cache_dir='var_cache')
 
         # initialize theta
         self.theta = theta
@@ -58,25 +107,42 @@ class AC_IRL:
         self.c = c
         # regularization
         self.reg = reg
+        self.arch = arch
+        self.ensemble_size = ensemble_size
         self.n_fc3 = n_fc3
         self.n_fc4 = n_fc4
 
-        # initialize collection of start states
-        self.init_pi0(path_to_dir=os.getcwd()+'/train_normalized_round2')
+        self.dataset_file = dataset_file
+        self.action_codec = action_codec
+        self.demo_cache = demo_cache
+        if shared:
+            self.attach_data(shared)
+        else:
+            # initialize collection of start states
+            self.init_pi0(path_to_dir=os.getcwd()+'/train_normalized_round2', dataset_file=dataset_file)
+            # initialize collection of start states of test set
+            self.init_pi0_test(path_to_dir=os.getcwd()+'/test_normalized_round2', day_start=22, dataset_file=dataset_file)
+            # Will become store of trajectories of (state, action) pairs, with actions encoded
+            self.list_demonstrations = self.load_demonstrations(state_dir='./train_normalized_round2', action_dir='./actions_2', dim_action=20, start_day=1, split='train')
+            self.list_demonstrations_test = self.load_demonstrations(state_dir='./test_normalized_round2', action_dir='./actions_test_2', dim_action=20, start_day=22, split='test')
         self.num_start_samples = self.mat_pi0.shape[0] # number of rows
-        # initialize collection of start states of test set
-        self.init_pi0_test(path_to_dir=os.getcwd()+'/test_normalized_round2', day_start=22)
         self.num_start_samples_test = self.mat_pi0_test.shape[0]
-
-        # Will become list of list of tuples of the form (state, action)
-        self.list_demonstrations = self.read_demonstrations(state_dir='./train_normalized_round2', action_dir='./actions_2', dim_action=20, start_day=1)
-        self.list_demonstrations_test = self.read_demonstrations(state_dir='./test_normalized_round2', action_dir='./actions_test_2', dim_action=20, start_day=22)
-        # Collect a set of transitions from demo trajectories for testing reward function
-        self.list_eval_demo_transitions = [pair for traj in self.list_demonstrations for pair in traj]
-        # self.list_eval_demo_transitions = self.get_eval_transitions(self.list_demonstrations)
+        # shared_data.shared_arrays published by share_data()
+        self.shared = None
+        # Feed-ready arrays of evaluation transitions, built by prepare_eval_sets()
+        self.eval_subsample = eval_subsample
+        self.eval_batch_size = eval_batch_size
+        self.eval_demo_states = None
+        self.eval_demo_actions = None
+
+        # rollout workers over TCP, set by attach_workers()
+        self.remote = None
+        self.local_workers = []
+        # True if attach_workers() created self.shared, which detach_workers() then releases
+        self.shared_for_workers = False
 
         # This is D_samp in the IRL algorithm. Will be populated while running outerloop()
-        self.list_generated = []
+        self.list_generated = codec.trajectory_store(self.d, method=action_codec, stochastic=True)
 
         # Create neural net representation of reward function
         if use_tf:
@@ -100,7 +166,7 @@ class AC_IRL:
             
             if summarize:
                 self.merged = tf.summary.merge_all()
-                self.train_writer = tf.summary.FileWriter('./log', self.sess.graph)
+                self.train_writer = summaries.create_writer(log_dir, self.sess.graph)
             
             init = tf.global_variables_initializer()
             self.sess.run(init)
@@ -113,55 +179,51 @@ class AC_IRL:
         
     # ------------------- File processing functions ------------------ #
 
-    def convert_action(self, state_dir, action_dir, action_write_dir, dim_action=20, start_day=1):
+    def convert_action(self, state_dir, action_dir, action_write_dir, dim_action=20, start_day=1, num_workers=None, force=False, to_cache=False):
         """
         For each action matrix, if row is all zeros except single 1 on the diagonal entry, 
         check whether the person actually stayed in topic, or whether 
         the number of people was zero and the 1 was added artificially during recording
 
         dim_action - dimension of action matrix that was recorded (will be larger than or equal to self.d)
+        num_workers - number of processes that clean days concurrently, None for one per CPU
+        force - if True, rewrite outputs that are already up to date
+        to_cache - if True, skip the text output and write the cleaned demonstrations
+        directly into the demonstration cache in self.demo_cache, as read by load_demonstrations
+
+        Returns number of days written
         """
         num_file_action = len(os.listdir(action_dir))
         num_file_state = len(os.listdir(state_dir))
         if num_file_action != num_file_state:
             print("Weird")
+        list_days = range(start_day, start_day+num_file_action)
+        list_paths = [(state_dir+'/trend_distribution_day%d.csv' % idx_day, action_dir+'/action_day%d.txt' % idx_day) for idx_day in list_days]
+
+        if not to_cache:
+            list_args = [(path_state, path_action, action_write_dir+'/action_day%d.txt' % idx_day, self.d, dim_action, force) for idx_day, (path_state, path_action) in zip(list_days, list_paths)]
+            return sum(preprocess.run_tasks(preprocess.convert_action_file, list_args, num_workers))
+
+        if not self.demo_cache:
+            raise ValueError("to_cache requires demo_cache")
+        list_results = preprocess.run_tasks(preprocess.read_clean_day, [(path_state, path_action, self.d, dim_action) for path_state, path_action in list_paths], num_workers)
         list_demonstrations = []
-        for idx_day in range(start_day, start_day+num_file_action):        
-            file_state = "trend_distribution_day%d.csv" % idx_day
-            file_action = "action_day%d.txt" % idx_day
-            # read states for this day
-            states = pd.read_table(state_dir+'/'+file_state, delimiter=' ', header=None)
-            # convert to np matrix
-            states = states.as_matrix() # 16 x d
-            # read actions for this day, automatically skips over blank lines
-            actions = pd.read_table(action_dir+'/'+file_action, delimiter=' ', header=None)
-            actions = actions.as_matrix() # (15*d) * d
+        for states, actions in list_results:
+            # group into (state, action) pairs, as in read_demonstrations
+            list_demonstrations.append( [(states[hour, 0:self.d], actions[hour*dim_action:(hour*dim_action+self.d), 0:self.d]) for hour in range(0,15)] )
+        store = codec.trajectory_store(self.d, method=self.action_codec, list_trajectories=list_demonstrations)
+        if not os.path.isdir(self.demo_cache):
+            os.makedirs(self.demo_cache)
+        store.save(self.demo_cache_path(state_dir))
 
-            f = open(action_write_dir+'/action_day%d.txt' % idx_day, 'a')
-            for hour in range(0,15):
-                state = states[hour, 0:self.d]
-                # state_next = states[hour+1, 0:self.d]
-                # read everything
-                action = actions[hour*dim_action:(hour+1)*dim_action, :]
-                for topic in range(0, self.d):
-                    if action[topic, topic] == 1.0 and state[topic] == 0:
-                        # keep same number of entries, but normalize against self.d
-                        action[topic, :] = np.ones(dim_action) / self.d
-                    action[topic].tofile(f, sep=' ', format='%.3e')
-                    f.write('\n')
-                # write the rest without change
-                for topic in range(self.d, dim_action):
-                    action[topic].tofile(f, sep=' ', format='%.3e')
-                    f.write('\n')
-                f.write('\n')
-            f.close()
+        return len(list_demonstrations)
 
     # ------------------- End file processing functions ------------------ #
 
 
     # ------------------- New and overridden functions ---------------- #
 
-    def read_demonstrations(self, state_dir, action_dir, dim_action=20, start_day=1):
+    def read_demonstrations(self, state_dir, action_dir, dim_action=20, start_day=1, dataset_file=None, split='train'):
         """
         Reads measured trajectories to produce list of trajectories,
         where each trajectory is a list of (state, action) pairs,
@@ -171,8 +233,14 @@ class AC_IRL:
         action_dir - name of folder containing measured actions for each hour of each day
         dim_action - dimension of action matrix that was recorded (will be larger than or equal to self.d)
         start_day - day number, 1 for train group, some other number for test group
+        dataset_file - if not None, take split of this dataset instead of reading state_dir and action_dir
         """
         print("Inside read_demonstrations")
+        if dataset_file:
+            ds = dataset.open_dataset(dataset_file)
+            states = ds.states(split)
+            actions = ds.actions(split)
+            return [[(np.array(states[idx_day, hour, 0:self.d]), np.array(actions[idx_day, hour, 0:self.d, 0:self.d])) for hour in range(0,15)] for idx_day in range(states.shape[0])]
         num_file_action = len(os.listdir(action_dir))
         num_file_state = len(os.listdir(state_dir))
         if num_file_action != num_file_state:
@@ -200,6 +268,86 @@ class AC_IRL:
         return list_demonstrations
 
 
+    def demo_cache_path(self, state_dir, split='train'):
+        """
+        Returns path of the cached demonstrations for the states in state_dir,
+        or for split of self.dataset_file
+        """
+        if self.dataset_file:
+            name = '%s_%s' % (os.path.splitext(os.path.basename(self.dataset_file))[0], split)
+        else:
+            name = os.path.basename(os.path.normpath(state_dir))
+        return os.path.join(self.demo_cache, 'demo_%s_%s.npz' % (name, self.action_codec))
+
+
+    def load_demonstrations(self, state_dir, action_dir, dim_action=20, start_day=1, split='train'):
+        """
+        Returns demonstrations as a codec.trajectory_store with actions encoded by self.action_codec.
+        If self.demo_cache is set, the store is read from the cache when it is newer
+        than every input file, otherwise parsed by read_demonstrations and written to the cache.
+
+        Arguments are the same as read_demonstrations
+        """
+        if self.demo_cache:
+            path_cache = self.demo_cache_path(state_dir, split)
+            if self.dataset_file:
+                list_inputs = [self.dataset_file]
+            else:
+                # the action text files may not exist when the cache was written by convert_action
+                list_inputs = [os.path.join(dir_input, f) for dir_input in [state_dir, action_dir] if os.path.isdir(dir_input) for f in os.listdir(dir_input)]
+            if os.path.isfile(path_cache) and os.path.getmtime(path_cache) >= max(os.path.getmtime(f) for f in list_inputs):
+                print("Reading demonstrations from %s" % path_cache)
+                try:
+                    return codec.load_store(path_cache)
+                except ValueError as e:
+                    print("Rebuilding cache: %s" % e)
+
+        list_demonstrations = self.read_demonstrations(state_dir, action_dir, dim_action, start_day, self.dataset_file, split)
+        store = codec.trajectory_store(self.d, method=self.action_codec, list_trajectories=list_demonstrations)
+
+        if self.demo_cache:
+            if not os.path.isdir(self.demo_cache):
+                os.makedirs(self.demo_cache)
+            store.save(path_cache)
+
+        return store
+
+
+    def share_data(self):
+        """
+        Copies start states and demonstrations into shared memory once.
+        Returns a handle to pass as shared= to AC_IRL in worker processes,
+        which then attach to the same memory instead of reading the files.
+        The memory is released by release_data()
+        """
+        if self.shared is None:
+            self.shared = shared_data.shared_arrays({'mat_pi0':self.mat_pi0, 'mat_pi0_test':self.mat_pi0_test,
+                                                     'demo_states':self.list_demonstrations.states, 'demo_codes':self.list_demonstrations.codes, 'demo_scales':self.list_demonstrations.scales,
+                                                     'demo_test_states':self.list_demonstrations_test.states, 'demo_test_codes':self.list_demonstrations_test.codes, 'demo_test_scales':self.list_demonstrations_test.scales})
+
+        return self.shared.handle
+
+
+    def attach_data(self, handle):
+        """
+        Uses read-only views of start states and demonstrations published by share_data()
+        """
+        arrays = shared_data.attach(handle)
+        self.mat_pi0 = arrays['mat_pi0']
+        self.mat_pi0_test = arrays['mat_pi0_test']
+        self.list_demonstrations = codec.from_arrays(arrays['demo_states'], arrays['demo_codes'], arrays['demo_scales'], self.action_codec)
+        self.list_demonstrations_test = codec.from_arrays(arrays['demo_test_states'], arrays['demo_test_codes'], arrays['demo_test_scales'], self.action_codec)
+
+
+    def release_data(self):
+        """
+        Removes the shared memory created by share_data(), after all workers are done
+        """
+        if self.shared is not None:
+            self.shared.close()
+            self.shared = None
+
+
     def get_eval_transitions(self, list_trajectories):
         """
         Returns a list of (s,a) tuples, one tuple from each input trajectory in 
@@ -219,6 +367,107 @@ class AC_IRL:
         return list_test_transitions
 
 
+    def flatten_trajectories(self, list_trajectories, per_hour=0, rng=None):
+        """
+        Converts list of trajectories into feed-ready arrays
+        states - [N, d] float32
+        actions - [N, d, d] float32
+        where N = number of trajectories * 15
+
+        per_hour - if > 0, keep a stratified subsample with at most this
+        many transitions from each hour, chosen with rng
+        """
+        if isinstance(list_trajectories, codec.trajectory_store):
+            # decode in bulk
+            if per_hour <= 0:
+                return list_trajectories.fetch()
+            num_traj = len(list_trajectories)
+            list_idx_traj = []
+            list_idx_hour = []
+            for hour in range(list_trajectories.num_steps):
+                if num_traj > per_hour:
+                    indices = np.sort(rng.choice(num_traj, per_hour, replace=False))
+                else:
+                    indices = np.arange(num_traj)
+                list_idx_traj.append(indices)
+                list_idx_hour.append(np.full(len(indices), hour))
+            return list_trajectories.fetch(np.concatenate(list_idx_traj), np.concatenate(list_idx_hour))
+
+        if per_hour > 0:
+            list_pairs = []
+            num_traj = len(list_trajectories)
+            for hour in range(15):
+                if num_traj > per_hour:
+                    indices = np.sort(rng.choice(num_traj, per_hour, replace=False))
+                else:
+                    indices = range(num_traj)
+                list_pairs += [list_trajectories[idx][hour] for idx in indices]
+        else:
+            list_pairs = [pair for traj in list_trajectories for pair in traj]
+        states = np.array([pair[0] for pair in list_pairs], dtype=np.float32)
+        actions = np.array([pair[1] for pair in list_pairs], dtype=np.float32)
+
+        return states, actions
+
+
+    def prepare_eval_sets(self):
+        """
+        Materializes the demo and generated evaluation transitions as arrays,
+        called once per outer iteration after self.list_generated changes.
+        The demo set never changes, so it is built only on the first call.
+        With self.eval_subsample > 0 the demo subsample is fixed for the whole run.
+        """
+        if self.eval_demo_states is None:
+            self.eval_demo_states, self.eval_demo_actions = self.flatten_trajectories(self.list_demonstrations, self.eval_subsample, self.streams.subsample(0))
+        # key the generated subsample by the number of trajectories generated so far
+        self.eval_gen_states, self.eval_gen_actions = self.flatten_trajectories(self.list_generated, self.eval_subsample, self.streams.subsample(1 + self.rollout_count))
+
+
+    def calc_reward_avg(self, states, actions, demo=True):
+        """
+        Average reward over arrays of transitions, evaluated in chunks of
+        self.eval_batch_size with a streaming running mean
+
+        demo - if True, run the demo tower of the reward network, else the generated tower
+        """
+        if demo:
+            tensor, ph_states, ph_actions = self.reward_demo, self.demo_states, self.demo_actions
+        else:
+            tensor, ph_states, ph_actions = self.reward_gen, self.gen_states, self.gen_actions
+        num_total = len(states)
+        reward_avg = 0.0
+        num_seen = 0
+        for idx_start in range(0, num_total, self.eval_batch_size):
+            idx_end = min(idx_start + self.eval_batch_size, num_total)
+            reward_val = self.sess.run(tensor, feed_dict={ph_states:states[idx_start:idx_end], ph_actions:actions[idx_start:idx_end]})
+            num_seen += idx_end - idx_start
+            reward_avg += (np.sum(reward_val) - (idx_end - idx_start) * reward_avg) / num_seen
+
+        return reward_avg
+
+
+    def calc_reward_histogram(self, states, actions, lo, hi, demo=True, edges=None):
+        """
+        Evaluates reward on arrays of transitions in chunks of self.eval_batch_size
+        and accumulates the rewards into a density.streaming_histogram over [lo, hi]
+
+        demo - if True, run the demo tower of the reward network, else the generated tower
+        edges - bin edges of the histogram, see density.streaming_histogram
+        """
+        if demo:
+            tensor, ph_states, ph_actions = self.reward_demo, self.demo_states, self.demo_actions
+        else:
+            tensor, ph_states, ph_actions = self.reward_gen, self.gen_states, self.gen_actions
+        hist = density.streaming_histogram(lo, hi, edges=edges)
+        for idx_start in range(0, len(states), self.eval_batch_size):
+            idx_end = min(idx_start + self.eval_batch_size, len(states))
+            hist.add(self.sess.run(tensor, feed_dict={ph_states:states[idx_start:idx_end], ph_actions:actions[idx_start:idx_end]}))
+        if hist.num_outside > 0:
+            print("%d rewards outside [%f, %f]" % (hist.num_outside, lo, hi))
+
+        return hist
+
+
     def get_trainable_var_under(self, scope_name):
         """
         Returns list of trainable variables nested under scope_name
@@ -229,42 +478,75 @@ class AC_IRL:
         return filtered_list
 
 
+    def build_reward_net(self, states, actions):
+        """
+        Creates the reward network selected by self.arch and self.reg on a batch of states and actions
+        expected dimension of output [N, 1] where N = total number of transitions in batch,
+        or [ensemble_size, N, 1] for an ensemble
+        """
+        return networks.reward_net(states, actions, **self.reward_net_config())
+
+
+    def reward_net_config(self):
+        """
+        Keyword arguments of networks.reward_net for this reward network
+        """
+        return {'reg':self.reg, 'arch':self.arch, 'ensemble_size':self.ensemble_size, 'n_fc3':self.n_fc3, 'n_fc4':self.n_fc4, 'd':self.d}
+
+
+    def get_reward_weights(self):
+        """
+        Returns dict of variable name to current value of all reward network variables,
+        without optimizer slots
+        """
+        list_values = self.sess.run(self.reward_vars)
+
+        return {var.op.name: value for var, value in zip(self.reward_vars, list_values)}
+
+
     def create_network(self):
         """
-        Creates neural net representation of reward function
+        Creates neural net representation of reward function.
+        Demo and generated batches are concatenated and run through the network
+        in a single pass, then split by segment id (0 demo, 1 generated),
+        so every layer does one matmul over both batches.
+        Either batch may be left unfed, it then defaults to an empty batch.
         """
         print("Inside create_network")
         # placeholder for actions in demonstration batch, shape [N, num_actions, d,d]
         # where N = number of trajectories * num actions along trajectory (should be 15)
-        self.demo_actions = tf.placeholder(dtype=tf.float32, shape=[None,self.d,self.d], name='demo_actions')
+        self.demo_actions = tf.placeholder_with_default(tf.zeros([0,self.d,self.d]), shape=[None,self.d,self.d], name='demo_actions')
         # placeholder for states in demonstration batch
         # where N = number of trajectories * num states along trajectory (should be 15)
-        self.demo_states = tf.placeholder(dtype=tf.float32, shape=[None,self.d], name='demo_states')
+        self.demo_states = tf.placeholder_with_default(tf.zeros([0,self.d]), shape=[None,self.d], name='demo_states')
         # placeholder for actions in generated batch
-        self.gen_actions = tf.placeholder(dtype=tf.float32, shape=[None,self.d,self.d], name='gen_actions')
+        self.gen_actions = tf.placeholder_with_default(tf.zeros([0,self.d,self.d]), shape=[None,self.d,self.d], name='gen_actions')
         # placeholder for states in generated batch
-        self.gen_states = tf.placeholder(dtype=tf.float32, shape=[None,self.d], name='gen_states')
-        with tf.variable_scope("reward") as scope:
-            if self.reg == 'none':
-                # rewards for state-action pairs in demonstration batch
-                # expected dimension [N, 1] where N = total number of transitions in batch
-                self.reward_demo = networks.r_net(self.demo_states, self.demo_actions, f1=1, k1=5, f2=2, k2=3, n_fc3=self.n_fc3, n_fc4=self.n_fc4, d=self.d)
-                scope.reuse_variables()
-                # rewards for state-action pairs in generated batch
-                # expected dimension [N, 1] where N = total number of transitions in batch
-                self.reward_gen = networks.r_net(self.gen_states, self.gen_actions, f1=1, k1=5, f2=2, k2=3, n_fc3=self.n_fc3, n_fc4=self.n_fc4, d=self.d)
-            elif self.reg == 'dropout':
-                self.reward_demo = networks.r_net_dropout(self.demo_states, self.demo_actions, f1=1, k1=5, f2=2, k2=3, n_fc3=self.n_fc3, n_fc4=self.n_fc4, d=self.d)
-                scope.reuse_variables()
-                self.reward_gen = networks.r_net_dropout(self.gen_states, self.gen_actions, f1=1, k1=5, f2=2, k2=3, n_fc3=self.n_fc3, n_fc4=self.n_fc4, d=self.d)
-            elif self.reg == 'l1l2':
-                self.reward_demo = networks.r_net_l1l2(self.demo_states, self.demo_actions, f1=1, k1=5, f2=2, k2=3, n_fc3=self.n_fc3, n_fc4=self.n_fc4, d=self.d)
-                scope.reuse_variables()
-                self.reward_gen = networks.r_net_l1l2(self.gen_states, self.gen_actions, f1=1, k1=5, f2=2, k2=3, n_fc3=self.n_fc3, n_fc4=self.n_fc4, d=self.d)
-            elif self.reg == 'dropout_l1l2':
-                self.reward_demo = networks.r_net_dropout_l1l2(self.demo_states, self.demo_actions, f1=1, k1=5, f2=2, k2=3, n_fc3=self.n_fc3, n_fc4=self.n_fc4, d=self.d)
-                scope.reuse_variables()
-                self.reward_gen = networks.r_net_dropout_l1l2(self.gen_states, self.gen_actions, f1=1, k1=5, f2=2, k2=3, n_fc3=self.n_fc3, n_fc4=self.n_fc4, d=self.d)
+        self.gen_states = tf.placeholder_with_default(tf.zeros([0,self.d]), shape=[None,self.d], name='gen_states')
+
+        # segment id of each transition in the combined batch
+        self.segment_ids = tf.concat([tf.zeros(tf.shape(self.demo_states)[0:1], dtype=tf.int32), tf.ones(tf.shape(self.gen_states)[0:1], dtype=tf.int32)], 0)
+        states_all = tf.concat([self.demo_states, self.gen_states], 0)
+        actions_all = tf.concat([self.demo_actions, self.gen_actions], 0)
+        with tf.variable_scope("reward"):
+            # rewards for all state-action pairs, [N_demo + N_gen, 1]
+            reward_all = self.build_reward_net(states_all, actions_all)
+        # variables of the reward network, collected before the optimizer adds
+        # its slot variables (reward/.../Adam) under the same scope
+        self.reward_vars = tf.get_collection(tf.GraphKeys.GLOBAL_VARIABLES, scope='reward/')
+        if self.ensemble_size > 1:
+            # rewards of every member, [N_demo + N_gen, ensemble_size]
+            reward_members = tf.transpose(tf.squeeze(reward_all, axis=2))
+            self.reward_demo_members, self.reward_gen_members = tf.dynamic_partition(reward_members, self.segment_ids, 2)
+            # ensemble mean is the reward signal, std measures disagreement between members
+            reward_mean, reward_var = tf.nn.moments(reward_all, axes=[0])
+            self.reward_all = reward_mean
+            self.reward_all_std = tf.sqrt(reward_var)
+            self.reward_demo_std, self.reward_gen_std = tf.dynamic_partition(self.reward_all_std, self.segment_ids, 2)
+        else:
+            self.reward_all = reward_all
+        # rewards for state-action pairs in demonstration batch and in generated batch
+        self.reward_demo, self.reward_gen = tf.dynamic_partition(self.reward_all, self.segment_ids, 2)
                 
 
     def calc_pdf_action(self, theta, action, state):
@@ -387,6 +669,9 @@ class AC_IRL:
         # first term = - 1/N sum_{traj_demo} r(traj_demo)
         # where N = number of sampled demo trajectories
         # just sum up r(s,a) over all (s_t,a_t) in each trajectory over all demo trajectories
+        if self.ensemble_size > 1:
+            self.create_ensemble_loss()
+            return
         self.sum_demo_rewards = - 1.0/self.num_demo_samples * tf.reduce_sum(self.reward_demo)
 
         # second term = log(1/M sum_{traj_sample} z_{traj_sample} exp(r(traj_sample))
@@ -406,24 +691,48 @@ class AC_IRL:
         self.second_term = tf.log( 1.0 / self.num_sampled_trajectories * tf.reduce_sum( gen_rewards_exp) ) 
 
         # compute loss = negative log likelihood
+        self.create_optimizer(self.sum_demo_rewards + self.second_term)
+
+
+    def create_ensemble_loss(self):
+        """
+        Loss of an ensemble: the loss of create_training_method for each member,
+        summed over members. Members have separate parameters, so minimizing the sum
+        trains each member on its own loss, on the same minibatches.
+        self.sum_demo_rewards and self.second_term are averaged over members for reporting
+        """
+        # [ensemble_size]
+        sum_demo_members = - 1.0/self.num_demo_samples * tf.reduce_sum(self.reward_demo_members, axis=0)
+        # [num_sampled_trajectories, 15, ensemble_size]
+        gen_rewards_reshaped = tf.reshape( self.reward_gen_members, [self.num_sampled_trajectories, 15, self.ensemble_size] )
+        # exp(r(traj_sample)) for each trajectory and member
+        gen_rewards_exp = tf.exp( tf.reduce_sum( gen_rewards_reshaped, axis=1 ) )
+        second_members = tf.log( 1.0 / self.num_sampled_trajectories * tf.reduce_sum( gen_rewards_exp, axis=0 ) )
+
+        self.sum_demo_rewards = tf.reduce_mean(sum_demo_members)
+        self.second_term = tf.reduce_mean(second_members)
+        self.create_optimizer(tf.reduce_sum(sum_demo_members + second_members))
+
+
+    def create_optimizer(self, data_loss):
+        """
+        Adds regularization to data_loss and creates the training operation
+        """
         if self.reg == 'l1l2' or self.reg == 'dropout_l1l2':
             reg_losses = tf.get_collection(tf.GraphKeys.REGULARIZATION_LOSSES)
-            self.loss = self.sum_demo_rewards + self.second_term + sum(reg_losses)
+            self.loss = data_loss + sum(reg_losses)
         else:
-            self.loss = self.sum_demo_rewards + self.second_term
+            self.loss = data_loss
 
         if self.summarize:
             tf.summary.scalar('loss', self.loss)
         self.optimizer = tf.train.AdamOptimizer(learning_rate=self.lr_reward)
-        self.r_train_op = self.optimizer.minimize(self.loss)
+        # split minimize() so that gradient summaries reuse the gradients of the update
+        grads_and_vars = self.optimizer.compute_gradients(self.loss)
+        self.r_train_op = self.optimizer.apply_gradients(grads_and_vars)
 
         if self.summarize:
-            for v in tf.trainable_variables():
-                tf.summary.histogram(v.op.name, v)
-            grads = self.optimizer.compute_gradients(self.loss, tf.trainable_variables())
-            for grad, var in grads:
-                if grad is not None:
-                    tf.summary.histogram(var.op.name + '/gradients', grad)
+            summaries.add_histograms(grads_and_vars)
 
 
     def init_w(self, d):
@@ -437,10 +746,10 @@ class AC_IRL:
         Need to decide whether to include the null topic
         """
         num_features = int((d+1)*d / 2 + d + 1)
-        return np.random.rand(num_features, 1)
+        return self.streams.init().random((num_features, 1))
 
 
-    def init_pi0(self, path_to_dir, verbose=0):
+    def init_pi0(self, path_to_dir, verbose=0, dataset_file=None):
         """
         Generates the collection of initial population distributions.
         This collection will be sampled to get the start state for each training episode
@@ -449,7 +758,13 @@ class AC_IRL:
         ...
         pi^d_1 pi^d_2 ... pi^d_d
         where d is a fixed constant across all files
+
+        dataset_file - if not None, take the train split of this dataset instead of path_to_dir
         """
+        if dataset_file:
+            self.mat_pi0 = np.array(dataset.open_dataset(dataset_file).pi0('train', self.d))
+            return
+
         # will be list of lists
         list_pi0 = []
         num_files = len(os.listdir(path_to_dir))
@@ -473,7 +788,7 @@ class AC_IRL:
             self.mat_pi0[i] = list_pi0[i]
 
 
-    def init_pi0_test(self, path_to_dir, day_start=22, verbose=0):
+    def init_pi0_test(self, path_to_dir, day_start=22, verbose=0, dataset_file=None):
         """
         Generates the collection of initial population distributions.
         This collection will be sampled to get the start state for each training episode
@@ -482,7 +797,13 @@ class AC_IRL:
         ...
         pi^d_1 pi^d_2 ... pi^d_d
         where d is a fixed constant across all files
+
+        dataset_file - if not None, take the test split of this dataset instead of path_to_dir
         """
+        if dataset_file:
+            self.mat_pi0_test = np.array(dataset.open_dataset(dataset_file).pi0('test', self.d))
+            return
+
         # will be list of lists
         list_pi0 = []
         num_files = len(os.listdir(path_to_dir))
@@ -506,46 +827,20 @@ class AC_IRL:
             self.mat_pi0_test[i] = list_pi0[i]            
         
 
-    def sample_action(self, pi):
+    def sample_action(self, pi, rng=None):
         """
         Samples from product of d d-dimensional Dirichlet distributions
         Input:
         pi - row vector
+        rng - np.random.Generator to draw from, None to use the global np.random state
         Returns an entire transition probability matrix
         """
-        # Construct all alphas
-        self.mat_alpha = np.zeros([self.d, self.d])
-
-        # temp_{ij} = pi_j - pi_i
+        # Construct all alphas, kept for calc_gradient_vectorized
         # alpha^i_j = ln ( 1 + exp[ theta ( (pi_j - pi_i) - shift ) ] )
-        mat1 = np.repeat(pi.reshape(1, self.d), self.d, 0) # all rows same
-        mat2 = np.repeat(pi.reshape(self.d, 1), self.d, 1) # all columns same
-        temp = mat1 - mat2
-        self.mat_alpha = np.log( 1 + np.exp( self.theta * (temp - self.shift)))
+        self.mat_alpha = rollout.calc_alpha(pi, self.theta, self.shift)
 
         # Sample matrix P from Dirichlet
-        P = np.zeros([self.d, self.d])
-        for i in range(self.d):
-            # Get y^i_1, ... y^i_d
-            # Using the vector as input to shape reduces runtime by 5s
-            try:
-                y = np.random.gamma(shape=self.mat_alpha[i,:]*self.alpha_scale, scale=1)
-            except ValueError:
-                print("ValueError!")
-                print(pi)
-                print(self.mat_alpha)
-                print(self.mat_alpha[i,:]*self.alpha_scale)
-            # replace zeros with dummy value
-            y[y == 0] = 1e-20
-            total = np.sum(y)
-            # Store into i-th row of matrix P
-            try:
-                P[i] = y / total
-            except Warning:
-                P[i] = y / total
-                print(y, total)
-
-        return P
+        return rollout.sample_dirichlet(self.mat_alpha, self.alpha_scale, rng, self.sampler, self.sampler_threshold)
 
 
     def calc_features(self, pi):
@@ -631,7 +926,7 @@ class AC_IRL:
         f.close()
     
 
-    def train(self, max_episodes=4000, stop_criteria=0.01, gamma=1, constant=False, lr_critic=0.1, lr_actor=0.001, consecutive=100, file_theta='results/theta.csv', file_pi='results/pi.csv', file_reward='results/reward.csv', write_file=0, write_all=0):
+    def train(self, max_episodes=4000, stop_criteria=0.01, gamma=1, constant=False, lr_critic=0.1, lr_actor=0.001, consecutive=100, file_theta='results/theta.csv', file_pi='results/pi.csv', file_reward='results/reward.csv', write_file=0, write_all=0, stop_window=0, stop_z=2.0, critic='sgd', lstd_batch=15, lstd_reg=1e-3, lstd_decay=1.0, lstd_recursive=False):
         """
         Main actor-critic training procedure that improves theta and w
 
@@ -642,17 +937,37 @@ class AC_IRL:
         lr_critic - learning rate for value function parameter update
         lr_actor - learning rate for policy parameter update
         consecutive - number of consecutive episodes between report of average reward
-        """
+        stop_window - if > 0, stop once theta and episode return over the last
+        stop_window episodes pass is_stationary(). Must be at least 4, so
+        that each half of the window has a sample variance.
+        The learning rate schedule restarts at every call, also when theta and w
+        are carried over from a previous call, so that theta can still move
+        enough for the test to detect a trend
+        stop_z - z-value used by is_stationary(), a smaller value stops later
+        critic - 'sgd' for per-step TD updates of w, 'lstd' to solve for w by least-squares TD
+        lstd_batch - number of transitions between LSTD solves
+        lstd_reg, lstd_decay, lstd_recursive - see lstd.lstd_solver
+        """
+        if 0 < stop_window < 4:
+            raise ValueError("stop_window must be 0 or at least 4, got %d" % stop_window)
         print("----- Starting train -----")
+        if critic == 'lstd':
+            solver = lstd.lstd_solver(len(self.w), reg=lstd_reg, decay=lstd_decay, recursive=lstd_recursive)
         list_reward = []
         prev_theta = self.theta
+        # running windows for the stationarity test
+        window_theta = []
+        window_return = []
         for episode in range(1, max_episodes+1):
             # print("forward episode ", episode)
             if write_all:
                 with open('temp.csv', 'a') as f:
                     f.write('Episode %d \n\n' % episode)
+            # Each episode draws from its own stream
+            rng_episode = self.streams.episode(self.episode_count)
+            self.episode_count += 1
             # Sample starting pi^0 from mat_pi0
-            idx_row = np.random.randint(self.num_start_samples)
+            idx_row = rng_episode.integers(self.num_start_samples)
             pi = self.mat_pi0[idx_row, :] # row vector
 
             discount = 1
@@ -665,7 +980,8 @@ class AC_IRL:
                 num_steps += 1
 
                 # Sample action
-                P = self.sample_action(pi)
+                with self.prof.timer('train/sample_action'):
+                    P = self.sample_action(pi, rng_episode)
 
                 if write_all:
                     with open('temp.csv', 'ab') as f:
@@ -680,28 +996,36 @@ class AC_IRL:
 
                 # Calculate reward
                 # reward = self.calc_reward(P, pi, self.d)
-                reward = self.sess.run( self.reward_gen, feed_dict={self.gen_states:[pi], self.gen_actions:[P]} )
+                with self.prof.timer('train/reward'):
+                    reward = self.sess.run( self.reward_gen, feed_dict={self.gen_states:[pi], self.gen_actions:[P]} )
                 if np.isnan(reward) or reward == np.inf or reward == -np.inf:
                     print(reward)
                 
-                # Calculate TD error
-                vec_features_next = self.calc_features(pi_next)
-                vec_features = self.calc_features(pi)
-                # TD error = r + gamma * v(s'; w) - v(s; w)
-                delta = reward + discount*(vec_features_next.dot(self.w)) - (vec_features.dot(self.w))
-
-                # Update value function parameter
-                # w <- w + alpha * TD error * feature vector
-                # still a column vector
-                length = len(vec_features)
-                if constant:
-                    self.w = self.w + lr_critic * delta * vec_features.reshape(length,1)
-                else:
-                    self.w = self.w + (lr_critic/(episode+1)) * delta * vec_features.reshape(length,1) #here
+                with self.prof.timer('train/critic'):
+                    # Calculate TD error
+                    vec_features_next = self.calc_features(pi_next)
+                    vec_features = self.calc_features(pi)
+                    # TD error = r + gamma * v(s'; w) - v(s; w)
+                    delta = reward + discount*(vec_features_next.dot(self.w)) - (vec_features.dot(self.w))
+
+                    # Update value function parameter
+                    # w <- w + alpha * TD error * feature vector
+                    # still a column vector
+                    length = len(vec_features)
+                    if critic == 'lstd':
+                        # accumulate A and b, re-solve for w once per batch
+                        solver.add(vec_features, vec_features_next, float(reward), discount)
+                        if solver.num_added == lstd_batch:
+                            self.w = solver.solve()
+                    elif constant:
+                        self.w = self.w + lr_critic * delta * vec_features.reshape(length,1)
+                    else:
+                        self.w = self.w + (lr_critic/(episode+1)) * delta * vec_features.reshape(length,1) #here
 
                 # Update policy parameter
                 # theta <- theta + beta * grad(log(F)) * TD error
-                gradient = self.calc_gradient_vectorized(P, pi)
+                with self.prof.timer('train/gradient'):
+                    gradient = self.calc_gradient_vectorized(P, pi)
                 if constant:
                     self.theta = self.theta + lr_actor * delta * gradient
                 else:
@@ -712,6 +1036,7 @@ class AC_IRL:
                 total_reward += reward
 
             list_reward.append(total_reward)
+            self.prof.count('train/episodes')
 
             if (episode % consecutive == 0):
                 print("Theta\n", self.theta)
@@ -720,53 +1045,125 @@ class AC_IRL:
                 print("Average reward during previous %d episodes: " % consecutive, str(reward_avg))
                 list_reward = []
                 if write_file:
-                    self.train_log(self.theta, file_theta, "%.5e")
-                    self.train_log(pi, file_pi, "%.3e")
-                    self.train_log(np.array([reward_avg]), file_reward, "%.3e")
+                    with self.prof.timer('train/log'):
+                        self.train_log(self.theta, file_theta, "%.5e")
+                        self.train_log(pi, file_pi, "%.3e")
+                        self.train_log(np.array([reward_avg]), file_reward, "%.3e")
             if stop_criteria != -1 and abs(self.theta - prev_theta) < stop_criteria:
                 break
             prev_theta = self.theta
+            if stop_window > 0:
+                window_theta.append(self.theta)
+                window_return.append(float(total_reward))
+                if len(window_theta) > stop_window:
+                    window_theta.pop(0)
+                    window_return.pop(0)
+                if len(window_theta) == stop_window and self.is_stationary(window_theta, stop_z) and self.is_stationary(window_return, stop_z):
+                    break
 
         # record this policy
         self.list_policies = (self.list_policies + [self.theta])[1:]
         print("----- Exiting train at episode %d with theta %f -----" % (episode, self.theta))
 
 
-    def generate_trajectories(self, n, from_test=False):
+    def is_stationary(self, list_values, z=2.0):
+        """
+        Two-sample test for a change in mean between the first and second half of list_values.
+        Returns True if the difference of the means is within z standard errors,
+        i.e. there is no detectable trend over the window.
+        Consecutive values are correlated, so z is a heuristic threshold
+        rather than an exact significance level.
+        """
+        half = len(list_values) // 2
+        first = np.array(list_values[:half])
+        second = np.array(list_values[half:])
+        std_err = np.sqrt( np.var(first, ddof=1)/len(first) + np.var(second, ddof=1)/len(second) )
+
+        return abs(np.mean(second) - np.mean(first)) <= z * std_err
+
+
+    def generate_trajectories(self, n, from_test=False, deterministic=False):
         """
         Use the current policy self.theta to generate trajectories
         n - number of trajectories to generate
         from_test - if True, use initial state of test set to generate trajectories from policy
+        deterministic - if True, take the mean action at every step instead of sampling it
 
         Return: list of generated trajectories
         """
         print("Inside generate_trajectories")
+        if from_test:
+            mat_pi0 = self.mat_pi0_test
+        else:
+            mat_pi0 = self.mat_pi0
+        if self.remote is not None and not deterministic:
+            # same trajectory indices, generated by the rollout workers
+            self.remote.publish(self.theta, self.shift, self.alpha_scale)
+            states, actions, _ = self.remote.rollout(self.rollout_count, n, split='test' if from_test else 'train')
+            self.rollout_count += n
+            return [list(zip(states[idx], actions[idx])) for idx in range(n)]
         # Will be list of lists of tuples of form (state, action)
-        list_generated = []
-        max_hour = 16
-
-        for idx_traj in range(n):
-            trajectory = []
-            # Sample start state
-            if from_test:
-                idx_row = np.random.randint(self.num_start_samples_test)
-                pi = self.mat_pi0_test[idx_row, :] # row vector
-            else: # from train
-                idx_row = np.random.randint(self.num_start_samples)
-                pi = self.mat_pi0[idx_row, :] # row vector
-
-            # Generate trajectory, i.e. a list of state-action pairs
-            hour = 1
-            while hour < max_hour:
-                P = self.sample_action(pi)
-                trajectory.append( (pi, P) )
-                pi = np.transpose(P).dot(pi)
-                hour += 1
-            list_generated.append( trajectory )
+        # Each trajectory draws from its own stream
+        list_generated = rollout.generate_trajectories(range(self.rollout_count, self.rollout_count+n), mat_pi0, self.theta, self.shift, self.alpha_scale, self.streams, sampler=self.sampler, threshold=self.sampler_threshold, deterministic=deterministic)
+        self.rollout_count += n
 
         return list_generated
 
 
+    def attach_workers(self, list_addresses=None, num_local=0):
+        """
+        Sends trajectory generation to rollout workers over TCP (see remote.py)
+
+        list_addresses - list of (host, port) of running workers
+        num_local - number of additional workers to start on localhost.
+        If all workers are local, they attach to the start states of share_data()
+        instead of receiving copies
+        """
+        list_addresses = list(list_addresses or [])
+        handle = None
+        if num_local > 0:
+            if not list_addresses:
+                self.shared_for_workers = self.shared is None
+                handle = self.share_data()
+            self.local_workers, list_local = remote.spawn_local(num_local)
+            list_addresses += list_local
+        self.remote = remote.rollout_coordinator(list_addresses, self.mat_pi0, self.mat_pi0_test, self.streams.seed, self.reward_net_config(), sampler=self.sampler, threshold=self.sampler_threshold, shared=handle)
+
+
+    def detach_workers(self):
+        """
+        Returns to generating trajectories in this process, and stops workers started by attach_workers
+        """
+        if self.remote is not None:
+            self.remote.close()
+            self.remote = None
+        for p in self.local_workers:
+            p.terminate()
+            p.join()
+        self.local_workers = []
+        if self.shared_for_workers:
+            self.release_data()
+            self.shared_for_workers = False
+
+
+    def score_policy(self, n, from_test=False):
+        """
+        Return statistics of the current policy under the current reward network,
+        over n episodes run by the rollout workers.
+        Episodes are generated trajectories, so they advance self.rollout_count
+
+        Returns mean and std of episode returns, and rewards [n, 15]
+        """
+        if self.remote is None:
+            raise ValueError("score_policy requires rollout workers, see attach_workers")
+        self.remote.publish(self.theta, self.shift, self.alpha_scale, self.get_reward_weights())
+        _, _, rewards = self.remote.rollout(self.rollout_count, n, split='test' if from_test else 'train', score=True)
+        self.rollout_count += n
+        returns = np.sum(rewards, axis=1)
+
+        return np.mean(returns), np.std(returns), rewards
+
+
     def debug(self, feed_dict):
         self.tensor_alpha_val = self.sess.run(self.tensor_alpha, feed_dict=feed_dict)
         self.tensor_alpha_lowerbound_val = self.sess.run(self.tensor_alpha_lowerbound, feed_dict=feed_dict)
@@ -801,32 +1198,34 @@ class AC_IRL:
         print(self.vec_z_val)
 
 
-    def update_reward(self, summary=False, iteration=0):
+    def update_reward(self, summary=False):
         """
         Improvement of reward function via gradient descent
 
-        summary - if True, then run tf.summary ops
-        iteration - global iteration count for number of reward updates so far
+        summary - if True, then run tf.summary ops on this update regardless of self.summary_schedule.
+        Summaries are written at step self.reward_step, the number of reward updates
+        since construction, so steps keep increasing across calls of reward_iteration and train_reward
         """
         # print("In update_reward")
-        # Sample demonstrations from self.list_demonstrations,
-        # which is list of lists of tuples
-        if len(self.list_demonstrations) >= self.num_demo_samples:
-            demo_sampled = random.sample(self.list_demonstrations, self.num_demo_samples)
-        else:
-            demo_sampled = self.list_demonstrations[:]
-        # Separate into actions and states to calculate self.reward_demo
-        demo_states = [pair[0] for traj in demo_sampled for pair in traj]
-        demo_actions = [pair[1] for traj in demo_sampled for pair in traj]
-
-        # Sample generated trajectories from self.list_generated
-        if len(self.list_generated) >= self.num_gen_samples:
-            gen_sampled = random.sample(self.list_generated, self.num_gen_samples)
-        else:
-            gen_sampled = self.list_generated[:]
-        # Separate into actions and states to calculate self.reward_gen
-        gen_states = [pair[0] for traj in gen_sampled for pair in traj]
-        gen_actions = [pair[1] for traj in gen_sampled for pair in traj]
+        with self.prof.timer('update_reward/sample'):
+            # Each minibatch draws from its own stream
+            rng_batch = self.streams.minibatch(self.minibatch_count)
+            self.minibatch_count += 1
+            # Sample demonstrations from self.list_demonstrations,
+            # which is a codec.trajectory_store
+            if len(self.list_demonstrations) >= self.num_demo_samples:
+                indices = rng_batch.choice(len(self.list_demonstrations), self.num_demo_samples, replace=False)
+            else:
+                indices = np.arange(len(self.list_demonstrations))
+            # Decode all sampled actions at once
+            demo_states, demo_actions = self.list_demonstrations.fetch(indices)
+
+            # Sample generated trajectories from self.list_generated
+            if len(self.list_generated) >= self.num_gen_samples:
+                indices = rng_batch.choice(len(self.list_generated), self.num_gen_samples, replace=False)
+            else:
+                indices = np.arange(len(self.list_generated))
+            gen_states, gen_actions = self.list_generated.fetch(indices)
 
         # Combine
         # gen_states = gen_states + demo_states
@@ -839,11 +1238,16 @@ class AC_IRL:
         # self.debug(feed_dict)
 
         # Execute gradient descent
-        if summary and self.summarize:
-            summary, _, self.loss_val, self.first_term_val, self.second_term_val = self.sess.run([self.merged, self.r_train_op, self.loss, self.sum_demo_rewards, self.second_term], feed_dict=feed_dict)
-            self.train_writer.add_summary(summary, iteration)
-        else:
-            _, self.loss_val, self.first_term_val, self.second_term_val = self.sess.run([self.r_train_op, self.loss, self.sum_demo_rewards, self.second_term], feed_dict=feed_dict)
+        with self.prof.timer('update_reward/sess_run'):
+            self.reward_step += 1
+            if self.summarize and (summary or self.summary_schedule.due(self.reward_step)):
+                summary, _, self.loss_val, self.first_term_val, self.second_term_val = self.sess.run([self.merged, self.r_train_op, self.loss, self.sum_demo_rewards, self.second_term], feed_dict=feed_dict)
+                # only enqueued, the writer thread serializes to disk
+                self.train_writer.add_summary(summary, self.reward_step)
+                self.summary_schedule.mark()
+            else:
+                _, self.loss_val, self.first_term_val, self.second_term_val = self.sess.run([self.r_train_op, self.loss, self.sum_demo_rewards, self.second_term], feed_dict=feed_dict)
+        self.prof.count('update_reward/steps')
 
 
     def reward_iteration(self, max_iterations=500, stop_criteria=0.01, iter_check=10):
@@ -863,33 +1267,24 @@ class AC_IRL:
         print("----- Starting reward_iteration -----")
         for it in range(1, max_iterations+1):
 
-            self.reward_update_count += 1
-
             if it % iter_check != 0:
                 self.update_reward(summary=False)
             else:
                 print("Reward iteration %d" % it)
-                self.update_reward(summary=False, iteration=self.reward_update_count)
-
-                demo_states = [pair[0] for pair in self.list_eval_demo_transitions]
-                demo_actions = [pair[1] for pair in self.list_eval_demo_transitions]
-                num_test_demo = len(self.list_eval_demo_transitions)
-                gen_states = [pair[0] for pair in self.list_eval_gen_transitions]
-                gen_actions = [pair[1] for pair in self.list_eval_gen_transitions]
-                num_test_gen = len(self.list_eval_gen_transitions)
-                feed_dict = {self.demo_states:demo_states, self.demo_actions:demo_actions, self.gen_states:gen_states, self.gen_actions:gen_actions}
-                
-                reward_demo_val, reward_gen_val = self.sess.run([self.reward_demo, self.reward_gen], feed_dict=feed_dict )
-                # average reward across state-action pairs
-                reward_demo_avg = np.sum(reward_demo_val) / num_test_demo
-                reward_gen_avg = np.sum(reward_gen_val) / num_test_gen
+                self.update_reward(summary=False)
+
+                with self.prof.timer('reward_iteration/eval'):
+                    # average reward across state-action pairs
+                    reward_demo_avg = self.calc_reward_avg(self.eval_demo_states, self.eval_demo_actions, demo=True)
+                    reward_gen_avg = self.calc_reward_avg(self.eval_gen_states, self.eval_gen_actions, demo=False)
                 print("Reward demo avg %f | Reward gen avg %f" % (reward_demo_avg, reward_gen_avg))
                 print("First %f | Second %f | Loss %f" % (self.first_term_val, self.second_term_val, self.loss_val))
 
                 if np.isnan(reward_demo_avg) or np.isnan(reward_gen_avg):
                     break
-                with open("results/reward_training.csv", 'a') as f:
-                    f.write("%f,%f\n" % (reward_demo_avg, reward_gen_avg))
+                with self.prof.timer('reward_iteration/log'):
+                    with open("results/reward_training.csv", 'a') as f:
+                        f.write("%f,%f\n" % (reward_demo_avg, reward_gen_avg))
                 if stop_criteria != -1 and abs(reward_demo_avg - prev_reward_demo_avg) < stop_criteria:
                     break
                 prev_reward_demo_avg = reward_demo_avg
@@ -897,7 +1292,7 @@ class AC_IRL:
         print("----- Exiting reward_iteration at iter %d -----" % it)
 
 
-    def outerloop(self, num_iterations=20, num_gen_from_policy=5, max_reward_iterations=100, max_forward_episodes=200, gamma=1, constant=False, lr_critic=0.1, lr_actor=0.001):
+    def outerloop(self, num_iterations=20, num_gen_from_policy=5, max_reward_iterations=100, max_forward_episodes=200, gamma=1, constant=False, lr_critic=0.1, lr_actor=0.001, num_workers=0, queue_size=20, max_staleness=1, warm_start=False, stop_window=0, stop_z=2.0):
         """
         Outer-most loop that calls functions to update reward function
         and solve the forward problem
@@ -910,47 +1305,91 @@ class AC_IRL:
         constant - if True, then does not decrease learning rates
         lr_critic - learning rate for value function parameter update
         lr_actor - learning rate for policy parameter update
-        """
-
-        # At the beginning, generate trajectories from initial policies, all of which
-        # are the same. This is meant to populate the data for use in reward learning,
-        # before accumulating <num_policies> different policies from forward passes
-        self.list_generated = self.generate_trajectories(num_gen_from_policy * self.num_policies)
-        # Initialize reward update counter for writing to tensorboard
-        self.reward_update_count = 0
-        with open("results/reward_training.csv", 'w') as f:
-            f.write("reward_demo_avg,reward_gen_avg\n")
-
-        for it in range(num_iterations):
-            print("########## Outerloop iteration %d ##########" % it)
-            # Generate samples D_traj from current policy
-            list_generated = self.generate_trajectories(num_gen_from_policy)
-
-            # D_samp <- D_samp union D_traj
-            self.list_generated = self.list_generated + list_generated
-            # kick out trajectories generated from the earliest policy
-            self.list_generated = self.list_generated[num_gen_from_policy: ]
+        num_workers - if > 0, generate trajectories in this many background processes
+        that keep running while the reward network and the forward problem are trained
+        queue_size - maximum number of trajectories the workers may generate ahead
+        max_staleness - maximum number of policy updates a trajectory may lag behind
+        the current policy, 0 reproduces the sequential loop
+        warm_start - if True, each forward solve starts from theta and w left by the
+        previous one, instead of resetting theta to theta_initial. The learning rate
+        schedule restarts at every solve
+        stop_window - if > 0, forward solves stop early once theta and the episode return
+        are stationary over this many episodes, with max_forward_episodes as upper bound.
+        Must be at least 4, see train()
+        stop_z - threshold of the stationarity test, a smaller value stops later
+        """
+        if num_workers > 0:
+            # Policy versions are published after each forward solve
+            pipe = pipeline.rollout_pipeline(self.mat_pi0, self.streams.seed, self.theta, self.shift, self.alpha_scale, start_index=self.rollout_count, num_workers=num_workers, queue_size=queue_size, max_staleness=max_staleness, sampler=self.sampler, threshold=self.sampler_threshold)
+            pipe.start()
 
-            # Get a list of transitions from generated trajectories, for evaluating reward
-            self.list_eval_gen_transitions = [pair for traj in self.list_generated for pair in traj]
-            # self.list_eval_gen_transitions = self.get_eval_transitions(self.list_generated)
-
-            # Update reward function
-            self.reward_iteration(max_iterations=max_reward_iterations, stop_criteria=0.0001, iter_check=10)
-
-            # Solve forward problem
-            self.theta = self.theta_initial
-            self.train(max_forward_episodes, -1, gamma, constant, lr_critic, lr_actor, consecutive=100, file_theta='results/theta.csv', file_pi='results/pi.csv', file_reward='results/reward.csv', write_file=1, write_all=0)
-            print("\n")
+        try:
+            # At the beginning, generate trajectories from initial policies, all of which
+            # are the same. This is meant to populate the data for use in reward learning,
+            # before accumulating <num_policies> different policies from forward passes
+            if num_workers > 0:
+                list_generated = pipe.collect(num_gen_from_policy * self.num_policies)
+                # the collected trajectories are not taken from self.rollout_count on, but
+                # advancing it by the number collected keys the eval subsample of each
+                # iteration to a new stream, independent of how far ahead the workers are
+                self.rollout_count += len(list_generated)
+            else:
+                list_generated = self.generate_trajectories(num_gen_from_policy * self.num_policies)
+            self.list_generated = codec.trajectory_store(self.d, method=self.action_codec, list_trajectories=list_generated, stochastic=True)
+            with open("results/reward_training.csv", 'w') as f:
+                f.write("reward_demo_avg,reward_gen_avg\n")
+
+            for it in range(num_iterations):
+                print("########## Outerloop iteration %d ##########" % it)
+                self.prof.start_iteration(it)
+                # Generate samples D_traj from current policy
+                with self.prof.timer('generate_trajectories'):
+                    if num_workers > 0:
+                        list_generated = pipe.collect(num_gen_from_policy)
+                        self.rollout_count += len(list_generated)
+                    else:
+                        list_generated = self.generate_trajectories(num_gen_from_policy)
+
+                # D_samp <- D_samp union D_traj
+                self.list_generated.extend(list_generated)
+                # kick out trajectories generated from the earliest policy
+                self.list_generated.drop_first(num_gen_from_policy)
+
+                # Get arrays of transitions from generated trajectories, for evaluating reward
+                self.prepare_eval_sets()
+
+                # Update reward function
+                with self.prof.timer('reward_iteration'):
+                    self.reward_iteration(max_iterations=max_reward_iterations, stop_criteria=0.0001, iter_check=10)
+
+                # Solve forward problem
+                if not warm_start:
+                    self.theta = self.theta_initial
+                with self.prof.timer('train'):
+                    self.train(max_forward_episodes, -1, gamma, constant, lr_critic, lr_actor, consecutive=100, file_theta='results/theta.csv', file_pi='results/pi.csv', file_reward='results/reward.csv', write_file=1, write_all=0, stop_window=stop_window, stop_z=stop_z)
+                if num_workers > 0:
+                    pipe.publish(self.theta)
+                self.prof.end_iteration()
+                print("\n")
+        finally:
+            # also stops the workers and releases shared memory if training fails
+            if num_workers > 0:
+                print("Discarded %d stale trajectories" % pipe.num_discarded)
+                pipe.stop()
+                # later trajectories continue after every index handed out to the workers
+                self.rollout_count = max(self.rollout_count, pipe.next_index())
 
         # Save reward network
         print("Saving network")
         self.saver.save(self.sess, "log/model_%s_%d_%d.ckpt" % (self.reg, self.n_fc3, self.n_fc4))
+        if self.summarize:
+            self.train_writer.flush()
 
         # Solve forward problem completely
         print("********** Final forward training **********")
-        self.theta = self.theta_initial
-        self.train(2000, -1, gamma, constant, lr_critic, lr_actor, consecutive=100, file_theta='results/theta.csv', file_pi='results/pi.csv', file_reward='results/reward.csv', write_file=1, write_all=0)
+        if not warm_start:
+            self.theta = self.theta_initial
+        self.train(2000, -1, gamma, constant, lr_critic, lr_actor, consecutive=100, file_theta='results/theta.csv', file_pi='results/pi.csv', file_reward='results/reward.csv', write_file=1, write_all=0, stop_window=stop_window, stop_z=stop_z)
         return self.theta
 
 
@@ -968,11 +1407,10 @@ class AC_IRL:
         num_gen_from_policy - number of trajectories to generate using fixed policy
         iter_check - check reward value on selected demo trajectory after every <iter_check> iterations
         """
-        self.list_generated = self.generate_trajectories(num_gen_from_policy * self.num_policies)
+        self.list_generated = codec.trajectory_store(self.d, method=self.action_codec, list_trajectories=self.generate_trajectories(num_gen_from_policy * self.num_policies), stochastic=True)
 
-        # Get a list of transitions from generated trajectories, for testing reward function
-        self.list_eval_gen_transitions = [pair for traj in self.list_generated for pair in traj]
-        # self.list_eval_gen_transitions = self.get_eval_transitions(self.list_generated)
+        # Get arrays of transitions from generated trajectories, for testing reward function
+        self.prepare_eval_sets()
         
         with open("results/" + filename, 'w') as f:
             f.write("iteration,reward_demo_avg,reward_gen_avg\n")
@@ -983,20 +1421,11 @@ class AC_IRL:
                 self.update_reward(summary=False)
             else:
                 print("Iteration %d" % it)
-                self.update_reward(summary=False, iteration=it)
-                
-                demo_states = [pair[0] for pair in self.list_eval_demo_transitions]
-                demo_actions = [pair[1] for pair in self.list_eval_demo_transitions]
-                num_test_demo = len(self.list_eval_demo_transitions)
-                gen_states = [pair[0] for pair in self.list_eval_gen_transitions]
-                gen_actions = [pair[1] for pair in self.list_eval_gen_transitions]
-                num_test_gen = len(self.list_eval_gen_transitions)
-                feed_dict = {self.demo_states:demo_states, self.demo_actions:demo_actions, self.gen_states:gen_states, self.gen_actions:gen_actions}
+                self.update_reward(summary=False)
                 
-                reward_demo_val, reward_gen_val = self.sess.run([self.reward_demo, self.reward_gen], feed_dict=feed_dict )
                 # average reward across all transitions
-                reward_demo_avg = np.sum(reward_demo_val) / num_test_demo
-                reward_gen_avg = np.sum(reward_gen_val) / num_test_gen
+                reward_demo_avg = self.calc_reward_avg(self.eval_demo_states, self.eval_demo_actions, demo=True)
+                reward_gen_avg = self.calc_reward_avg(self.eval_gen_states, self.eval_gen_actions, demo=False)
                 print("Reward demo avg %f | Reward gen avg %f" % (reward_demo_avg, reward_gen_avg))
                 print("First %f | Second %f | Loss %f" % (self.first_term_val, self.second_term_val, self.loss_val))
                 with open("results/" + filename, 'a') as f:
@@ -1015,13 +1444,11 @@ class AC_IRL:
 
         # Evaluate on demonstration training set and generated set
         num_demos = len(self.list_demonstrations)
-        self.list_generated = self.generate_trajectories(num_demos)
-        gen_states = [pair[0] for traj in self.list_generated for pair in traj]
-        gen_actions = [pair[1] for traj in self.list_generated for pair in traj]
+        self.list_generated = codec.trajectory_store(self.d, method=self.action_codec, list_trajectories=self.generate_trajectories(num_demos), stochastic=True)
+        gen_states, gen_actions = self.list_generated.fetch()
         num_test_gen = len(gen_states)
 
-        demo_states = [pair[0] for traj in self.list_demonstrations for pair in traj]
-        demo_actions = [pair[1] for traj in self.list_demonstrations for pair in traj]
+        demo_states, demo_actions = self.list_demonstrations.fetch()
         num_test_demo = len(demo_states)
 
         feed_dict = {self.demo_states:demo_states, self.demo_actions:demo_actions, self.gen_states:gen_states, self.gen_actions:gen_actions}
@@ -1030,8 +1457,7 @@ class AC_IRL:
         reward_gen_avg = np.sum(reward_gen_val) / num_test_gen
 
         # Evaluate on demonstration validation or test set
-        demo_states = [pair[0] for traj in self.list_demonstrations_test for pair in traj]
-        demo_actions = [pair[1] for traj in self.list_demonstrations_test for pair in traj]
+        demo_states, demo_actions = self.list_demonstrations_test.fetch()
         num_test_demo = len(demo_states)
 
         feed_dict = {self.demo_states:demo_states, self.demo_actions:demo_actions}
@@ -1043,7 +1469,7 @@ class AC_IRL:
         return reward_demo_avg_train, reward_demo_avg_test, reward_gen_avg
 
 
-    def plot_reward_distribution(self, theta_good=8.64, xmin=-0.1, xmax=0.4, legend_loc=0, gen_test=False, num_bins=20, filename='reward_distribution.pdf'):
+    def plot_reward_distribution(self, theta_good=8.64, xmin=-0.1, xmax=0.4, legend_loc=0, gen_test=False, num_bins=20, filename='reward_distribution.pdf', streaming=False):
         """
         Generate three histograms
         1. distribution of reward for demo transitions
@@ -1052,52 +1478,45 @@ class AC_IRL:
 
         theta_good - learned theta for generating good transitions
         xmin, xmax, ymin, ymax - axis boundaries
+        streaming - if True, accumulate rewards into histograms chunk by chunk
+        instead of holding all rewards in memory
         """
-
-        # Get rewards on demo transitions
-        demo_states = [pair[0] for traj in self.list_demonstrations for pair in traj]
-        demo_actions = [pair[1] for traj in self.list_demonstrations for pair in traj]
-        feed_dict = {self.demo_states:demo_states, self.demo_actions:demo_actions}
-        reward_demo_val = self.sess.run(self.reward_demo, feed_dict=feed_dict)
-
-        # Rewards on demo test transitions
-        demo_test_states = [pair[0] for traj in self.list_demonstrations_test for pair in traj]
-        demo_test_actions = [pair[1] for traj in self.list_demonstrations_test for pair in traj]
-        feed_dict = {self.demo_states:demo_test_states, self.demo_actions:demo_test_actions}
-        reward_demo_test_val = self.sess.run(self.reward_demo, feed_dict=feed_dict)
+        # Demo transitions
+        demo_states, demo_actions = self.list_demonstrations.fetch()
+        # Demo test transitions
+        demo_test_states, demo_test_actions = self.list_demonstrations_test.fetch()
 
         # Generate list of trajectories using policy from initial state of training demo
         num_demos = len(self.list_demonstrations)
         self.theta = theta_good
-        list_generated_good = self.generate_trajectories(num_demos)
-        gen_states = [pair[0] for traj in list_generated_good for pair in traj]
-        gen_actions = [pair[1] for traj in list_generated_good for pair in traj]
-        feed_dict = {self.gen_states:gen_states, self.gen_actions:gen_actions}
-        reward_gen_from_train = self.sess.run(self.reward_gen, feed_dict=feed_dict)
-
+        gen_states, gen_actions = self.flatten_trajectories(self.generate_trajectories(num_demos))
         # Generate list of trajectories using policy from initial state of test demo
-        list_generated_from_test = self.generate_trajectories(num_demos, from_test=True)
-        gen_states = [pair[0] for traj in list_generated_from_test for pair in traj]
-        gen_actions = [pair[1] for traj in list_generated_from_test for pair in traj]
-        feed_dict = {self.gen_states:gen_states, self.gen_actions:gen_actions}
-        reward_gen_from_test = self.sess.run(self.reward_gen, feed_dict=feed_dict)        
+        gen_test_states, gen_test_actions = self.flatten_trajectories(self.generate_trajectories(num_demos, from_test=True))
+
+        list_sets = [(demo_states, demo_actions, True, 'Demo (train)', 'g'),
+                     (demo_test_states, demo_test_actions, True, 'Demo (test)', 'r'),
+                     (gen_states, gen_actions, False, 'Generated (from train)', 'b'),
+                     (gen_test_states, gen_test_actions, False, 'Generated (from test)', 'k')]
 
         fig = plt.figure(1)
 
-        density_demo = gaussian_kde(reward_demo_val.flatten())
         xs = np.linspace(xmin, xmax, 200)
-        # density_demo.covariance_factor = lambda : .25
-        # density_demo._compute_covariance()
-        plt.plot(xs, density_demo(xs), label='Demo (train)', color='g')
-
-        density_demo_test = gaussian_kde(reward_demo_test_val.flatten())
-        plt.plot(xs, density_demo_test(xs), label='Demo (test)', color='r')
-
-        density_gen = gaussian_kde(reward_gen_from_train.flatten())
-        plt.plot(xs, density_gen(xs), label='Generated (from train)', color='b')
-
-        density_gen_from_test = gaussian_kde(reward_gen_from_test.flatten())
-        plt.plot(xs, density_gen_from_test(xs), label='Generated (from test)', color='k')
+        # the same bins in both modes, so that their JSD are comparable,
+        # rewards outside [xmin, xmax] are counted in the end bins
+        edges = np.linspace(xmin, xmax, num_bins + 1)
+        list_dist = []
+        for states, actions, demo, label, color in list_sets:
+            if streaming:
+                hist = self.calc_reward_histogram(states, actions, xmin - (xmax - xmin), xmax + (xmax - xmin), demo=demo, edges=edges)
+                plt.plot(xs, hist.density(xs), label=label, color=color)
+                list_dist.append(hist.histogram())
+            else:
+                if demo:
+                    reward_val = self.sess.run(self.reward_demo, feed_dict={self.demo_states:states, self.demo_actions:actions})
+                else:
+                    reward_val = self.sess.run(self.reward_gen, feed_dict={self.gen_states:states, self.gen_actions:actions})
+                plt.plot(xs, density.binned_kde(reward_val, xs), label=label, color=color)
+                list_dist.append(reward_val)
 
         plt.ylabel('Density')
         plt.xlabel('Reward')
@@ -1113,60 +1532,66 @@ class AC_IRL:
         pp.savefig(fig, bbox_inches='tight')
         pp.close()
 
-        dist_demo_train, _, _ = plt.hist(reward_demo_val, bins=num_bins, normed=0, facecolor='g')
-        dist_demo_test, _, _ = plt.hist(reward_demo_test_val, bins=num_bins, normed=0, facecolor='r')
-        dist_gen_from_train, _, _ = plt.hist(reward_gen_from_train, bins=num_bins, normed=0, facecolor='b')
-        dist_gen_from_test, _, _ = plt.hist(reward_gen_from_test, bins=num_bins, normed=0, facecolor='k')        
+        if not streaming:
+            list_dist = [plt.hist(density.clip_to_edges(reward_val, edges), bins=edges, normed=0, facecolor=color)[0] for reward_val, (_, _, _, _, color) in zip(list_dist, list_sets)]
+        dist_demo_train, dist_demo_test, dist_gen_from_train, dist_gen_from_test = list_dist
 
         print("JSD between demo train and demo_test", self.JSD(dist_demo_train, dist_demo_test))
         print("JSD between demo and gen_from_train", self.JSD(dist_demo_train, dist_gen_from_train))
         print("JSD between demo and gen_from_test", self.JSD(dist_demo_test, dist_gen_from_test))
 
 
-    def plot_reward_distribution_pairs(self, theta_good=8.64, xmin=-0.1, xmax=0.4, legend_loc=0, train=True, num_bins=20, filename='reward_distribution.pdf'):
+    def plot_reward_distribution_pairs(self, theta_good=8.64, xmin=-0.1, xmax=0.4, legend_loc=0, train=True, num_bins=20, filename='reward_distribution.pdf', streaming=False):
         """
         Generate interpolated density plot of either (demo train, gen from train)
         or (demo test, gen from test)
 
         theta_good - learned theta for generating good transitions
         xmin, xmax, ymin, ymax - axis boundaries
+        streaming - if True, accumulate rewards into histograms chunk by chunk
+        instead of holding all rewards in memory
         """
         self.theta = theta_good
         if train:
             # Get rewards on training demo transitions
-            demo_states = [pair[0] for traj in self.list_demonstrations for pair in traj]
-            demo_actions = [pair[1] for traj in self.list_demonstrations for pair in traj]
+            demo_states, demo_actions = self.list_demonstrations.fetch()
             num_demos = len(self.list_demonstrations)
             list_generated = self.generate_trajectories(num_demos, from_test=False)
         else:
             # Rewards on test demo transitions
-            demo_states = [pair[0] for traj in self.list_demonstrations_test for pair in traj]
-            demo_actions = [pair[1] for traj in self.list_demonstrations_test for pair in traj]
+            demo_states, demo_actions = self.list_demonstrations_test.fetch()
             num_demos = len(self.list_demonstrations_test)
             list_generated = self.generate_trajectories(num_demos, from_test=True)
         
-        gen_states = [pair[0] for traj in list_generated for pair in traj]
-        gen_actions = [pair[1] for traj in list_generated for pair in traj]
-            
-        feed_dict = {self.demo_states:demo_states, self.demo_actions:demo_actions}
-        reward_demo_val = self.sess.run(self.reward_demo, feed_dict=feed_dict)
-
-        feed_dict = {self.gen_states:gen_states, self.gen_actions:gen_actions}
-        reward_gen_val = self.sess.run(self.reward_gen, feed_dict=feed_dict)
+        gen_states, gen_actions = self.flatten_trajectories(list_generated)
 
         fig = plt.figure(1)
 
-        density_demo = gaussian_kde(reward_demo_val.flatten())
         xs = np.linspace(xmin, xmax, 200)
-        # density_demo.covariance_factor = lambda : .25
-        # density_demo._compute_covariance()
+        # the same bins in both modes, so that their JSD are comparable,
+        # rewards outside [xmin, xmax] are counted in the end bins
+        edges = np.linspace(xmin, xmax, num_bins + 1)
+        if streaming:
+            hist_demo = self.calc_reward_histogram(demo_states, demo_actions, xmin - (xmax - xmin), xmax + (xmax - xmin), demo=True, edges=edges)
+            hist_gen = self.calc_reward_histogram(gen_states, gen_actions, xmin - (xmax - xmin), xmax + (xmax - xmin), demo=False, edges=edges)
+            density_demo = hist_demo.density(xs)
+            density_gen = hist_gen.density(xs)
+        else:
+            feed_dict = {self.demo_states:demo_states, self.demo_actions:demo_actions}
+            reward_demo_val = self.sess.run(self.reward_demo, feed_dict=feed_dict)
+
+            feed_dict = {self.gen_states:gen_states, self.gen_actions:gen_actions}
+            reward_gen_val = self.sess.run(self.reward_gen, feed_dict=feed_dict)
+
+            density_demo = density.binned_kde(reward_demo_val, xs)
+            density_gen = density.binned_kde(reward_gen_val, xs)
+
         if train:
-            plt.plot(xs, density_demo(xs), linewidth=2, label='Demo (train)', color='g')
+            plt.plot(xs, density_demo, linewidth=2, label='Demo (train)', color='g')
         else:
-            plt.plot(xs, density_demo(xs), linewidth=2, label='Demo (test)', color='g')
+            plt.plot(xs, density_demo, linewidth=2, label='Demo (test)', color='g')
 
-        density_gen = gaussian_kde(reward_gen_val.flatten())
-        plt.plot(xs, density_gen(xs), linewidth=2, label='Generated', color='b')
+        plt.plot(xs, density_gen, linewidth=2, label='Generated', color='b')
 
         plt.ylabel('Density')
         plt.xlabel('Reward')
@@ -1185,8 +1610,12 @@ class AC_IRL:
         pp.savefig(fig, bbox_inches='tight')
         pp.close()
 
-        dist_demo, _, _ = plt.hist(reward_demo_val, bins=num_bins, normed=0, facecolor='g')
-        dist_gen, _, _ = plt.hist(reward_gen_val, bins=num_bins, normed=0, facecolor='b')
+        if streaming:
+            dist_demo = hist_demo.histogram()
+            dist_gen = hist_gen.histogram()
+        else:
+            dist_demo, _, _ = plt.hist(density.clip_to_edges(reward_demo_val, edges), bins=edges, normed=0, facecolor='g')
+            dist_gen, _, _ = plt.hist(density.clip_to_edges(reward_gen_val, edges), bins=edges, normed=0, facecolor='b')
 
         print("JSD between demo and gen", self.JSD(dist_demo, dist_gen))
         plt.gcf().clear()
@@ -1204,23 +1633,19 @@ class AC_IRL:
         """
 
         # Get rewards on demo transitions
-        demo_states = [pair[0] for traj in self.list_demonstrations for pair in traj]
-        demo_actions = [pair[1] for traj in self.list_demonstrations for pair in traj]
+        demo_states, demo_actions = self.list_demonstrations.fetch()
         feed_dict = {self.demo_states:demo_states, self.demo_actions:demo_actions}
         reward_demo_val = self.sess.run(self.reward_demo, feed_dict=feed_dict)
 
         # Rewards on demo test transitions
-        demo_test_states = [pair[0] for traj in self.list_demonstrations_test for pair in traj]
-        demo_test_actions = [pair[1] for traj in self.list_demonstrations_test for pair in traj]
+        demo_test_states, demo_test_actions = self.list_demonstrations_test.fetch()
         feed_dict = {self.demo_states:demo_test_states, self.demo_actions:demo_test_actions}
         reward_demo_test_val = self.sess.run(self.reward_demo, feed_dict=feed_dict)
 
         # Generate list of trajectories using good policy
         num_demos = len(self.list_demonstrations)
         self.theta = theta_good
-        list_generated_good = self.generate_trajectories(num_demos)
-        gen_states = [pair[0] for traj in list_generated_good for pair in traj]
-        gen_actions = [pair[1] for traj in list_generated_good for pair in traj]
+        gen_states, gen_actions = self.flatten_trajectories(self.generate_trajectories(num_demos))
         feed_dict = {self.gen_states:gen_states, self.gen_actions:gen_actions}
         reward_gen_good = self.sess.run(self.reward_gen, feed_dict=feed_dict)
 
@@ -1274,9 +1699,8 @@ class AC_IRL:
         theta_bad - some random bad theta for generating bad transitions
         """
         # Get demo actions
-        demo_actions = [pair[1] for traj in self.list_demonstrations for pair in traj]
-        demo_actions_arr = np.asarray(demo_actions)
-        demo_avg = np.mean(demo_actions_arr, axis=0)
+        _, demo_actions = self.list_demonstrations.fetch()
+        demo_avg = np.mean(demo_actions, axis=0)
 
         # Generate list of trajectories using good policy
         num_demos = len(self.list_demonstrations)
@@ -1334,9 +1758,8 @@ class AC_IRL:
         theta_bad - some random bad theta for generating bad transitions
         """
         # Get demo actions
-        demo_actions = [pair[1] for traj in self.list_demonstrations for pair in traj]
-        demo_actions_arr = np.asarray(demo_actions)
-        demo_avg = np.mean(demo_actions_arr, axis=0)
+        _, demo_actions = self.list_demonstrations.fetch()
+        demo_avg = np.mean(demo_actions, axis=0)
 
         # Generate list of trajectories using good policy
         num_demos = len(self.list_demonstrations)
@@ -1375,6 +1798,142 @@ class AC_IRL:
         pp.close()        
 
 
+    def landscape_states(self, rows=None, num_interp=5):
+        """
+        Builds a set of states for reward_landscape
+
+        rows - indices of rows of self.mat_pi0 to include, None for all rows
+        num_interp - number of interpolated states strictly between consecutive selected rows
+
+        Returns
+        mat_states - [num_states, d]
+        list_labels - description of each state
+        """
+        if rows is None:
+            rows = range(self.mat_pi0.shape[0])
+        list_states = []
+        list_labels = []
+        for idx, row in enumerate(rows):
+            list_states.append(self.mat_pi0[row])
+            list_labels.append('pi0[%d]' % row)
+            if idx + 1 < len(rows):
+                for k in range(1, num_interp+1):
+                    w = k / float(num_interp + 1)
+                    list_states.append( (1 - w) * self.mat_pi0[row] + w * self.mat_pi0[rows[idx+1]] )
+                    list_labels.append('%.2f pi0[%d] + %.2f pi0[%d]' % (1-w, row, w, rows[idx+1]))
+        # [heavy ... light]
+        state_heavy = 2.0**(self.d - np.arange(self.d))
+        list_states.append(state_heavy / np.sum(state_heavy))
+        list_labels.append('heavy')
+        # [uniform .... uniform]
+        list_states.append(np.ones(self.d) / self.d)
+        list_labels.append('uniform')
+
+        return np.array(list_states), list_labels
+
+
+    def landscape_actions(self, state, list_theta=[0, 2, 4, 8.64], num_samples=1, num_permutations=1, rng=None):
+        """
+        Builds a set of actions for reward_landscape: samples of the policy at state
+        for each theta, the same samples with reversed columns and with random column
+        permutations, and the uniform action
+
+        state - population distribution at which actions are sampled
+        rng - np.random.Generator, None to use the next evaluation stream
+
+        Returns
+        tensor_actions - [num_actions, d, d]
+        list_labels - description of each action
+        """
+        if rng is None:
+            rng = self.streams.eval(self.eval_count)
+            self.eval_count += 1
+        theta_saved = self.theta
+        list_actions = []
+        list_labels = []
+        for theta in list_theta:
+            self.theta = theta
+            for idx in range(num_samples):
+                P = self.sample_action(state, rng)
+                list_actions.append(P)
+                list_labels.append('theta=%g #%d' % (theta, idx))
+                # people in topic i only move to topic j that has lower popularity
+                list_actions.append(P[:, ::-1])
+                list_labels.append('theta=%g #%d reversed' % (theta, idx))
+                for idx_perm in range(num_permutations):
+                    list_actions.append(P[:, rng.permutation(self.d)])
+                    list_labels.append('theta=%g #%d permutation %d' % (theta, idx, idx_perm))
+        self.theta = theta_saved
+        # everyone moves equally to all topics
+        list_actions.append(np.ones((self.d, self.d)) / self.d)
+        list_labels.append('uniform')
+
+        return np.array(list_actions), list_labels
+
+
+    def reward_landscape(self, mat_states, tensor_actions, outfile=None, state_labels=None, action_labels=None):
+        """
+        Scores every (state, action) pair in the cross product of mat_states and tensor_actions,
+        evaluating chunks of self.eval_batch_size pairs per sess.run
+
+        mat_states - [num_states, d]
+        tensor_actions - [num_actions, d, d]
+        outfile - if not None, save reward matrix and labels to this .npz file
+
+        Returns reward matrix [num_states, num_actions]
+        """
+        num_states = mat_states.shape[0]
+        num_actions = tensor_actions.shape[0]
+        mat_states = mat_states.astype(np.float32)
+        tensor_actions = tensor_actions.astype(np.float32)
+        reward_flat = np.zeros(num_states * num_actions, dtype=np.float32)
+        # pair k is (state k // num_actions, action k % num_actions)
+        for idx_start in range(0, num_states * num_actions, self.eval_batch_size):
+            idx_end = min(idx_start + self.eval_batch_size, num_states * num_actions)
+            indices = np.arange(idx_start, idx_end)
+            feed_dict = {self.gen_states:mat_states[indices // num_actions], self.gen_actions:tensor_actions[indices % num_actions]}
+            reward_flat[idx_start:idx_end] = np.ravel(self.sess.run(self.reward_gen, feed_dict=feed_dict))
+        reward_matrix = reward_flat.reshape(num_states, num_actions)
+
+        if outfile:
+            if state_labels is None:
+                state_labels = [str(idx) for idx in range(num_states)]
+            if action_labels is None:
+                action_labels = [str(idx) for idx in range(num_actions)]
+            np.savez(outfile, reward=reward_matrix, states=mat_states, actions=tensor_actions, state_labels=np.array(state_labels), action_labels=np.array(action_labels))
+
+        return reward_matrix
+
+
+    def plot_reward_landscape(self, infile, r_min=None, r_max=None, cmap='hot', filename='reward_landscape.pdf'):
+        """
+        Plots a reward matrix saved by reward_landscape as a heatmap
+
+        infile - .npz file written by reward_landscape
+        r_min, r_max - color range, None for the range of the matrix
+        """
+        with np.load(infile) as data:
+            reward_matrix = data['reward']
+
+        fig = plt.figure()
+        ax = plt.gca()
+
+        im = ax.imshow(reward_matrix, cmap=cmap, vmin=r_min, vmax=r_max, aspect='auto', interpolation='nearest')
+        ax.set_title('Reward of state-action pairs')
+        ax.set_xlabel('Actions (A)')
+        ax.set_ylabel('States (S)')
+        for item in ([ax.yaxis.label, ax.xaxis.label, ax.title]):
+            item.set_fontsize(14)
+
+        fig.colorbar(im)
+
+        pp = PdfPages('plots_irl/'+filename)
+        pp.savefig(fig, bbox_inches='tight')
+        pp.close()
+
+        plt.gcf().clear()
+
+
     def plot_reward_heatmap(self, r_min=-0.25, r_max=0.5, cmap='hot', filename='reward_heatmap.pdf'):
         """
         Generates three kinds of states
@@ -1410,14 +1969,8 @@ class AC_IRL:
         # reverse the all rows of action1
         action3 = action1[:, ::-1]
 
-        reward_matrix = np.zeros((3,3), dtype=np.float32)
-        matrix_pairs = [ [(state1,action1), (state1,action2), (state1,action3)], [(state2,action1), (state2,action2), (state2,action3)], [(state3,action1), (state3,action2), (state3,action3)] ]
-        for idx_row in range(0,3):
-            for idx_col in range(0,3):
-                pair = matrix_pairs[idx_row][idx_col]
-                feed_dict = {self.gen_states:[pair[0]], self.gen_actions:[pair[1]]}
-                reward_val = self.sess.run(self.reward_gen, feed_dict=feed_dict)
-                reward_matrix[idx_row, idx_col] = reward_val
+        # score all 9 pairs in one batch
+        reward_matrix = self.reward_landscape(np.array([state1, state2, state3]), np.array([action1, action2, action3]))
 
         fig = plt.figure()
         ax = plt.gca()
@@ -1463,16 +2016,41 @@ class AC_IRL:
         return 0.5 * (entropy(P,M) + entropy(Q,M))
 
 
-    def generate_trajectory(self, pi0, total_hours):
+    def JSD_batch(self, P, Q):
+        """
+        JSD over the last axis of arrays P and Q of the same shape,
+        with the same zero replacement and normalization as JSD
+        """
+        P = np.where(P == 0, 1e-100, P)
+        Q = np.where(Q == 0, 1e-100, Q)
+        M = 0.5 * (P + Q)
+
+        def kl(X, Y):
+            # scipy.stats.entropy normalizes both arguments
+            X = X / np.sum(X, axis=-1, keepdims=True)
+            Y = Y / np.sum(Y, axis=-1, keepdims=True)
+            return np.sum(special.xlogy(X, X) - special.xlogy(X, Y), axis=-1)
+
+        return 0.5 * (kl(P, M) + kl(Q, M))
+
+
+    def generate_trajectory(self, pi0, total_hours, rng=None, deterministic=False):
         """
         Argument:
         pi0 - initial population distribution (included in output)
         total_hours - number of hours to generate (including first and last hour)
+        rng - np.random.Generator, None to use the next evaluation stream
+        deterministic - if True, take the mean action at every step, no random numbers are drawn
 
         Return:
         Matrix, each row is the distribution at a discrete time step,
         from pi^0 to pi^N
         """
+        if deterministic:
+            return rollout.mean_trajectories(np.reshape(pi0, (1, -1)), [self.theta], [self.shift], total_hours)[0, 0]
+        if rng is None:
+            rng = self.streams.eval(self.eval_count)
+            self.eval_count += 1
 
         pi = pi0
         # Initialize matrix to store trajectory
@@ -1483,7 +2061,7 @@ class AC_IRL:
         hour = 1
 
         while hour < total_hours:
-            P = self.sample_action(pi)
+            P = self.sample_action(pi, rng)
             pi_next = np.transpose(P).dot(pi)
             mat_trajectory[hour] = pi_next
             pi = pi_next
@@ -1492,13 +2070,60 @@ class AC_IRL:
         return mat_trajectory
 
 
-    def evaluate(self, theta=8.86349, shift=0.5, alpha_scale=1e4, d=15, episode_length=16, indir='test_normalized_round2', outfile='eval_mfg_round2/validation.csv', write_header=0):
+    def simulate_population(self, pi0, total_hours, num_agents=int(1e6), num_replicates=1, rng=None):
+        """
+        Runs the mean-field trajectory and finite populations of num_agents agents
+        through the same sampled actions, to check the mean-field approximation
+
+        Argument:
+        pi0 - initial population distribution
+        total_hours - number of hours (including first and last hour)
+        num_agents - number of agents N in each population
+        num_replicates - number of independent populations
+        rng - np.random.Generator, None to use the next evaluation stream
+
+        Return:
+        mat_trajectory - mean-field trajectory, [total_hours, d]
+        tensor_empirical - empirical distributions, [num_replicates, total_hours, d]
+        mat_l1 - L1 distance between empirical and mean-field distribution, [num_replicates, total_hours]
+        mat_jsd - Jensen-Shannon divergence, [num_replicates, total_hours]
+        """
+        if rng is None:
+            rng = self.streams.eval(self.eval_count)
+            self.eval_count += 1
+
+        pi = pi0
+        mat_trajectory = np.zeros([total_hours, self.d])
+        mat_trajectory[0] = pi
+        list_P = []
+        for hour in range(1, total_hours):
+            P = self.sample_action(pi, rng)
+            list_P.append(P)
+            pi = np.transpose(P).dot(pi)
+            mat_trajectory[hour] = pi
+
+        tensor_counts, tensor_empirical = population.simulate(pi0, list_P, num_agents, rng, num_replicates)
+
+        mat_l1 = np.sum(np.abs(tensor_empirical - mat_trajectory), axis=2)
+        mat_jsd = np.zeros([num_replicates, total_hours])
+        for r in range(num_replicates):
+            for hour in range(total_hours):
+                # JSD replaces zeros in place
+                mat_jsd[r, hour] = self.JSD(np.array(tensor_empirical[r, hour]), np.array(mat_trajectory[hour]))
+
+        print("N = %d, mean L1 %.3e, max L1 %.3e, mean JSD %.3e" % (num_agents, np.mean(mat_l1), np.max(mat_l1), np.mean(mat_jsd)))
+
+        return mat_trajectory, tensor_empirical, mat_l1, mat_jsd
+
+
+    def evaluate(self, theta=8.86349, shift=0.5, alpha_scale=1e4, d=15, episode_length=16, indir='test_normalized_round2', outfile='eval_mfg_round2/validation.csv', write_header=0, deterministic=False):
         """
         Main evaluation function
 
         Argument:
         theta - value to use for the fixed policy
         indir - directory containing the test dataset
+        deterministic - if True, evaluate the mean-action trajectory
 
         """
         # Fix policy by setting parameter
@@ -1527,7 +2152,7 @@ class AC_IRL:
             pi0 = mat_empirical[0]
 
             # Generate entire trajectory using policy
-            mat_trajectory = self.generate_trajectory(pi0, episode_length)
+            mat_trajectory = self.generate_trajectory(pi0, episode_length, deterministic=deterministic)
 
             # L1 norm of difference between generated and empirical final distribution pi^N
             l1_final = norm(mat_trajectory[-1] - mat_empirical[-1], ord=1)
@@ -1570,29 +2195,107 @@ class AC_IRL:
         return mean_l1_final, mean_l1_mean, mean_JSD_final, mean_JSD_mean
 
 
-    def gridsearch(self, theta_range, shift_range, alpha_range, indir, outfile):
+    def gridsearch(self, theta_range, shift_range, alpha_range, indir, outfile, deterministic=False):
         """
         Arguments:
         theta_range - array
         shift_range - array
         alpha_range - array
+        deterministic - if True, evaluate mean-action trajectories of the whole grid at once with evaluate_grid
         """
         list_tuples = [[100,0,0,0],[100,0,0,0],[100,0,0,0],[100,0,0,0]]
-        for theta in theta_range:
-            for shift in shift_range:
-                for alpha_scale in alpha_range:
-                    print("Theta %f, shift %f, alpha %d" % (theta, shift, alpha_scale))
-                    result = self.evaluate(theta, shift, alpha_scale, indir=indir, outfile=outfile, write_header=0)
-                    for idx in range(4):
-                        if result[idx] <= list_tuples[idx][0]:
-                            list_tuples[idx] = [result[idx], theta, shift, alpha_scale]
+        if deterministic:
+            list_results = self.evaluate_grid(theta_range, shift_range, alpha_range, indir=indir, outfile=outfile)
+        else:
+            list_results = []
+            for theta in theta_range:
+                for shift in shift_range:
+                    for alpha_scale in alpha_range:
+                        print("Theta %f, shift %f, alpha %d" % (theta, shift, alpha_scale))
+                        list_results.append( (theta, shift, alpha_scale, self.evaluate(theta, shift, alpha_scale, indir=indir, outfile=outfile, write_header=0)) )
+        for theta, shift, alpha_scale, result in list_results:
+            for idx in range(4):
+                if result[idx] <= list_tuples[idx][0]:
+                    list_tuples[idx] = [result[idx], theta, shift, alpha_scale]
         print(list_tuples)
 
 
-    def visualize(self, theta=8.86349, d=21, topic=0, dir_train='train_normalized', train_start=1, train_end=26, dir_test='test_normalized', test_start=27, test_end=37, save_plot=0, outfile='plots/mfg_topic0_theta8p86_s0p5_alpha1e4_m5d9.pdf'):
+    def evaluate_grid(self, theta_range, shift_range, alpha_range, d=15, episode_length=16, indir='test_normalized_round2', outfile='eval_mfg_round2/validation.csv', write_header=0):
+        """
+        evaluate() with deterministic=True for every (theta, shift, alpha_scale) of the grid.
+        Mean-action trajectories of all settings from all test start states are
+        computed together by rollout.mean_trajectories, and the metrics with array operations.
+        alpha_scale does not change the mean action, so its values share one result.
+
+        Writes the same rows as evaluate() to outfile
+        Returns list of (theta, shift, alpha_scale, (mean_l1_final, mean_l1_mean, mean_JSD_final, mean_JSD_mean))
+        """
+        self.d = d
+        path_to_dir = os.getcwd() + '/' + indir
+        list_empirical = []
+        for filename in os.listdir(path_to_dir):
+            with open(path_to_dir + '/' + filename, 'r') as f:
+                list_empirical.append( np.loadtxt(f, delimiter=' ')[0:episode_length, 0:self.d] )
+        # [num_files, episode_length, d]
+        tensor_empirical = np.array(list_empirical)
+
+        list_settings = list(itertools.product(theta_range, shift_range))
+        vec_theta = np.array([theta for theta, _ in list_settings])
+        vec_shift = np.array([shift for _, shift in list_settings])
+        # [num_settings, num_files, episode_length, d]
+        tensor_traj = rollout.mean_trajectories(tensor_empirical[:, 0], vec_theta, vec_shift, episode_length)
+
+        # metrics per setting and file, [num_settings, num_files]
+        diff = np.abs(tensor_empirical[None] - tensor_traj)
+        l1_final = np.sum(diff[:, :, -1], axis=2)
+        l1_mean = np.mean(np.sum(diff, axis=3), axis=2)
+        JSD_final = self.JSD_batch(tensor_traj[:, :, -1], np.broadcast_to(tensor_empirical[:, -1], tensor_traj[:, :, -1].shape))
+        JSD_mean = np.mean(self.JSD_batch(np.broadcast_to(tensor_empirical, tensor_traj.shape), tensor_traj), axis=2)
+
+        list_results = []
+        with open(outfile, 'a') as f:
+            if write_header:
+                f.write('theta,shift,alpha_scale,mean_l1_final,std_l1_final,mean_l1_mean,std_l1_mean,mean_JSD_final,std_JSD_final,mean_JSD_mean,std_JSD_mean\n')
+            for k, (theta, shift) in enumerate(list_settings):
+                for alpha_scale in alpha_range:
+                    f.write("%f,%f,%f,%.3e,%.3e,%.3e,%.3e,%.3e,%.3e,%.3e,%.3e\n" % (theta, shift, alpha_scale, np.mean(l1_final[k]), np.std(l1_final[k]), np.mean(l1_mean[k]), np.std(l1_mean[k]), np.mean(JSD_final[k]), np.std(JSD_final[k]), np.mean(JSD_mean[k]), np.std(JSD_mean[k])))
+                    list_results.append( (theta, shift, alpha_scale, (np.mean(l1_final[k]), np.mean(l1_mean[k]), np.mean(JSD_final[k]), np.mean(JSD_mean[k]))) )
+
+        return list_results
+
+
+    def drift_report(self, theta=None, shift=None, alpha_scale=None, total_hours=16, num_samples=20, from_test=True, outfile=None):
+        """
+        Measures how far mean-action trajectories drift from stochastic rollouts,
+        from every start state of the test set (or train set if from_test is False).
+        Policy parameters default to the current ones
+
+        outfile - if not None, write the per-hour report as csv
+
+        Returns dict of arrays [total_hours], see rollout.drift_report
+        """
+        theta = self.theta if theta is None else theta
+        shift = self.shift if shift is None else shift
+        alpha_scale = self.alpha_scale if alpha_scale is None else alpha_scale
+        mat_pi0 = self.mat_pi0_test if from_test else self.mat_pi0
+        rng = self.streams.eval(self.eval_count)
+        self.eval_count += 1
+        report = rollout.drift_report(mat_pi0, theta, shift, alpha_scale, rng, total_hours, num_samples, self.sampler, self.sampler_threshold)
+        print("Drift of mean-action trajectory at last hour: mean L1 %.3e, max L1 %.3e, L1 to average rollout %.3e" % (report['l1_sample'][-1], report['l1_max'][-1], report['l1_bias'][-1]))
+        if outfile:
+            with open(outfile, 'w') as f:
+                f.write('hour,l1_sample,l1_max,l1_bias\n')
+                for hour in range(total_hours):
+                    f.write('%d,%.3e,%.3e,%.3e\n' % (hour, report['l1_sample'][hour], report['l1_max'][hour], report['l1_bias'][hour]))
+
+        return report
+
+
+    def visualize(self, theta=8.86349, d=21, topic=0, dir_train='train_normalized', train_start=1, train_end=26, dir_test='test_normalized', test_start=27, test_end=37, save_plot=0, outfile='plots/mfg_topic0_theta8p86_s0p5_alpha1e4_m5d9.pdf', deterministic=False):
         """
         Run MFG policy forward using initial distributions across both training and test set,
         and plot trajectory of topic against all measurement data.
+        deterministic - if True, plot mean-action trajectories
         """
         self.theta = theta
         self.d = d
@@ -1609,7 +2312,7 @@ class AC_IRL:
             pi0 = np.array(df_train.iloc[(num_day-1)*16])
 
             # Generate entire trajectory using policy
-            mat_trajectory = self.generate_trajectory(pi0, total_hours=16)
+            mat_trajectory = self.generate_trajectory(pi0, total_hours=16, deterministic=deterministic)
             df = pd.DataFrame(mat_trajectory)
             df.index = np.arange(idx, idx+16)
             list_df.append(df)
@@ -1625,7 +2328,7 @@ class AC_IRL:
             # Read initial distribution
             pi0 = np.array(df_test.iloc[(num_day-test_start)*16])
             # Generate entire trajectory using policy
-            mat_trajectory = self.generate_trajectory(pi0, total_hours=16)
+            mat_trajectory = self.generate_trajectory(pi0, total_hours=16, deterministic=deterministic)
             df = pd.DataFrame(mat_trajectory)
             df.index = np.arange(idx, idx+16) # use same idx that was incremented above
             list_df.append(df)
@@ -1660,12 +2363,14 @@ class AC_IRL:
         self.df_rnn = df
 
         
-    def visualize_test(self, lag=18, theta=8.64, d=15, topic=0, dir_train='train_normalized_round2', train_start=1, train_end=21, dir_test='test_normalized_round2', test_start=22, test_end=27, choice=2, path_to_rnn='rnn_normalized_round2/trajectories.txt', log_scale=0,  c1='g', c2='b', c3='m', save_plot=1, outfile='traj_mfg_var_0_8p06_0p16_12e3_13_m10d18.pdf'):
+    def calc_test_trajectories(self, lag=18, theta=8.64, d=15, dir_train='train_normalized_round2', train_start=1, train_end=21, dir_test='test_normalized_round2', test_start=22, test_end=27, path_to_rnn='rnn_normalized_round2/trajectories.txt', deterministic=False):
         """
-        Produce plot of trajectory of raw test data, 
-        MFG generated data, and time series prediction (from var.py)
+        Computes the trajectories plotted by visualize_test for all topics at once:
+        MFG trajectories from the test start states in self.df_test_generated,
+        RNN predictions in self.df_rnn
+        deterministic - if True, MFG trajectories use the mean action
 
-        choice - 0 (MFG and VAR), 1 (MFG and RNN), 2 (all three)
+        Returns test data and VAR forecast as DataFrames, one column per topic
         """
         self.theta = theta
         self.d = d
@@ -1681,7 +2386,7 @@ class AC_IRL:
             # Read initial distribution
             pi0 = np.array(df_test.iloc[(num_day-test_start)*16])
             # Generate entire trajectory using policy
-            mat_trajectory = self.generate_trajectory(pi0, total_hours=16)
+            mat_trajectory = self.generate_trajectory(pi0, total_hours=16, deterministic=deterministic)
             df = pd.DataFrame(mat_trajectory)
             df.index = np.arange(idx, idx+16)
             list_df.append(df)
@@ -1692,11 +2397,49 @@ class AC_IRL:
         # Train VAR and get forecast
         print("Running VAR to get forecast")
         self.var.train(lag, self.var.df_train)
-        df_future_var = self.var.forecast(num_prior=int(16*(train_end-train_start+1)), steps=int(16*(test_end-test_start+1)), topic=topic, plot=0, show_plot=0)
+        df_future_var = self.var.forecast(num_prior=int(16*(train_end-train_start+1)), steps=int(16*(test_end-test_start+1)), plot=0, show_plot=0)
 
         # Get RNN predictions
         self.read_rnn(path_to_rnn, (test_end-test_start+1))
 
+        return df_test, df_future_var
+
+
+    def visualize_test_batch(self, topics=None, lag=18, theta=8.64, d=15, dir_train='train_normalized_round2', train_start=1, train_end=21, dir_test='test_normalized_round2', test_start=22, test_end=27, choice=2, path_to_rnn='rnn_normalized_round2/trajectories.txt', log_scale=0,  c1='g', c2='b', c3='m', outfile='traj_mfg_var_topic%d.pdf', num_workers=None, deterministic=False):
+        """
+        Produces the figure of visualize_test for every topic in topics (None for all d topics).
+        Trajectories are computed once, then figures are rendered in parallel headless workers
+
+        outfile - filename pattern in plots_irl/ with %d for the topic
+        num_workers - number of rendering processes, None for one per CPU
+        deterministic - if True, MFG trajectories use the mean action
+
+        Returns list of written files
+        """
+        df_test, df_future_var = self.calc_test_trajectories(lag, theta, d, dir_train, train_start, train_end, dir_test, test_start, test_end, path_to_rnn, deterministic)
+        if topics is None:
+            topics = range(d)
+
+        array_x_test = np.arange(0, len(self.df_test_generated.index))/16.0
+        list_jobs = []
+        for topic in topics:
+            list_jobs.append( {'topic':topic, 'x':array_x_test, 'test':np.array(df_test[topic]), 'mfg':np.array(self.df_test_generated[topic]),
+                               'var':np.array(df_future_var[topic]), 'rnn':np.array(self.df_rnn[topic]), 'choice':choice, 'log_scale':log_scale,
+                               'c1':c1, 'c2':c2, 'c3':c3, 'num_days':test_end-test_start+1, 'outfile':'plots_irl/' + outfile % topic} )
+
+        return figures.render_all(list_jobs, num_workers)
+
+
+    def visualize_test(self, lag=18, theta=8.64, d=15, topic=0, dir_train='train_normalized_round2', train_start=1, train_end=21, dir_test='test_normalized_round2', test_start=22, test_end=27, choice=2, path_to_rnn='rnn_normalized_round2/trajectories.txt', log_scale=0,  c1='g', c2='b', c3='m', save_plot=1, outfile='traj_mfg_var_0_8p06_0p16_12e3_13_m10d18.pdf', deterministic=False):
+        """
+        Produce plot of trajectory of raw test data, 
+        MFG generated data, and time series prediction (from var.py)
+
+        choice - 0 (MFG and VAR), 1 (MFG and RNN), 2 (all three)
+        deterministic - if True, MFG trajectories use the mean action
+        """
+        df_test, df_future_var = self.calc_test_trajectories(lag, theta, d, dir_train, train_start, train_end, dir_test, test_start, test_end, path_to_rnn, deterministic)
+
         #array_x_test = np.arange(0, len(self.df_test_generated.index))
         array_x_test = np.arange(0, len(self.df_test_generated.index))/16.0
 
@@ -0,0 +1,53 @@
+"""
+Time per action of the exact and normal Dirichlet samplers, for single actions
+and for trajectories generated one at a time or in batches.
+
+Run as python bench_rollout.py. With shift=0 every parameter is above the
+threshold, with shift=0.5 some rows fall back to the exact sampler.
+"""
+
+import time
+
+import numpy as np
+
+import rng
+import rollout
+
+
+def best_time(fn, num_actions, num_repeats=5):
+    """
+    Returns the best over num_repeats of the time per action of fn() in us
+    """
+    list_times = []
+    for _ in range(num_repeats):
+        t_start = time.perf_counter()
+        fn()
+        list_times.append(1e6 * (time.perf_counter() - t_start) / num_actions)
+
+    return min(list_times)
+
+
+def main(d=15, theta=8.64, alpha_scale=1e4, num_samples=2000, num_traj=64, num_steps=15):
+    rng_data = np.random.default_rng(4)
+    pi = rng_data.dirichlet(np.ones(d))
+    mat_pi0 = rng_data.dirichlet(np.ones(d), size=100)
+    streams = rng.rng_manager(1234)
+    list_idx = range(num_traj)
+    num_actions = num_traj * num_steps
+
+    for shift in [0, 0.5]:
+        mat_alpha = rollout.calc_alpha(pi, theta, shift)
+        rng_action = np.random.default_rng(0)
+        results = {}
+        for sampler in ['exact', 'normal']:
+            results[('action', sampler)] = best_time(lambda: [rollout.sample_dirichlet(mat_alpha, alpha_scale, rng_action, sampler) for _ in range(num_samples)], num_samples)
+            results[('single', sampler)] = best_time(lambda: [rollout.generate_trajectory(idx, mat_pi0, theta, shift, alpha_scale, streams, num_steps, sampler) for idx in list_idx], num_actions)
+            results[('batch', sampler)] = best_time(lambda: rollout.generate_trajectories(list_idx, mat_pi0, theta, shift, alpha_scale, streams, num_steps, sampler), num_actions)
+        for mode in ['action', 'single', 'batch']:
+            t_exact = results[(mode, 'exact')]
+            t_normal = results[(mode, 'normal')]
+            print("shift %.1f %-6s: exact %6.1f us, normal %6.1f us per action, speedup %.2f" % (shift, mode, t_exact, t_normal, t_exact / t_normal))
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,201 @@
+"""
+Single indexed binary dataset of all days.
+
+A directory of trend_distribution_day%d.csv files (and optionally the matching
+action_day%d.txt files) is parsed once by build() into one file laid out as
+
+    MAGIC | uint64 header length | JSON header | padding | raw arrays
+
+The JSON header records the offset, shape and dtype of each array:
+states [days, hours, width], actions [days, hours-1, dim_action, dim_action]
+(NaN for days without recorded actions) and the day ID of each row.
+Rows are ordered by split, then by day ID, so every split and every range of
+days within a split is a contiguous slice. The reader memory-maps the arrays,
+so slices are returned without copying.
+"""
+
+import json
+import os
+import re
+import struct
+
+import numpy as np
+
+import preprocess
+
+
+MAGIC = b'MFGDS001'
+# arrays start at multiples of ALIGN bytes
+ALIGN = 64
+
+PATTERN_STATE = re.compile(r'trend_distribution_day(\d+)(_reordered)?\.csv$')
+
+
+def data_offset(header_len):
+    """
+    Returns position of the first array, the first multiple of ALIGN after the header
+    """
+    return -(-(len(MAGIC) + 8 + header_len) // ALIGN) * ALIGN
+
+
+def list_days(state_dir):
+    """
+    Returns sorted list of (day ID, filename) of the state files in state_dir
+    """
+    list_found = []
+    for filename in os.listdir(state_dir):
+        match = PATTERN_STATE.match(filename)
+        if match:
+            list_found.append( (int(match.group(1)), filename) )
+    list_found.sort()
+
+    return list_found
+
+
+def build(path_out, list_splits, dim_action=20, num_hours=16):
+    """
+    Parses day files into a single dataset file
+
+    path_out - output file
+    list_splits - list of (split name, state_dir, action_dir), action_dir may be None,
+    e.g. [('train', 'train_normalized_round2', 'actions_2'), ('test', 'test_normalized_round2', 'actions_test_2')]
+    dim_action - dimension of recorded action matrices
+    num_hours - number of states per day
+
+    Returns number of days written
+    """
+    list_states = []
+    list_actions = []
+    list_day_ids = []
+    splits = {}
+    for split, state_dir, action_dir in list_splits:
+        idx_start = len(list_day_ids)
+        for day, filename in list_days(state_dir):
+            states = preprocess.read_matrix(os.path.join(state_dir, filename))
+            list_states.append(states[0:num_hours])
+            path_action = os.path.join(action_dir, 'action_day%d.txt' % day) if action_dir else None
+            if path_action and os.path.isfile(path_action):
+                actions = preprocess.read_matrix(path_action)
+                list_actions.append(actions[0:(num_hours-1)*dim_action].reshape(num_hours-1, dim_action, dim_action))
+            else:
+                list_actions.append(np.full([num_hours-1, dim_action, dim_action], np.nan))
+            list_day_ids.append(day)
+        splits[split] = [idx_start, len(list_day_ids)]
+
+    # files may differ in number of columns, keep the smallest common width
+    width = min(states.shape[1] for states in list_states)
+    arrays = {
+        'states': np.array([states[:, 0:width] for states in list_states], dtype=np.float64),
+        'actions': np.array(list_actions, dtype=np.float64),
+        'days': np.array(list_day_ids, dtype=np.int64),
+    }
+
+    # lay out arrays after the header
+    header = {'splits': splits, 'arrays': {}}
+    offset = 0
+    for name in ['states', 'actions', 'days']:
+        header['arrays'][name] = {'offset': offset, 'shape': list(arrays[name].shape), 'dtype': arrays[name].dtype.str}
+        offset += -(-arrays[name].nbytes // ALIGN) * ALIGN
+    header_bytes = json.dumps(header).encode('utf-8')
+    data_start = data_offset(len(header_bytes))
+
+    path_tmp = path_out + '.tmp'
+    with open(path_tmp, 'wb') as f:
+        f.write(MAGIC)
+        f.write(struct.pack('<Q', len(header_bytes)))
+        f.write(header_bytes)
+        for name in ['states', 'actions', 'days']:
+            f.seek(data_start + header['arrays'][name]['offset'])
+            f.write(np.ascontiguousarray(arrays[name]).tobytes())
+    os.replace(path_tmp, path_out)
+
+    return len(list_day_ids)
+
+
+class dataset:
+
+    def __init__(self, path):
+        """
+        Opens a file written by build() and memory-maps its arrays
+        """
+        self.path = path
+        with open(path, 'rb') as f:
+            if f.read(len(MAGIC)) != MAGIC:
+                raise ValueError("%s is not a dataset file" % path)
+            header_len = struct.unpack('<Q', f.read(8))[0]
+            self.header = json.loads(f.read(header_len).decode('utf-8'))
+        data_start = data_offset(header_len)
+        self.splits = self.header['splits']
+        self.arrays = {}
+        for name, info in self.header['arrays'].items():
+            self.arrays[name] = np.memmap(path, dtype=np.dtype(info['dtype']), mode='r', offset=data_start + info['offset'], shape=tuple(info['shape']))
+
+    def rows(self, split=None, day_start=None, day_end=None):
+        """
+        Returns the rows in split (all splits if None) with
+        day_start <= day ID <= day_end (unbounded if None).
+        This is a slice, so that selecting with it does not copy, unless the
+        selected days of different splits are not adjacent, then an index array
+        """
+        if split is not None:
+            idx_start, idx_end = self.splits[split]
+            # day IDs are sorted within a split
+            days = self.arrays['days'][idx_start:idx_end]
+            if day_end is not None:
+                idx_end = idx_start + int(np.searchsorted(days, day_end, side='right'))
+            if day_start is not None:
+                idx_start += int(np.searchsorted(days, day_start, side='left'))
+            return slice(idx_start, max(idx_start, idx_end))
+
+        days = self.arrays['days']
+        mask = np.ones(len(days), dtype=bool)
+        if day_start is not None:
+            mask &= days >= day_start
+        if day_end is not None:
+            mask &= days <= day_end
+        indices = np.nonzero(mask)[0]
+        if len(indices) == 0:
+            return slice(0, 0)
+        if indices[-1] - indices[0] + 1 == len(indices):
+            return slice(int(indices[0]), int(indices[-1]) + 1)
+
+        return indices
+
+    def days(self, split=None, day_start=None, day_end=None):
+        """
+        Day IDs, [days]
+        """
+        return self.arrays['days'][self.rows(split, day_start, day_end)]
+
+    def states(self, split=None, day_start=None, day_end=None):
+        """
+        Read-only view of states, [days, hours, width]
+        """
+        return self.arrays['states'][self.rows(split, day_start, day_end)]
+
+    def actions(self, split=None, day_start=None, day_end=None):
+        """
+        Read-only view of actions, [days, hours-1, dim_action, dim_action]
+        """
+        return self.arrays['actions'][self.rows(split, day_start, day_end)]
+
+    def pi0(self, split=None, d=None):
+        """
+        Initial distribution of each day, [days, d]
+        """
+        return self.states(split)[:, 0, 0:d]
+
+
+# datasets opened so far, by path, so every consumer in a process shares one mapping
+_open_datasets = {}
+
+
+def open_dataset(path):
+    """
+    Returns the dataset at path, opening it on first use
+    """
+    path = os.path.abspath(path)
+    if path not in _open_datasets:
+        _open_datasets[path] = dataset(path)
+
+    return _open_datasets[path]
@@ -0,0 +1,181 @@
+"""
+Binned Gaussian kernel density estimation.
+
+scipy.stats.gaussian_kde evaluates every sample at every grid point, O(n x grid).
+Here samples are first spread onto a regular grid by linear binning, O(n), and
+the binned counts are convolved with the Gaussian kernel by FFT, O(M log M) for
+M grid points, then interpolated at the requested points. The bandwidth
+defaults to Scott's rule, as in gaussian_kde.
+
+The grid spans the central quantiles of the samples and the evaluation points,
+padded by 4 bandwidths, so that a few outliers do not make the grid spacing
+larger than the bandwidth. Samples outside the grid are further than 4
+bandwidths from every evaluation point and are left out of the binned counts,
+but still counted in the normalization, as their kernels are in gaussian_kde.
+
+streaming_histogram accumulates the same binned counts chunk by chunk, so the
+density of a large set of rewards can be estimated while they are computed,
+without keeping the rewards in memory. Given bin edges, it also counts values
+per bin exactly as np.histogram of the values clipped to the outer edges, so
+that no value is dropped and histograms of streamed and of in-memory rewards
+over the same edges can be compared, see clip_to_edges.
+"""
+
+import warnings
+
+import numpy as np
+
+
+def scott_bandwidth(n, std):
+    """
+    Scott's rule for 1D data, the default bandwidth of scipy.stats.gaussian_kde
+    """
+    return std * n ** (-0.2)
+
+
+def linear_binning(samples, lo, delta, num_points):
+    """
+    Spreads each sample over its two neighboring grid points lo + k*delta,
+    with weights proportional to proximity. Samples outside the grid are
+    not counted.
+
+    Returns counts of length num_points, summing to the number of samples inside the grid
+    """
+    pos = (samples - lo) / delta
+    pos = pos[(pos >= 0) & (pos <= num_points - 1)]
+    idx = np.minimum(np.floor(pos).astype(np.int64), num_points - 2)
+    weight = pos - idx
+    counts = np.bincount(idx, weights=1 - weight, minlength=num_points)
+    counts += np.bincount(idx + 1, weights=weight, minlength=num_points)
+
+    return counts
+
+
+def smooth_counts(counts, delta, bandwidth):
+    """
+    Convolves binned counts with a Gaussian kernel of the given bandwidth,
+    truncated at 4 bandwidths, using FFT
+
+    Returns density times number of samples at each grid point
+    """
+    num_points = len(counts)
+    # half-width of the kernel in grid points
+    L = int(min(np.ceil(4 * bandwidth / delta), num_points - 1))
+    kernel_x = np.arange(-L, L + 1) * delta
+    kernel = np.exp(-0.5 * (kernel_x / bandwidth)**2) / (bandwidth * np.sqrt(2 * np.pi))
+    # zero-pad to a power of 2 at least as long as the full linear convolution
+    size = 1 << int(np.ceil(np.log2(num_points + 2 * L + 1)))
+    result = np.fft.irfft(np.fft.rfft(counts, size) * np.fft.rfft(kernel, size), size)
+
+    return result[L:L + num_points]
+
+
+def binned_kde(samples, xs, bandwidth=None, num_points=1024, quantile=0.001):
+    """
+    Gaussian kernel density estimate of samples, evaluated at xs
+
+    samples - array of any shape, flattened
+    xs - evaluation points
+    bandwidth - kernel standard deviation, None for Scott's rule
+    num_points - size of the binning grid
+    quantile - the grid covers the samples between this quantile and 1 - quantile
+    """
+    samples = np.asarray(samples, dtype=np.float64).ravel()
+    xs = np.asarray(xs, dtype=np.float64)
+    n = len(samples)
+    if bandwidth is None:
+        bandwidth = scott_bandwidth(n, np.std(samples, ddof=1)) if n > 1 else 0
+    q_lo, q_hi = np.quantile(samples, [quantile, 1 - quantile])
+    lo = min(q_lo, xs.min())
+    hi = max(q_hi, xs.max())
+    if bandwidth <= 0:
+        # all samples equal, use a kernel one grid step wide
+        bandwidth = max(hi - lo, 1.0) / (num_points - 1)
+    # extend the grid so that the kernel tails are not cut off
+    lo -= 4 * bandwidth
+    hi += 4 * bandwidth
+    delta = (hi - lo) / (num_points - 1)
+    if bandwidth < delta:
+        warnings.warn("Bandwidth %.3e is below the grid spacing %.3e, the density is oversmoothed, increase num_points" % (bandwidth, delta))
+    # the kernel must span at least one grid step to integrate to 1
+    bandwidth = max(bandwidth, delta)
+    grid = lo + delta * np.arange(num_points)
+    density = smooth_counts(linear_binning(samples, lo, delta, num_points), delta, bandwidth) / n
+
+    return np.interp(xs, grid, density)
+
+
+def clip_to_edges(values, edges):
+    """
+    Clips values to [edges[0], edges[-1]], so that a histogram over edges
+    counts the tails in its first and last bin instead of dropping them
+    """
+    return np.clip(values, edges[0], edges[-1])
+
+
+class streaming_histogram:
+
+    def __init__(self, lo, hi, num_points=1024, edges=None):
+        """
+        Accumulates linearly binned counts of values on a fixed grid over [lo, hi].
+        Values outside [lo, hi] are left out of the density and counted in num_outside.
+
+        edges - if not None, also count values in the bins with these edges, values
+        below edges[0] or above edges[-1] in the first or last bin, see histogram()
+        """
+        self.lo = lo
+        self.hi = hi
+        self.num_points = num_points
+        self.delta = (hi - lo) / float(num_points - 1)
+        self.grid = lo + self.delta * np.arange(num_points)
+        self.counts = np.zeros(num_points)
+        self.num_outside = 0
+        self.edges = edges
+        if edges is not None:
+            self.bin_counts = np.zeros(len(edges) - 1)
+        # running moments for the bandwidth
+        self.n = 0
+        self.mean = 0.0
+        self.M2 = 0.0
+
+    def add(self, values):
+        """
+        Accumulates an array of values of any shape
+        """
+        values = np.asarray(values, dtype=np.float64).ravel()
+        if len(values) == 0:
+            return
+        self.counts += linear_binning(values, self.lo, self.delta, self.num_points)
+        self.num_outside += int(np.sum((values < self.lo) | (values > self.hi)))
+        if self.edges is not None:
+            self.bin_counts += np.histogram(clip_to_edges(values, self.edges), self.edges)[0]
+        # combine moments of the chunk with the running moments (Chan et al.)
+        n_chunk = len(values)
+        mean_chunk = np.mean(values)
+        n_total = self.n + n_chunk
+        diff = mean_chunk - self.mean
+        self.M2 += np.sum((values - mean_chunk)**2) + diff**2 * self.n * n_chunk / n_total
+        self.mean += diff * n_chunk / n_total
+        self.n = n_total
+
+    def std(self):
+        return np.sqrt(self.M2 / (self.n - 1)) if self.n > 1 else 0.0
+
+    def density(self, xs, bandwidth=None):
+        """
+        Gaussian kernel density estimate of all values added so far, evaluated at xs
+        bandwidth - None for Scott's rule
+        """
+        if bandwidth is None:
+            bandwidth = scott_bandwidth(self.n, self.std())
+        bandwidth = max(bandwidth, self.delta)
+        density = smooth_counts(self.counts, self.delta, bandwidth) / self.n
+
+        return np.interp(xs, self.grid, density)
+
+    def histogram(self):
+        """
+        Returns counts of values in the bins of edges, equal to np.histogram
+        of clip_to_edges of all values added so far, for comparing distributions
+        """
+        return self.bin_counts
@@ -0,0 +1,79 @@
+"""
+Headless rendering of trajectory figures in parallel worker processes.
+
+The trajectories are computed once by the caller; each job only carries the
+curves of one topic. Figures are drawn on a matplotlib Figure with an Agg
+canvas instead of through pyplot, so rendering needs no display and does not
+touch the pyplot backend of the calling process.
+"""
+
+import multiprocessing
+import os
+
+import numpy as np
+
+from matplotlib.figure import Figure
+from matplotlib.backends.backend_agg import FigureCanvasAgg
+
+
+def render_topic(topic, x, test, mfg, var=None, rnn=None, choice=2, log_scale=0, c1='g', c2='b', c3='m', num_days=6, outfile='plots_irl/traj.pdf'):
+    """
+    Renders the figure of visualize_test for one topic to outfile
+
+    x - time axis in days
+    test, mfg, var, rnn - popularity of the topic in test data and predictions
+    choice - 0 (MFG and VAR), 1 (MFG and RNN), 2 (all three)
+
+    Returns outfile
+    """
+    fig = Figure()
+    FigureCanvasAgg(fig)
+    ax = fig.add_subplot(111)
+    for item in ([ax.title, ax.xaxis.label, ax.yaxis.label] + ax.get_xticklabels() + ax.get_yticklabels()):
+        item.set_fontsize(14)
+
+    if choice == 0:
+        ax.plot(x, test, color='k', linestyle='-', label='test data')
+        ax.plot(x, mfg, color=c1, linestyle='--', label='MFG (test)')
+        ax.plot(x, var, color=c2, linestyle='--', label="VAR (test)")
+    elif choice == 1:
+        ax.plot(x, test, color='k', linestyle='-', label='test data')
+        ax.plot(x, mfg, color='g', linestyle='--', label='MFG (test)')
+        ax.plot(x, rnn, color='m', linestyle='-.', label='RNN (test)')
+        if log_scale:
+            ax.set_yscale('log')
+    elif choice == 2:
+        ax.plot(x, test, color='k', linestyle='-', label='test data')
+        ax.plot(x, mfg, color=c1, linestyle='--', label='MFG (test)')
+        ax.plot(x, var, color=c2, linestyle='--', label="VAR (test)")
+        ax.plot(x, rnn, color=c3, linestyle='--', label='RNN (test)')
+    ax.set_ylabel('Topic %d popularity' % topic)
+    ax.set_xlabel('Day')
+    ax.set_xticks(np.arange(0, num_days+1, 1))
+    ax.legend(loc='best', prop={'size':14})
+    ax.set_title("Topic %d measurement and predictions" % topic)
+
+    fig.savefig(outfile, format='pdf')
+
+    return outfile
+
+
+def render_all(list_jobs, num_workers=None):
+    """
+    Renders every job, a dict of keyword arguments of render_topic,
+    in a pool of num_workers processes (None for one per CPU)
+
+    Returns list of written files
+    """
+    for job in list_jobs:
+        dir_out = os.path.dirname(job['outfile'])
+        if dir_out and not os.path.isdir(dir_out):
+            os.makedirs(dir_out)
+    if num_workers == 1 or len(list_jobs) <= 1:
+        return [render_topic(**job) for job in list_jobs]
+    with multiprocessing.Pool(num_workers) as pool:
+        return pool.map(render_job, list_jobs)
+
+
+def render_job(job):
+    return render_topic(**job)
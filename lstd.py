@@ -0,0 +1,76 @@
+"""
+Least-squares temporal difference (LSTD) solver for the linear critic
+V(pi; w) = varphi(pi) dot w used by the actor-critic solvers.
+"""
+
+import numpy as np
+
+
+class lstd_solver:
+
+    def __init__(self, num_features, reg=1e-3, decay=1.0, recursive=False):
+        """
+        num_features - length of the feature vector varphi(pi)
+        reg - ridge regularization added to A before solving
+        decay - factor applied to the accumulated statistics after each solve,
+        1 keeps all past transitions, 0 makes every batch independent
+        (in recursive mode only 0 < decay <= 1 is supported)
+        recursive - if True, maintain A^{-1} with Sherman-Morrison updates so that
+        w can be read off after every transition in O(num_features^2)
+        """
+        if recursive and not 0 < decay <= 1:
+            raise ValueError("recursive LSTD requires 0 < decay <= 1, got %g" % decay)
+        self.num_features = num_features
+        self.reg = reg
+        self.decay = decay
+        self.recursive = recursive
+        self.reset()
+
+    def reset(self):
+        # A = sum phi (phi - gamma phi')^T
+        self.A = np.zeros([self.num_features, self.num_features])
+        # b = sum phi r
+        self.b = np.zeros([self.num_features, 1])
+        if self.recursive:
+            # inverse of (reg * I + A)
+            self.A_inv = np.eye(self.num_features) / self.reg
+        # number of transitions added since the last solve
+        self.num_added = 0
+
+    def add(self, features, features_next, reward, gamma):
+        """
+        Accumulates one transition
+
+        features - varphi(pi) as a row vector
+        features_next - varphi(pi_next) as a row vector
+        reward - scalar reward of the transition
+        gamma - discount applied to V(pi_next)
+        """
+        u = features.reshape(self.num_features, 1)
+        v = u - gamma * features_next.reshape(self.num_features, 1)
+        self.b += u * reward
+        if self.recursive:
+            # (A + u v^T)^{-1} = A^{-1} - A^{-1} u v^T A^{-1} / (1 + v^T A^{-1} u)
+            A_inv_u = self.A_inv.dot(u)
+            v_A_inv = v.T.dot(self.A_inv)
+            self.A_inv -= A_inv_u.dot(v_A_inv) / (1 + v_A_inv.dot(u))
+        else:
+            self.A += u.dot(v.T)
+        self.num_added += 1
+
+    def solve(self):
+        """
+        Returns critic weights w as a column vector, then decays the statistics
+        """
+        if self.recursive:
+            w = self.A_inv.dot(self.b)
+            if 0 < self.decay < 1:
+                # decays the regularizer along with A
+                self.A_inv /= self.decay
+        else:
+            w = np.linalg.solve(self.A + self.reg * np.eye(self.num_features), self.b)
+            self.A *= self.decay
+        self.b *= self.decay
+        self.num_added = 0
+
+        return w
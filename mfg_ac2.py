@@ -18,11 +18,15 @@ import itertools
 import time
 import warnings
 
+import lstd
+import preprocess
+import dataset
+
 warnings.filterwarnings('error')
 
 class actor_critic:
 
-    def __init__(self, theta=8.86349, shift=0.16, alpha_scale=12000, d=21):
+    def __init__(self, theta=8.86349, shift=0.16, alpha_scale=12000, d=21, dataset_file=None):
 
         # initialize theta
         self.theta = theta
@@ -36,7 +40,7 @@ class actor_critic:
         self.d = d
 
         # initialize collection of start states
-        self.init_pi0(path_to_dir=os.getcwd()+'/train_normalized_round2')
+        self.init_pi0(path_to_dir=os.getcwd()+'/train_normalized_round2', dataset_file=dataset_file)
         self.num_start_samples = self.mat_pi0.shape[0] # number of rows
 
         # d x d x dim_theta tensor, computed within sample_action and used for
@@ -50,7 +54,7 @@ class actor_critic:
         self.mat_alpha_deriv = np.zeros([self.d, self.d])
 
         if (platform.system() == "Windows"):
-            self.var = var.var(d=d)
+            self.var = var.var(d=d, cache_dir='var_cache')
 
 # ------------------- File processing functions ------------------ #
 
@@ -60,99 +64,37 @@ class actor_critic:
         Given a list of rows (each is a pi^n), order all rows by decreasing popularity
         based on the first row.
         """
-        row1 = list_rows[0]
-        # create mapping from index to value
-        list_pairs = []
-        for i in range(len(row1)):
-            list_pairs.append( (i, row1[i]) )
-
-        # sort by decreasing popularity
-        list_pairs.sort(reverse=True, key=lambda x: x[1])
-
-        # extract ordering
-        order = []
-        for pair in list_pairs:
-            order.append( pair[0] )
-        
-        # apply ordering to all rows in list_rows
-        for i in range(len(list_rows)):
-            list_rows[i] = [ list_rows[i][j] for j in order ]
-
-        return list_rows
+        return preprocess.reorder_rows(np.array(list_rows)).tolist()
 
     
-    def reorder_files(self, indir='train', outdir='train_reordered'):
+    def reorder_files(self, indir='train', outdir='train_reordered', num_workers=None, force=False):
         """
-        Process all files in given directory, creates new files
+        Process all files in given directory, creates new files.
+        Days are processed in parallel by num_workers processes (None for one per CPU),
+        files whose output is up to date are skipped unless force is True
         """
         path_to_dir = os.getcwd() + '/' + indir
         path_to_outdir = os.getcwd() + '/' + outdir
-
-        for filename in os.listdir(path_to_dir):
-            path_to_file = path_to_dir + '/' + filename
-            f = open(path_to_file, 'r')
-            f.readline() # skip the header line of topics
-            list_lines = f.readlines()
-            f.close()
-            # strip away newline, convert csv format to list of entries,
-            # remove the last empty entry (due to extra comma)
-            list_lines = list(map(lambda x: x.strip().split(',')[:-1], list_lines))
-            # convert to int
-            for i in range(len(list_lines)):
-                list_lines[i] = list(map(int, list_lines[i]))
-            # reorder
-            list_rows = self.reorder(list_lines)
-            # write to new file
-            index_dot = filename.index('.')
-            filename_new = filename[:index_dot] + '_reordered' + filename[index_dot:]
-            f = open(path_to_outdir + '/' + filename_new, 'w')
-            for row in list_rows:
-                s = ','.join(map(str, row))
-                s += '\n'
-                f.write(s)
-            f.close()
+        preprocess.reorder_files(path_to_dir, path_to_outdir, num_workers, force)
 
 
-    def normalize(self, indir='train_round2', outdir='train_normalized_round2', header=True):
+    def normalize(self, indir='train_round2', outdir='train_normalized_round2', header=True, num_workers=None, force=False):
         """
         Reads files from indir, normalize all rows of data, and writes to outdir.
         If header = True, then skips the first line
         """
         path_to_dir = os.getcwd() + '/' + indir
         path_to_outdir = os.getcwd() + '/' + outdir
-        for filename in os.listdir(path_to_dir):
-            path_to_file = path_to_dir + '/' + filename
-            with open(path_to_file, 'r') as f:
-                if header:
-                    # skip over first line
-                    f.readline()
-                # read everything else into a matrix
-                matrix = np.loadtxt(f, delimiter=',')
-            num_rows = matrix.shape[0]
-            # normalize
-            matrix = matrix / np.sum(matrix, axis=1, keepdims=True)
-            # write to space-separated file in outdir with same filename
-            path_to_outfile = path_to_outdir + '/' + filename
-            with open(path_to_outfile, 'wb') as f:
-                np.savetxt(f, matrix, fmt='%.3e', delimiter=' ')
-
-
-    def get_max_nonzero(self, indir):
+        preprocess.normalize(path_to_dir, path_to_outdir, header, num_workers, force)
+
+
+    def get_max_nonzero(self, indir, num_workers=None):
         """
         Scan through the training files in indir and find the maximum
         number of nonzero entries in the initial distribution
         """
-        max_nnz = 0
-        file_with_max = ''
         path_to_dir = os.getcwd() + '/' + indir
-        for filename in os.listdir(path_to_dir):
-            path_to_file = path_to_dir + '/' + filename
-            with open(path_to_file, 'r') as f:
-                matrix = np.loadtxt(f, delimiter=',')
-            nnz = np.count_nonzero(matrix[0])
-            if ( nnz > max_nnz ):
-                max_nnz = nnz
-                file_with_max = filename
+        max_nnz, file_with_max = preprocess.get_max_nonzero(path_to_dir, num_workers)
         print("Max nnz:", max_nnz)
         print("File with max nnz:", file_with_max)
 
@@ -176,14 +118,20 @@ class actor_critic:
         return np.random.rand(num_features, 1)
 
 
-    def init_pi0(self, path_to_dir, verbose=0):
+    def init_pi0(self, path_to_dir, verbose=0, dataset_file=None):
         """
         Generates the collection of initial population distributions.
         This collection will be sampled to get the start state for each training episode
         Assumes that each file in directory has rows of the format:
         pi^0_1, ... , pi^0_d
         where d is a fixed constant across all files
+
+        dataset_file - if not None, take the train split of this dataset instead of path_to_dir
         """
+        if dataset_file:
+            self.mat_pi0 = np.array(dataset.open_dataset(dataset_file).pi0('train', self.d))
+            return
+
         # will be list of lists
         list_pi0 = []
         num_files = len(os.listdir(path_to_dir))
@@ -445,7 +393,7 @@ class actor_critic:
         f.close()
     
 
-    def train(self, num_episodes=4000, gamma=1, constant=0, lr_critic=0.1, lr_actor=0.001, consecutive=100, file_theta='results/theta.csv', file_pi='results/pi.csv', file_reward='results/reward.csv', write_file=0, write_all=0):
+    def train(self, num_episodes=4000, gamma=1, constant=0, lr_critic=0.1, lr_actor=0.001, consecutive=100, file_theta='results/theta.csv', file_pi='results/pi.csv', file_reward='results/reward.csv', write_file=0, write_all=0, critic='sgd', lstd_batch=15, lstd_reg=1e-3, lstd_decay=1.0, lstd_recursive=False):
         """
         Input:
         1. num_episodes - each episode is 16 steps (9am to 12midnight)
@@ -453,9 +401,15 @@ class actor_critic:
         3. lr_critic - learning rate for value function parameter update
         4. lr_actor - learning rate for policy parameter update
         5. consecutive - number of consecutive episodes for each reporting of average reward
+        6. critic - 'sgd' for per-step TD updates of w, 'lstd' to solve for w by least-squares TD
+        7. lstd_batch - number of transitions between LSTD solves
+        8. lstd_reg, lstd_decay, lstd_recursive - see lstd.lstd_solver
 
         Main actor-critic training procedure that improves theta and w
         """
+        if critic == 'lstd':
+            solver = lstd.lstd_solver(len(self.w), reg=lstd_reg, decay=lstd_decay, recursive=lstd_recursive)
+
         list_reward = []
         for episode in range(num_episodes):
             # print("Episode", episode)
@@ -508,7 +462,12 @@ class actor_critic:
                 # w <- w + alpha * TD error * feature vector
                 # still a column vector
                 length = len(vec_features)
-                if constant == 1:
+                if critic == 'lstd':
+                    # accumulate A and b, re-solve for w once per batch
+                    solver.add(vec_features, vec_features_next, reward, gamma)
+                    if solver.num_added == lstd_batch:
+                        self.w = solver.solve()
+                elif constant == 1:
                     self.w = self.w + lr_critic * delta * vec_features.reshape(length,1)
                 else:
                     self.w = self.w + (lr_critic/(episode+1)) * delta * vec_features.reshape(length,1) #here
@@ -592,13 +551,14 @@ class actor_critic:
         return mat_trajectory
 
 
-    def evaluate(self, theta=8.86349, shift=0.5, alpha_scale=1e4, d=21, episode_length=16, indir='test_normalized_round2', outfile='eval_mfg_round2/test_eval_fixed_reward.csv', write_header=0):
+    def evaluate(self, theta=8.86349, shift=0.5, alpha_scale=1e4, d=21, episode_length=16, indir='test_normalized_round2', outfile='eval_mfg_round2/test_eval_fixed_reward.csv', write_header=0, dataset_file=None, split='test'):
         """
         Main evaluation function
 
         Argument:
         theta - value to use for the fixed policy
         indir - directory containing the test dataset
+        dataset_file - if not None, evaluate on split of this dataset instead of indir
 
         """
         # Fix policy by setting parameter
@@ -607,8 +567,14 @@ class actor_critic:
         self.alpha_scale = alpha_scale
         self.d = d
         
-        path_to_dir = os.getcwd() + '/' + indir
-        num_test_trajectories = len(os.listdir(path_to_dir))
+        if dataset_file:
+            # [days, hours, d] view of the dataset
+            tensor_empirical = dataset.open_dataset(dataset_file).states(split)[:, :, 0:self.d]
+            num_test_trajectories = tensor_empirical.shape[0]
+        else:
+            path_to_dir = os.getcwd() + '/' + indir
+            list_files = os.listdir(path_to_dir)
+            num_test_trajectories = len(list_files)
         array_l1_final = np.zeros(num_test_trajectories)
         array_l1_mean = np.zeros(num_test_trajectories)
         array_JSD_final = np.zeros(num_test_trajectories)
@@ -616,12 +582,14 @@ class actor_critic:
         
         idx = 0
         # For each file in test_normalized
-        for filename in os.listdir(path_to_dir):
-            path_to_file = path_to_dir + '/' + filename
-
-            with open(path_to_file, 'r') as f:
-                mat_empirical = np.loadtxt(f, delimiter=' ')
-                mat_empirical = mat_empirical[:, 0:self.d]
+        for idx_day in range(num_test_trajectories):
+            if dataset_file:
+                mat_empirical = np.array(tensor_empirical[idx_day])
+            else:
+                path_to_file = path_to_dir + '/' + list_files[idx_day]
+                with open(path_to_file, 'r') as f:
+                    mat_empirical = np.loadtxt(f, delimiter=' ')
+                    mat_empirical = mat_empirical[:, 0:self.d]
 
             # Read initial distribution pi0
             pi0 = mat_empirical[0]
@@ -16,14 +16,23 @@ if (platform.system() == "Windows"):
 
 import os
 import itertools
+import multiprocessing
 import time
 import warnings
 
+import lstd
+import preprocess
+import rng
+import shared_data
+
 warnings.filterwarnings('error')
 
 class actor_critic:
 
-    def __init__(self, theta=10, shift=0, alpha_scale=100, d=21):
+    def __init__(self, theta=10, shift=0, alpha_scale=100, d=21, mat_pi0=None):
+        """
+        mat_pi0 - preloaded matrix of start states, if None then train() reads them from train_normalized
+        """
 
         # initialize theta
         self.theta = theta
@@ -46,6 +55,8 @@ class actor_critic:
 
         self.mat_alpha_deriv = np.zeros([self.d, self.d])
 
+        self.mat_pi0 = mat_pi0
+
         if (platform.system() == "Windows"):
             self.var = var.var(d=d)
 
@@ -57,92 +68,36 @@ class actor_critic:
         Given a list of rows (each is a pi^n), order all rows by decreasing popularity
         based on the first row.
         """
-        row1 = list_rows[0]
-        # create mapping from index to value
-        list_pairs = []
-        for i in range(len(row1)):
-            list_pairs.append( (i, row1[i]) )
-
-        # sort by decreasing popularity
-        list_pairs.sort(reverse=True, key=lambda x: x[1])
-
-        # extract ordering
-        order = []
-        for pair in list_pairs:
-            order.append( pair[0] )
-        
-        # apply ordering to all rows in list_rows
-        for i in range(len(list_rows)):
-            list_rows[i] = [ list_rows[i][j] for j in order ]
-
-        return list_rows
+        return preprocess.reorder_rows(np.array(list_rows)).tolist()
 
     
-    def reorder_files(self, indir='train', outdir='train_reordered'):
+    def reorder_files(self, indir='train', outdir='train_reordered', num_workers=None, force=False):
         """
-        Process all files in given directory, creates new files
+        Process all files in given directory, creates new files.
+        Days are processed in parallel by num_workers processes (None for one per CPU),
+        files whose output is up to date are skipped unless force is True
         """
         path_to_dir = os.getcwd() + '/' + indir
         path_to_outdir = os.getcwd() + '/' + outdir
-
-        for filename in os.listdir(path_to_dir):
-            path_to_file = path_to_dir + '/' + filename
-            f = open(path_to_file, 'r')
-            f.readline() # skip the header line of topics
-            list_lines = f.readlines()
-            f.close()
-            # strip away newline, convert csv format to list of entries,
-            # remove the last empty entry (due to extra comma)
-            list_lines = list(map(lambda x: x.strip().split(',')[:-1], list_lines))
-            # convert to int
-            for i in range(len(list_lines)):
-                list_lines[i] = list(map(int, list_lines[i]))
-            # reorder
-            list_rows = self.reorder(list_lines)
-            # write to new file
-            index_dot = filename.index('.')
-            filename_new = filename[:index_dot] + '_reordered' + filename[index_dot:]
-            f = open(path_to_outdir + '/' + filename_new, 'w')
-            for row in list_rows:
-                s = ','.join(map(str, row))
-                s += '\n'
-                f.write(s)
-            f.close()
+        preprocess.reorder_files(path_to_dir, path_to_outdir, num_workers, force)
 
 
-    def normalize(self, indir='train_reordered', outdir='train_normalized'):
+    def normalize(self, indir='train_reordered', outdir='train_normalized', num_workers=None, force=False):
         """
         Normalize all rows of data
         """
         path_to_dir = os.getcwd() + '/' + indir
         path_to_outdir = os.getcwd() + '/' + outdir
-        for filename in os.listdir(path_to_dir):
-            path_to_file = path_to_dir + '/' + filename
-            with open(path_to_file, 'r') as f:
-                matrix = np.loadtxt(f, delimiter=',')
-            num_rows = matrix.shape[0]
-            matrix = matrix / np.sum(matrix, axis=1).reshape(num_rows,1)
-            path_to_outfile = path_to_outdir + '/' + filename
-            with open(path_to_outfile, 'wb') as f:
-                np.savetxt(f, matrix, fmt='%.3e')
+        preprocess.normalize(path_to_dir, path_to_outdir, False, num_workers, force)
 
 
-    def get_max_nonzero(self, indir):
+    def get_max_nonzero(self, indir, num_workers=None):
         """
         Scan through the training files in indir and find the maximum
         number of nonzero entries in the initial distribution
         """
-        max_nnz = 0
-        file_with_max = ''
         path_to_dir = os.getcwd() + '/' + indir
-        for filename in os.listdir(path_to_dir):
-            path_to_file = path_to_dir + '/' + filename
-            with open(path_to_file, 'r') as f:
-                matrix = np.loadtxt(f, delimiter=',')
-            nnz = np.count_nonzero(matrix[0])
-            if ( nnz > max_nnz ):
-                max_nnz = nnz
-                file_with_max = filename
+        max_nnz, file_with_max = preprocess.get_max_nonzero(path_to_dir, num_workers)
         print("Max nnz:", max_nnz)
         print("File with max nnz:", file_with_max)
 
@@ -423,7 +378,7 @@ class actor_critic:
         f.close()
     
 
-    def train(self, num_episodes=4000, gamma=1, constant=0, lr_critic=0.1, lr_actor=0.001, consecutive=100, file_theta='results_syn/theta.csv', file_pi='results_syn/pi.csv', file_reward='results_syn/reward.csv', file_w='results_syn/w.csv', write_file=0, write_all=0):
+    def train(self, num_episodes=4000, gamma=1, constant=0, lr_critic=0.1, lr_actor=0.001, consecutive=100, file_theta='results_syn/theta.csv', file_pi='results_syn/pi.csv', file_reward='results_syn/reward.csv', file_w='results_syn/w.csv', write_file=0, write_all=0, critic='sgd', lstd_batch=15, lstd_reg=1e-3, lstd_decay=1.0, lstd_recursive=False, episode_offset=0):
         """
         Input:
         1. num_episodes - each episode is 16 steps (9am to 12midnight)
@@ -431,16 +386,27 @@ class actor_critic:
         3. lr_critic - learning rate for value function parameter update
         4. lr_actor - learning rate for policy parameter update
         5. consecutive - number of consecutive episodes for each reporting of average reward
+        6. critic - 'sgd' for per-step TD updates of w, 'lstd' to solve for w by least-squares TD
+        7. lstd_batch - number of transitions between LSTD solves
+        8. lstd_reg, lstd_decay, lstd_recursive - see lstd.lstd_solver
+        9. episode_offset - number of episodes already trained, so that decaying learning rates
+        continue from there when training is resumed in segments
 
         Main actor-critic training procedure that improves theta and w
+        Returns average episode return over all episodes of this call
         """
 
-        # initialize collection of start states
-        self.init_pi0(path_to_dir=os.getcwd()+'/train_normalized')
+        # initialize collection of start states, unless preloaded
+        if self.mat_pi0 is None:
+            self.init_pi0(path_to_dir=os.getcwd()+'/train_normalized')
         self.num_start_samples = self.mat_pi0.shape[0] # number of rows
 
+        if critic == 'lstd':
+            solver = lstd.lstd_solver(len(self.w), reg=lstd_reg, decay=lstd_decay, recursive=lstd_recursive)
+
         list_reward = []
-        for episode in range(num_episodes):
+        sum_return = 0
+        for episode in range(episode_offset, episode_offset+num_episodes):
             # print("Episode", episode)
             if write_all:
                 with open('temp.csv', 'a') as f:
@@ -489,7 +455,12 @@ class actor_critic:
                 # w <- w + alpha * delta * varphi(pi)
                 # still a column vector
                 length = len(vec_features)
-                if constant == 1:
+                if critic == 'lstd':
+                    # accumulate A and b, re-solve for w once per batch
+                    solver.add(vec_features, vec_features_next, reward, gamma)
+                    if solver.num_added == lstd_batch:
+                        self.w = solver.solve()
+                elif constant == 1:
                     self.w = self.w + lr_critic * delta * vec_features.reshape(length,1)
                 else:
                     self.w = self.w + (lr_critic/(episode+1)) * delta * vec_features.reshape(length,1)
@@ -508,6 +479,7 @@ class actor_critic:
                 total_reward += reward
 
             list_reward.append(total_reward)
+            sum_return += total_reward
 
             if (episode % consecutive == 0):
                 print("Theta\n", self.theta)
@@ -521,6 +493,8 @@ class actor_critic:
                     self.train_log(np.array([reward_avg]), file_reward, "%.3e")
                     self.train_log(self.w, file_w, "%.5e")
 
+        return float(sum_return) / max(num_episodes, 1)
+
 
 # ---------------- End training code ---------------- #
 
@@ -899,27 +873,106 @@ class actor_critic:
         return diff_mean, diff_std    
 
 
+# start states shared by all points of a sweep, set in each worker by init_sweep_worker
+_sweep_pi0 = None
+
+
+def init_sweep_worker(handle):
+    """
+    Pool initializer, attaches to the start states published by sweep()
+    """
+    global _sweep_pi0
+    _sweep_pi0 = shared_data.attach(handle)['mat_pi0']
+
+
+def sweep_point(shift, theta_initial, seed, num_episodes=1000, alpha_scale=10000, d=21, day_first=1, day_last=26):
+    """
+    Task: trains from theta_initial with the given shift and evaluates the result
+
+    Returns dict with the row of synthetic.csv; on failure, status names the
+    stage that failed ('train' or 'evaluate'), error holds the exception,
+    and the values that were not computed are NaN
+    """
+    np.random.seed(seed)
+    result = {'shift':shift, 'theta_initial':theta_initial, 'theta_final':np.nan, 'diff_mean':np.nan, 'diff_std':np.nan, 'status':'ok', 'error':''}
+    ac = actor_critic(theta=theta_initial, shift=shift, alpha_scale=alpha_scale, d=d, mat_pi0=_sweep_pi0)
+    try:
+        ac.train(num_episodes=num_episodes, gamma=1, constant=1, lr_critic=0.1, lr_actor=0.001, consecutive=100, write_file=0)
+    except Exception as e:
+        result['status'] = 'train'
+        result['error'] = '%s: %s' % (type(e).__name__, e)
+        return result
+    result['theta_final'] = ac.theta
+    try:
+        result['diff_mean'], result['diff_std'] = ac.evaluate_synthetic_JSD(day_first=day_first, day_last=day_last)
+    except Exception as e:
+        result['status'] = 'evaluate'
+        result['error'] = '%s: %s' % (type(e).__name__, e)
+
+    return result
+
+
+def sweep_done(outfile):
+    """
+    Returns set of (shift, theta_initial) keys, formatted as in outfile, already recorded in outfile
+    """
+    set_done = set()
+    if os.path.isfile(outfile):
+        with open(outfile, 'r') as f:
+            f.readline()
+            for line in f:
+                fields = line.strip().split(',')
+                if len(fields) >= 2:
+                    set_done.add( (fields[0], fields[1]) )
+
+    return set_done
+
+
+def sweep(list_shift, list_theta, num_episodes=1000, alpha_scale=10000, d=21, day_first=1, day_last=26, indir='train_normalized', outfile='synthetic.csv', num_workers=None, seed=None):
+    """
+    Runs sweep_point for every (shift, theta_initial) in a pool of num_workers
+    processes (None for one per CPU). Start states are read once and shared with
+    the workers through shared memory. Each result is appended to outfile as soon as it finishes,
+    points already in outfile are skipped, so an interrupted sweep resumes
+    where it stopped. Failed points are recorded with their status and error,
+    delete their rows to retry them.
+
+    seed - root seed of rng.rng_manager, point idx is seeded from stream (WORKER, idx)
+
+    Returns number of failed points in this run
+    """
+    loader = actor_critic(d=d)
+    loader.init_pi0(path_to_dir=os.getcwd() + '/' + indir)
+
+    streams = rng.rng_manager(seed)
+    set_done = sweep_done(outfile)
+    list_args = []
+    for idx, (shift, theta_initial) in enumerate(itertools.product(list_shift, list_theta)):
+        if ("%.3f" % shift, "%.3f" % theta_initial) in set_done:
+            continue
+        point_seed = int(streams.worker(idx).integers(2**32))
+        list_args.append( (float(shift), float(theta_initial), point_seed, num_episodes, alpha_scale, d, day_first, day_last) )
+    print("Sweep: %d points done, %d to run" % (len(set_done), len(list_args)))
+
+    if not os.path.isfile(outfile):
+        with open(outfile, 'w') as f:
+            f.write("Shift,theta_initial,theta_final,diff_mean,diff_std,status,error\n")
+    num_failed = 0
+    with shared_data.shared_arrays({'mat_pi0':loader.mat_pi0}) as shared, multiprocessing.Pool(num_workers, initializer=init_sweep_worker, initargs=(shared.handle,)) as pool:
+        for result in pool.imap_unordered(sweep_point_args, list_args):
+            if result['status'] != 'ok':
+                num_failed += 1
+                print("Shift %.3f theta_initial %.3f failed in %s: %s" % (result['shift'], result['theta_initial'], result['status'], result['error']))
+            with open(outfile, 'a') as f:
+                f.write("%.3f,%.3f,%.3f,%.3f,%.3f,%s,%s\n" % (result['shift'], result['theta_initial'], result['theta_final'], result['diff_mean'], result['diff_std'], result['status'], result['error'].replace(',', ';').replace('\n', ' ')))
+
+    return num_failed
+
+
+def sweep_point_args(args):
+    return sweep_point(*args)
+
+
 if __name__ == "__main__":
     # Try to find a good theta (current best is 2.6)
-    with open("synthetic.csv", 'a') as f:
-        f.write("Shift,theta_initial,theta_final,diff_mean,diff_std\n")
-    
-    for shift in np.arange(0, 0.04, 0.02):
-        for theta_initial in np.arange(0, 5.0, 0.05):
-            print("Theta initial", theta_initial)
-            print("Shift", shift)
-            ac = actor_critic(theta=theta_initial, shift=shift, alpha_scale=10000, d=21)
-        #ac = actor_critic(theta=theta, shift=0, alpha_scale=10000, d=21)
-            try:
-                ac.train(num_episodes=1000, gamma=1, constant=1, lr_critic=0.1, lr_actor=0.001, consecutive=100, write_file=0)
-            except:
-                pass
-            print("Theta final is", ac.theta)
-        #ac.init_pi0('train_normalized')
-            try:
-                diff_mean, diff_std = ac.evaluate_synthetic_JSD(day_first=1, day_last=26)
-            except:
-                diff_mean = 900
-                diff_std = 900
-            with open("synthetic.csv", 'a') as f:
-                f.write("%.3f,%.3f,%.3f,%.3f,%.3f\n" % (shift, theta_initial, ac.theta, diff_mean, diff_std))
+    sweep(list_shift=np.arange(0, 0.04, 0.02), list_theta=np.arange(0, 5.0, 0.05), num_episodes=1000, alpha_scale=10000, d=21, day_first=1, day_last=26)
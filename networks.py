@@ -155,3 +155,160 @@ def r_net_dropout(state_input, action_input, f1=1, k1=5, f2=2, k2=3, n_fc3=8, n_
     out = tf.contrib.layers.fully_connected(inputs=dropout4, num_outputs=1, activation_fn=tf.nn.tanh, scope='out')
 
     return out
+
+
+def r_net_rows(state_input, action_input, n_row1=16, n_row2=16, n_fc3=8, n_fc4=4, d=15, regularizer=None, keep_prob=1.0):
+    """
+    Permutation-aware network that processes the rows of P with shared weights,
+    so the number of parameters does not depend on d and cost grows as d^2 * n_row1
+
+    Each entry (i,j) is described by (P_ij, pi_j, pi_i) and mapped to n_row1 features
+    by a 1x1 convolution shared by all entries. Features are pooled over destinations j
+    to describe row i, mapped again by shared weights together with pi_i, and pooled
+    over rows, both uniformly and weighted by pi_i.
+
+    state_input - batch of states, assumed to be [batch_size, d]
+    action_input - batch of transition matrices, assumed to be [batch_size, d, d]
+    n_row1 - number of features of each entry
+    n_row2 - number of features of each row
+    regularizer - weights regularizer of all layers, e.g. tf.contrib.layers.l1_l2_regularizer()
+    keep_prob - keep probability of dropout after fc3 and fc4, 1.0 for no dropout
+    d - number of topics
+    """
+    action_input = tf.reshape(action_input, [-1,d,d])
+    state_input = tf.reshape(state_input, [-1,d])
+    # pi_j along columns and pi_i along rows, each [batch_size, d, d]
+    pi_col = tf.tile(tf.reshape(state_input, [-1,1,d]), [1,d,1])
+    pi_row = tf.tile(tf.reshape(state_input, [-1,d,1]), [1,1,d])
+    # [batch_size, d, d, 3]
+    entries = tf.stack([action_input, pi_col, pi_row], axis=3)
+    # shared map of each entry, [batch_size, d, d, n_row1]
+    conv1 = tf.contrib.layers.conv2d(inputs=entries, num_outputs=n_row1, kernel_size=1, stride=1, padding="SAME", activation_fn=tf.nn.relu, weights_regularizer=regularizer, scope='conv1')
+    # pool over destinations j, weighted by P_ij and uniformly, [batch_size, d, 2*n_row1]
+    row_weighted = tf.reduce_sum(conv1 * tf.expand_dims(action_input, 3), axis=2)
+    row_mean = tf.reduce_mean(conv1, axis=2)
+    rows = tf.concat([row_weighted, row_mean, tf.expand_dims(state_input, 2)], 2)
+    # shared map of each row, [batch_size, d, 1, n_row2]
+    conv2 = tf.contrib.layers.conv2d(inputs=tf.expand_dims(rows, 2), num_outputs=n_row2, kernel_size=1, stride=1, padding="SAME", activation_fn=tf.nn.relu, weights_regularizer=regularizer, scope='conv2')
+    conv2 = tf.reshape(conv2, [-1, d, n_row2])
+    # pool over rows weighted by population and uniformly, [batch_size, 2*n_row2]
+    pooled = tf.concat([tf.reduce_sum(conv2 * tf.expand_dims(state_input, 2), axis=1), tf.reduce_mean(conv2, axis=1)], 1)
+    fc3 = tf.contrib.layers.fully_connected(inputs=pooled, num_outputs=n_fc3, activation_fn=tf.nn.relu, weights_regularizer=regularizer, scope='fc3')
+    if keep_prob < 1.0:
+        fc3 = tf.contrib.layers.dropout(fc3, keep_prob=keep_prob, scope='dropout3')
+    fc4 = tf.contrib.layers.fully_connected(inputs=fc3, num_outputs=n_fc4, activation_fn=tf.nn.relu, weights_regularizer=regularizer, scope='fc4')
+    if keep_prob < 1.0:
+        fc4 = tf.contrib.layers.dropout(fc4, keep_prob=keep_prob, scope='dropout4')
+    # final output layer
+    out = tf.contrib.layers.fully_connected(inputs=fc4, num_outputs=1, activation_fn=tf.nn.tanh, scope='out')
+
+    return out
+
+
+def member_initializer(fan_in, fan_out):
+    """
+    Initializer with the distribution of xavier_initializer for one layer with
+    the given fans. xavier_initializer computes the fans from the variable shape,
+    which for variables holding the layers of all ensemble members includes the
+    member axis, so members would start sqrt(K) times smaller than a single network
+    """
+    limit = (6.0 / (fan_in + fan_out)) ** 0.5
+
+    return tf.random_uniform_initializer(-limit, limit)
+
+
+def ensemble_dense(inputs, num_outputs, activation_fn, regularizer, scope):
+    """
+    K independent fully connected layers applied by one batched matmul
+
+    inputs - [K, batch_size, n_in]
+    Returns [K, batch_size, num_outputs]
+    """
+    K = inputs.get_shape()[0].value
+    n_in = inputs.get_shape()[2].value
+    with tf.variable_scope(scope):
+        weights = tf.get_variable('weights', shape=[K, n_in, num_outputs], initializer=member_initializer(n_in, num_outputs), regularizer=regularizer)
+        biases = tf.get_variable('biases', shape=[K, 1, num_outputs], initializer=tf.zeros_initializer())
+        h = tf.matmul(inputs, weights) + biases
+
+    return activation_fn(h) if activation_fn else h
+
+
+def r_net_ensemble(state_input, action_input, K=4, f1=1, k1=5, f2=2, k2=3, n_fc3=8, n_fc4=4, d=15, regularizer=None, keep_prob=1.0):
+    """
+    K copies of the r_net architecture with separate parameters, stacked along a
+    leading parameter axis and evaluated together.
+    conv1 of all members is one convolution with K*f1 filters, conv2 is a grouped
+    convolution (each member sees only its own f1 channels) done as a depthwise
+    convolution followed by a sum over each member's channels, and the fully
+    connected layers are batched matmuls over the member axis.
+
+    state_input - batch of states, assumed to be [batch_size, d]
+    action_input - batch of transition matrices, assumed to be [batch_size, d, d]
+    K - number of members
+    regularizer - weights regularizer of the fully connected layers
+    keep_prob - keep probability of dropout after fc3 and fc4, 1.0 for no dropout
+    d - number of topics
+
+    Returns rewards of every member, [K, batch_size, 1]
+    """
+    action_input = tf.reshape(action_input, [-1,d,d,1])
+    state_input = tf.reshape(state_input, [-1,d])
+    # first convolutional layer, f1 filters for each member, [batch_size, d, d, K*f1]
+    conv1 = tf.contrib.layers.conv2d(inputs=action_input, num_outputs=K*f1, kernel_size=k1, stride=1, padding="SAME", activation_fn=tf.nn.relu, weights_initializer=member_initializer(k1*k1, k1*k1*f1), scope='conv1')
+    # second convolutional layer, grouped by member
+    with tf.variable_scope('conv2'):
+        weights = tf.get_variable('weights', shape=[k2, k2, K*f1, f2], initializer=member_initializer(k2*k2*f1, k2*k2*f2))
+        biases = tf.get_variable('biases', shape=[K*f2], initializer=tf.zeros_initializer())
+        # [batch_size, d, d, K*f1*f2], channel c*f2 + m is filter m applied to input channel c
+        depthwise = tf.nn.depthwise_conv2d(conv1, weights, strides=[1,1,1,1], padding="SAME")
+        # sum over the f1 input channels of each member, [batch_size, d, d, K, f2]
+        conv2 = tf.reduce_sum(tf.reshape(depthwise, [-1, d, d, K, f1, f2]), axis=4)
+        conv2 = tf.nn.relu(conv2 + tf.reshape(biases, [K, f2]))
+    # flatten per member, [K, batch_size, d*d*f2]
+    conv2_flat = tf.reshape(tf.transpose(conv2, [3, 0, 1, 2, 4]), [K, -1, d*d*f2])
+    fc3 = ensemble_dense(conv2_flat, n_fc3, tf.nn.relu, regularizer, scope='fc3')
+    if keep_prob < 1.0:
+        fc3 = tf.contrib.layers.dropout(fc3, keep_prob=keep_prob, scope='dropout3')
+    # for each member, concatenate conved action with state
+    fc3_action = tf.concat([fc3, tf.tile(tf.expand_dims(state_input, 0), [K, 1, 1])], 2)
+    fc4 = ensemble_dense(fc3_action, n_fc4, tf.nn.relu, regularizer, scope='fc4')
+    if keep_prob < 1.0:
+        fc4 = tf.contrib.layers.dropout(fc4, keep_prob=keep_prob, scope='dropout4')
+    out = ensemble_dense(fc4, 1, tf.nn.tanh, None, scope='out')
+
+    return out
+
+
+def reward_net(state_input, action_input, reg='none', arch='conv', ensemble_size=1, n_fc3=8, n_fc4=4, d=15):
+    """
+    Reward network of AC_IRL selected by reg, arch and ensemble_size
+
+    reg - 'none', 'dropout', 'l1l2', 'dropout_l1l2'
+    arch - 'conv' (r_net*) or 'rows' (r_net_rows)
+    ensemble_size - if > 1, r_net_ensemble with this many members
+
+    Returns [batch_size, 1], or [ensemble_size, batch_size, 1] for an ensemble
+    """
+    regularizer = tf.contrib.layers.l1_l2_regularizer() if reg in ['l1l2', 'dropout_l1l2'] else None
+    keep_prob = 0.4 if reg in ['dropout', 'dropout_l1l2'] else 1.0
+    if ensemble_size > 1:
+        if arch != 'conv':
+            raise ValueError("Ensembles are only available for arch='conv'")
+        return r_net_ensemble(state_input, action_input, K=ensemble_size, f1=1, k1=5, f2=2, k2=3, n_fc3=n_fc3, n_fc4=n_fc4, d=d, regularizer=regularizer, keep_prob=keep_prob)
+
+    if arch == 'rows':
+        return r_net_rows(state_input, action_input, n_fc3=n_fc3, n_fc4=n_fc4, d=d, regularizer=regularizer, keep_prob=keep_prob)
+
+    if reg == 'none':
+        net = r_net
+    elif reg == 'dropout':
+        net = r_net_dropout
+    elif reg == 'l1l2':
+        net = r_net_l1l2
+    elif reg == 'dropout_l1l2':
+        net = r_net_dropout_l1l2
+    else:
+        raise ValueError("Unknown reg %s" % reg)
+
+    return net(state_input, action_input, f1=1, k1=5, f2=2, k2=3, n_fc3=n_fc3, n_fc4=n_fc4, d=d)
@@ -0,0 +1,180 @@
+"""
+Population-based training of the forward solver of mfg_synthetic.
+
+A population of actor_critic solvers with different initial theta and
+learning rates is trained concurrently, in segments of num_episodes episodes.
+After each segment every member is scored, then the worst members (exploit)
+copy theta and the value function weights of a randomly chosen top member
+and (explore) multiply each of its learning rates by a random factor.
+Training of the copied parameters continues from the episode count of the
+top member, so decaying learning rates keep decaying.
+
+Scores are lower-is-better: the mean JSD of evaluate_synthetic_JSD, or the
+negative average episode return of the last segment.
+
+Each segment of a member is a module-level task run in a multiprocessing pool
+and seeded from rng.rng_manager by (round, member), so a run is reproducible
+for a given seed regardless of the number of worker processes. Start states
+are read once and shared with the workers through shared_data.
+
+mfg_synthetic turns all warnings into errors when it is imported, which is how
+diverging members are detected. It is imported inside the functions, under
+warnings.catch_warnings in run(), so that importing this module or calling run()
+leaves the warning filters of the calling process unchanged.
+"""
+
+import multiprocessing
+import os
+import warnings
+
+import numpy as np
+
+import rng
+import shared_data
+
+
+# start states shared by all members, set in each worker by init_worker
+_pbt_pi0 = None
+
+
+def init_worker(handle):
+    """
+    Pool initializer, attaches to the start states published by run()
+    """
+    global _pbt_pi0
+    # forked workers inherit the filters that run() restored after importing mfg_synthetic
+    warnings.filterwarnings('error')
+    _pbt_pi0 = shared_data.attach(handle)['mat_pi0']
+
+
+def sample_population(size, rng_init, theta_range=(0.0, 5.0), lr_critic_range=(0.01, 1.0), lr_actor_range=(1e-4, 1e-2), shift=0, alpha_scale=10000, d=21):
+    """
+    Returns list of member states with theta uniform in theta_range and
+    learning rates log-uniform in their ranges
+    """
+    list_members = []
+    for idx in range(size):
+        theta = float(rng_init.uniform(*theta_range))
+        lr_critic = float(np.exp(rng_init.uniform(*np.log(lr_critic_range))))
+        lr_actor = float(np.exp(rng_init.uniform(*np.log(lr_actor_range))))
+        list_members.append( {'id':idx, 'parent':-1, 'theta_initial':theta, 'theta':theta, 'w':None,
+                              'lr_critic':lr_critic, 'lr_actor':lr_actor,
+                              'shift':shift, 'alpha_scale':alpha_scale, 'd':d,
+                              'episodes':0, 'score':None} )
+
+    return list_members
+
+
+def train_member(member, num_episodes, seed, criterion='jsd', constant=1, day_first=1, day_last=26):
+    """
+    Task: trains one member for num_episodes episodes and scores it
+
+    Returns updated member state
+    """
+    import mfg_synthetic
+    np.random.seed(seed)
+    ac = mfg_synthetic.actor_critic(theta=member['theta'], shift=member['shift'], alpha_scale=member['alpha_scale'], d=member['d'], mat_pi0=_pbt_pi0)
+    if member['w'] is not None:
+        ac.w = np.array(member['w'])
+    member = dict(member)
+    try:
+        avg_return = ac.train(num_episodes=num_episodes, gamma=1, constant=constant, lr_critic=member['lr_critic'], lr_actor=member['lr_actor'], consecutive=num_episodes, write_file=0, episode_offset=member['episodes'])
+        if criterion == 'jsd':
+            score, _ = ac.evaluate_synthetic_JSD(day_first=day_first, day_last=day_last)
+        elif criterion == 'return':
+            score = -avg_return
+        else:
+            raise ValueError("Unknown criterion %s" % criterion)
+        if not np.isfinite(score):
+            score = np.inf
+    except (Warning, FloatingPointError, ValueError, np.linalg.LinAlgError) as e:
+        # diverged, rank last so that the member is replaced
+        print("Member %d failed: %s" % (member['id'], e))
+        score = np.inf
+    member['theta'] = float(ac.theta)
+    member['w'] = ac.w
+    member['episodes'] += num_episodes
+    member['score'] = float(score)
+
+    return member
+
+
+def exploit_explore(list_members, rng_round, fraction=0.25, perturb=(0.8, 1.25)):
+    """
+    Replaces the worst fraction of members by copies of random members of the
+    best fraction, with each learning rate multiplied by a random factor in perturb.
+    Replaced members keep their id and record the id of the copied member in parent
+
+    Returns new list of members, in the same order
+    """
+    num_replace = max(1, int(len(list_members) * fraction))
+    ranked = sorted(list_members, key=lambda m: m['score'])
+    top = ranked[:num_replace]
+    bottom_ids = set(m['id'] for m in ranked[-num_replace:])
+    list_new = []
+    for member in list_members:
+        if member['id'] in bottom_ids and member['score'] > top[-1]['score']:
+            source = top[rng_round.integers(len(top))]
+            member = dict(source, id=member['id'], parent=source['id'])
+            member['w'] = np.array(source['w'])
+            member['lr_critic'] = source['lr_critic'] * float(rng_round.choice(perturb))
+            member['lr_actor'] = source['lr_actor'] * float(rng_round.choice(perturb))
+        else:
+            member = dict(member, parent=-1)
+        list_new.append(member)
+
+    return list_new
+
+
+def log_round(outfile, idx_round, list_members):
+    """
+    Appends one line per member to outfile
+    """
+    write_header = not os.path.isfile(outfile)
+    with open(outfile, 'a') as f:
+        if write_header:
+            f.write("round,member,parent,episodes,theta_initial,theta,lr_critic,lr_actor,score\n")
+        for m in list_members:
+            f.write("%d,%d,%d,%d,%.3f,%.5f,%.5e,%.5e,%.5e\n" % (idx_round, m['id'], m['parent'], m['episodes'], m['theta_initial'], m['theta'], m['lr_critic'], m['lr_actor'], m['score']))
+
+
+def run(size=16, num_rounds=10, num_episodes=100, criterion='jsd', fraction=0.25, shift=0, alpha_scale=10000, d=21, theta_range=(0.0, 5.0), lr_critic_range=(0.01, 1.0), lr_actor_range=(1e-4, 1e-2), constant=1, day_first=1, day_last=26, indir='train_normalized', seed=None, num_workers=None, outfile='pbt.csv'):
+    """
+    Population-based training of mfg_synthetic.actor_critic
+
+    size - number of members
+    num_rounds - number of train/exploit/explore rounds
+    num_episodes - number of episodes each member trains per round
+    criterion - 'jsd' for evaluate_synthetic_JSD, 'return' for average episode return
+    fraction - fraction of the population replaced each round
+    constant - passed to actor_critic.train, 1 for constant learning rates
+    indir - directory of start states
+    seed - root seed of rng.rng_manager, None for fresh entropy
+    num_workers - number of processes, None for one per CPU
+    outfile - csv log of every member in every round
+
+    Returns best member after the last round
+    """
+    with warnings.catch_warnings():
+        import mfg_synthetic
+    loader = mfg_synthetic.actor_critic(d=d)
+    loader.init_pi0(path_to_dir=os.getcwd() + '/' + indir)
+
+    streams = rng.rng_manager(seed)
+    list_members = sample_population(size, streams.init(), theta_range, lr_critic_range, lr_actor_range, shift, alpha_scale, d)
+    with shared_data.shared_arrays({'mat_pi0':loader.mat_pi0}) as shared, multiprocessing.Pool(num_workers, initializer=init_worker, initargs=(shared.handle,)) as pool:
+        for idx_round in range(num_rounds):
+            list_args = [(member, num_episodes, int(streams.stream(rng.WORKER, idx_round, member['id']).integers(2**32)), criterion, constant, day_first, day_last) for member in list_members]
+            list_members = pool.starmap(train_member, list_args)
+            log_round(outfile, idx_round, list_members)
+            best = min(list_members, key=lambda m: m['score'])
+            print("Round %d best member %d theta %f score %f" % (idx_round, best['id'], best['theta'], best['score']))
+            if idx_round < num_rounds - 1:
+                list_members = exploit_explore(list_members, streams.stream(rng.WORKER, idx_round), fraction)
+
+    return best
+
+
+if __name__ == "__main__":
+    best = run()
+    print("Best member", best['id'], "theta_initial", best['theta_initial'], "theta", best['theta'], "lr_critic", best['lr_critic'], "lr_actor", best['lr_actor'], "score", best['score'])
@@ -0,0 +1,160 @@
+"""
+Pipelined trajectory generation for the IRL outer loop.
+
+Rollout worker processes keep generating trajectories from the most recently
+published policy into a bounded queue, while the main process trains the
+reward network and solves the forward problem. Each sample is tagged with the
+policy version that produced it, and collect() drops samples that lag the
+current version by more than max_staleness. A worker that fails puts an
+error record on the queue, which collect() raises in the main process.
+"""
+
+import multiprocessing
+import queue
+import traceback
+
+import numpy as np
+
+import rng
+import rollout
+import shared_data
+
+
+# first element of the queue record of a failed worker, followed by the traceback
+ERROR = 'error'
+
+
+def rollout_worker(handle, seed, shift, alpha_scale, policy, index_counter, out_queue, stop_event, sampler='exact', threshold=rollout.NORMAL_THRESHOLD, batch_size=8):
+    """
+    Loop run by each worker process
+
+    handle - shared_data handle of the matrix of start states
+    seed - root seed shared with the coordinator, so trajectory idx is the same in every process
+    policy - shared array [version, theta]
+    index_counter - shared counter that hands out trajectory indices
+    out_queue - bounded queue of (idx_traj, version, states, actions), or (ERROR, traceback) if the worker fails
+    stop_event - set by the coordinator to end the loop
+    sampler, threshold - see rollout.sample_dirichlet
+    batch_size - number of consecutive indices generated together by rollout.generate_trajectories
+    """
+    try:
+        mat_pi0 = shared_data.attach(handle)['mat_pi0']
+        streams = rng.rng_manager(seed)
+        while not stop_event.is_set():
+            with policy.get_lock():
+                version = int(policy[0])
+                theta = policy[1]
+            with index_counter.get_lock():
+                idx_start = index_counter.value
+                index_counter.value += batch_size
+            list_idx = range(idx_start, idx_start + batch_size)
+            list_trajectories = rollout.generate_trajectories(list_idx, mat_pi0, theta, shift, alpha_scale, streams, sampler=sampler, threshold=threshold)
+            for idx_traj, trajectory in zip(list_idx, list_trajectories):
+                states = np.array([pair[0] for pair in trajectory])
+                actions = np.array([pair[1] for pair in trajectory])
+                put(out_queue, (idx_traj, version, states, actions), stop_event)
+    except Exception:
+        put(out_queue, (ERROR, traceback.format_exc()), stop_event)
+
+
+def put(out_queue, item, stop_event):
+    """
+    Puts item on the bounded out_queue, giving up when stop_event is set
+    """
+    while not stop_event.is_set():
+        try:
+            out_queue.put(item, timeout=0.1)
+            return
+        except queue.Full:
+            continue
+
+
+class rollout_pipeline:
+
+    def __init__(self, mat_pi0, seed, theta, shift, alpha_scale, start_index=0, num_workers=2, queue_size=20, max_staleness=1, sampler='exact', threshold=rollout.NORMAL_THRESHOLD, batch_size=8):
+        """
+        mat_pi0 - matrix of start states
+        seed - entropy of the coordinator's rng.rng_manager
+        theta - initial policy, published as version 0
+        start_index - first trajectory index handed out to workers
+        num_workers - number of rollout processes
+        queue_size - maximum number of finished trajectories waiting in the queue
+        max_staleness - maximum number of policy versions a collected sample may lag behind
+        sampler, threshold - see rollout.sample_dirichlet
+        batch_size - number of trajectories each worker generates per policy read
+        """
+        self.max_staleness = max_staleness
+        self.version = 0
+        self.policy = multiprocessing.Array('d', [0, theta])
+        self.index_counter = multiprocessing.Value('q', start_index)
+        self.out_queue = multiprocessing.Queue(maxsize=queue_size)
+        self.stop_event = multiprocessing.Event()
+        self.num_discarded = 0
+        # start states are shared with the workers, not copied
+        self.shared = shared_data.shared_arrays({'mat_pi0':mat_pi0})
+        self.workers = []
+        for idx in range(num_workers):
+            p = multiprocessing.Process(target=rollout_worker, args=(self.shared.handle, seed, shift, alpha_scale, self.policy, self.index_counter, self.out_queue, self.stop_event, sampler, threshold, batch_size))
+            p.daemon = True
+            self.workers.append(p)
+
+    def start(self):
+        for p in self.workers:
+            p.start()
+
+    def publish(self, theta):
+        """
+        Makes theta the policy for all trajectories started from now on
+        """
+        self.version += 1
+        with self.policy.get_lock():
+            self.policy[0] = self.version
+            self.policy[1] = theta
+
+    def collect(self, n):
+        """
+        Returns n trajectories, each a list of (state, action) pairs,
+        generated by policy versions at most max_staleness behind the current one.
+        Trajectories are ordered by index.
+
+        Raises RuntimeError if a worker failed, or if no worker is alive
+        """
+        list_collected = []
+        while len(list_collected) < n:
+            try:
+                item = self.out_queue.get(timeout=1.0)
+            except queue.Empty:
+                if not any(p.is_alive() for p in self.workers):
+                    raise RuntimeError("No rollout worker is alive, exit codes %s" % [p.exitcode for p in self.workers])
+                continue
+            if item[0] == ERROR:
+                raise RuntimeError("Rollout worker failed:\n%s" % item[1])
+            idx_traj, version, states, actions = item
+            if self.version - version > self.max_staleness:
+                self.num_discarded += 1
+                continue
+            list_collected.append( (idx_traj, list(zip(states, actions))) )
+        list_collected.sort(key=lambda x: x[0])
+
+        return [traj for _, traj in list_collected]
+
+    def next_index(self):
+        """
+        Returns the first trajectory index not yet handed out
+        """
+        with self.index_counter.get_lock():
+            return self.index_counter.value
+
+    def stop(self):
+        self.stop_event.set()
+        # drain the queue so that workers blocked on put can exit
+        try:
+            while True:
+                self.out_queue.get_nowait()
+        except queue.Empty:
+            pass
+        for p in self.workers:
+            p.join(timeout=5)
+            if p.is_alive():
+                p.terminate()
+        self.shared.close()
@@ -0,0 +1,64 @@
+"""
+Finite population simulator for validating mean-field rollouts.
+
+Instead of moving N agents one by one, the agents in topic i at hour n are
+split among destination topics with one multinomial draw with probabilities
+P^n_i. The cost per hour is O(d^2) regardless of the number of agents, so tens
+of millions of agents are as cheap as ten.
+"""
+
+import numpy as np
+
+
+def init_counts(pi0, num_agents, rng, num_replicates=1):
+    """
+    Draws the number of agents in each topic at the first hour
+
+    pi0 - initial population distribution
+    num_agents - total number of agents N
+    num_replicates - number of independent populations
+
+    Returns int64 array [num_replicates, d]
+    """
+    pvals = pi0 / np.sum(pi0)
+
+    return rng.multinomial(num_agents, pvals, size=num_replicates)
+
+
+def step_counts(counts, P, rng):
+    """
+    Moves every agent once
+
+    counts - agents per topic, [num_replicates, d]
+    P - transition matrix, row i is the distribution of destinations of agents in topic i
+
+    Returns agents per topic at the next hour, [num_replicates, d]
+    """
+    # moved[r, i, j] = number of agents of replicate r moving from topic i to topic j
+    moved = rng.multinomial(counts, P)
+
+    return np.sum(moved, axis=1)
+
+
+def simulate(pi0, list_P, num_agents, rng, num_replicates=1):
+    """
+    Runs finite populations through a fixed sequence of actions
+
+    pi0 - initial population distribution
+    list_P - transition matrices, one per hour
+    num_agents - number of agents in each population
+
+    Returns
+    tensor_counts - [num_replicates, len(list_P)+1, d] agents per topic at every hour
+    tensor_empirical - same shape, empirical distributions
+    """
+    d = len(pi0)
+    tensor_counts = np.zeros([num_replicates, len(list_P)+1, d], dtype=np.int64)
+    counts = init_counts(pi0, num_agents, rng, num_replicates)
+    tensor_counts[:, 0] = counts
+    for hour, P in enumerate(list_P):
+        counts = step_counts(counts, P, rng)
+        tensor_counts[:, hour+1] = counts
+    tensor_empirical = tensor_counts / float(num_agents)
+
+    return tensor_counts, tensor_empirical
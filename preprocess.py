@@ -0,0 +1,216 @@
+"""
+Parallel preprocessing of raw day files.
+
+Each day file is handled by a module-level task function, so that days can be
+processed by a multiprocessing pool. Outputs are written to a temporary file
+and moved into place with os.replace, so an interrupted run never leaves a
+partial output, and files whose output is newer than the input are skipped
+unless force=True.
+"""
+
+import multiprocessing
+import os
+
+import numpy as np
+
+
+def read_matrix(path_to_file, header=False):
+    """
+    Reads a comma-separated file of numbers into a matrix, in one vectorized parse.
+    A trailing comma at the end of each line is allowed.
+
+    header - if True, skip the first line
+    """
+    with open(path_to_file, 'r') as f:
+        if header:
+            f.readline()
+        list_lines = [line for line in f.read().splitlines() if line.strip()]
+    values = np.fromstring(' '.join(list_lines).replace(',', ' '), sep=' ')
+
+    return values.reshape(len(list_lines), -1)
+
+
+def read_first_row(path_to_file):
+    """
+    Reads only the first line of a comma-separated file
+    """
+    with open(path_to_file, 'r') as f:
+        line = f.readline()
+
+    return np.fromstring(line.replace(',', ' '), sep=' ')
+
+
+def write_matrix(path_to_file, matrix, fmt, delimiter):
+    """
+    Writes matrix with np.savetxt to a temporary file in the same directory,
+    then atomically replaces path_to_file
+    """
+    path_tmp = path_to_file + '.tmp'
+    with open(path_tmp, 'wb') as f:
+        np.savetxt(f, matrix, fmt=fmt, delimiter=delimiter)
+    os.replace(path_tmp, path_to_file)
+
+
+def up_to_date(path_in, path_out):
+    """
+    Returns True if path_out exists and is not older than path_in
+    """
+    return os.path.isfile(path_out) and os.path.getmtime(path_out) >= os.path.getmtime(path_in)
+
+
+def reorder_rows(matrix):
+    """
+    Orders the columns of all rows by decreasing popularity in the first row.
+    Ties keep their original order.
+    """
+    order = np.argsort(-matrix[0], kind='stable')
+
+    return matrix[:, order]
+
+
+def normalize_rows(matrix):
+    """
+    Divides each row by its sum
+    """
+    return matrix / np.sum(matrix, axis=1, keepdims=True)
+
+
+def reorder_file(path_in, path_out, force=False):
+    """
+    Task: reorders one raw count file (header line, trailing commas) into path_out.
+    Returns True if the file was written, False if skipped
+    """
+    if not force and up_to_date(path_in, path_out):
+        return False
+    matrix = read_matrix(path_in, header=True).astype(np.int64)
+    write_matrix(path_out, reorder_rows(matrix), fmt='%d', delimiter=',')
+
+    return True
+
+
+def normalize_file(path_in, path_out, header=False, force=False):
+    """
+    Task: normalizes all rows of one comma-separated file into a space-separated path_out.
+    Returns True if the file was written, False if skipped
+    """
+    if not force and up_to_date(path_in, path_out):
+        return False
+    matrix = read_matrix(path_in, header=header)
+    write_matrix(path_out, normalize_rows(matrix), fmt='%.3e', delimiter=' ')
+
+    return True
+
+
+def count_nonzero_file(path_in):
+    """
+    Task: number of nonzero entries in the initial distribution of one file
+    """
+    return np.count_nonzero(read_first_row(path_in))
+
+
+def clean_actions(states, actions, d, dim_action, num_hours=15):
+    """
+    Vectorized cleanup of one day of recorded actions.
+    If row i of an action is all zeros except a single 1 on the diagonal while
+    state i is zero, the 1 was added artificially during recording, so the row
+    is replaced by a uniform row 1/d over all dim_action entries.
+
+    states - [num_hours+1, >= d] states of the day
+    actions - [num_hours*dim_action, dim_action] stacked action matrices
+
+    Returns cleaned copy of actions
+    """
+    blocks = actions[:num_hours*dim_action].reshape(num_hours, dim_action, dim_action).copy()
+    idx = np.arange(d)
+    mask = (blocks[:, idx, idx] == 1.0) & (states[:num_hours, :d] == 0)
+    # view of the first d rows of every hour, so the masked assignment writes into blocks
+    rows = blocks[:, :d, :]
+    rows[mask] = 1.0 / d
+
+    return blocks.reshape(num_hours*dim_action, dim_action)
+
+
+def format_actions(actions, dim_action):
+    """
+    Formats stacked action matrices as text, one row per line with entries
+    in %.3e and a blank line after each matrix
+    """
+    fmt_row = ' '.join(['%.3e'] * actions.shape[1])
+    list_blocks = []
+    for idx_start in range(0, actions.shape[0], dim_action):
+        list_blocks.append( '\n'.join([fmt_row % tuple(row) for row in actions[idx_start:idx_start+dim_action]]) + '\n\n' )
+
+    return ''.join(list_blocks)
+
+
+def convert_action_file(path_state, path_action, path_out, d, dim_action, force=False):
+    """
+    Task: cleans one day of actions and writes it to path_out in one bulk write.
+    Returns True if the file was written, False if skipped
+    """
+    if not force and up_to_date(path_action, path_out) and up_to_date(path_state, path_out):
+        return False
+    actions = clean_actions(read_matrix(path_state), read_matrix(path_action), d, dim_action)
+    path_tmp = path_out + '.tmp'
+    with open(path_tmp, 'w') as f:
+        f.write(format_actions(actions, dim_action))
+    os.replace(path_tmp, path_out)
+
+    return True
+
+
+def read_clean_day(path_state, path_action, d, dim_action):
+    """
+    Task: returns states and cleaned actions of one day, without writing text
+    """
+    states = read_matrix(path_state)
+
+    return states, clean_actions(states, read_matrix(path_action), d, dim_action)
+
+
+def run_tasks(func, list_args, num_workers=None):
+    """
+    Applies func to each tuple of arguments in list_args, in a pool of
+    num_workers processes (None for one per CPU), or serially if num_workers == 1.
+    Returns list of results in the order of list_args
+    """
+    if num_workers == 1 or len(list_args) <= 1:
+        return [func(*args) for args in list_args]
+    with multiprocessing.Pool(num_workers) as pool:
+        return pool.starmap(func, list_args)
+
+
+def reorder_files(indir, outdir, num_workers=None, force=False):
+    """
+    Reorders every file in indir, writing <name>_reordered.<ext> to outdir.
+    Returns number of files written
+    """
+    list_args = []
+    for filename in sorted(os.listdir(indir)):
+        index_dot = filename.index('.')
+        filename_new = filename[:index_dot] + '_reordered' + filename[index_dot:]
+        list_args.append( (os.path.join(indir, filename), os.path.join(outdir, filename_new), force) )
+
+    return sum(run_tasks(reorder_file, list_args, num_workers))
+
+
+def normalize(indir, outdir, header=False, num_workers=None, force=False):
+    """
+    Normalizes every file in indir, writing a file with the same name to outdir.
+    Returns number of files written
+    """
+    list_args = [(os.path.join(indir, filename), os.path.join(outdir, filename), header, force) for filename in sorted(os.listdir(indir))]
+
+    return sum(run_tasks(normalize_file, list_args, num_workers))
+
+
+def get_max_nonzero(indir, num_workers=None):
+    """
+    Returns the maximum number of nonzero entries in the initial distribution
+    over all files in indir, and the name of the file that attains it
+    """
+    list_files = sorted(os.listdir(indir))
+    list_nnz = run_tasks(count_nonzero_file, [(os.path.join(indir, filename),) for filename in list_files], num_workers)
+    idx_max = int(np.argmax(list_nnz))
+
+    return list_nnz[idx_max], list_files[idx_max]
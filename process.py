@@ -1,14 +1,34 @@
 import os
 import numpy as np
 
-def combine_files(start=1, end=21, read_dir='train_normalized_round2', write_location='rnn_round2/rnn_train.txt'):
+import dataset
+
+def combine_files(start=1, end=21, read_dir='train_normalized_round2', write_location='rnn_round2/rnn_train.txt', dataset_file=None):
+    """
+    dataset_file - if not None, read days start to end from this dataset instead of read_dir.
+    Raises ValueError if a day in that range is not in the dataset
+    """
     
+    if dataset_file:
+        ds = dataset.open_dataset(dataset_file)
+        tensor_states = ds.states(day_start=start, day_end=end)
+        # row of each day ID, days may be missing from the range
+        map_day_row = {}
+        for row, day in enumerate(ds.days(day_start=start, day_end=end)):
+            map_day_row.setdefault(int(day), row)
+        missing = [idx for idx in range(start, end+1) if idx not in map_day_row]
+        if missing:
+            raise ValueError("Days %s are not in %s" % (missing, dataset_file))
+
     f_out = open(write_location, 'w')
 
     for idx in range(start, end+1):
-        filename = read_dir + "/trend_distribution_day%d.csv" % idx
-        with open(filename, 'r') as f:
-            matrix = np.loadtxt(f, delimiter=' ')
+        if dataset_file:
+            matrix = tensor_states[map_day_row[idx]]
+        else:
+            filename = read_dir + "/trend_distribution_day%d.csv" % idx
+            with open(filename, 'r') as f:
+                matrix = np.loadtxt(f, delimiter=' ')
         matrix = matrix[:, 0:15]
         s = ''
         for hour in range(0,16):
@@ -0,0 +1,175 @@
+"""
+Named timers and counters for instrumenting the IRL outer loop.
+
+A disabled profiler hands out a shared no-op timer, so instrumented code
+pays for one attribute lookup and one method call per timed block.
+"""
+
+import os
+import time
+import json
+import cProfile
+import pstats
+
+
+class _null_timer:
+    """
+    Context manager that does nothing, returned by a disabled profiler
+    """
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *args):
+        return False
+
+
+_NULL_TIMER = _null_timer()
+
+
+class _timer:
+
+    def __init__(self, totals, counts, name):
+        self.totals = totals
+        self.counts = counts
+        self.name = name
+
+    def __enter__(self):
+        self.t_start = time.perf_counter()
+        return self
+
+    def __exit__(self, *args):
+        elapsed = time.perf_counter() - self.t_start
+        self.totals[self.name] = self.totals.get(self.name, 0.0) + elapsed
+        self.counts[self.name] = self.counts.get(self.name, 0) + 1
+        return False
+
+
+class profiler:
+
+    def __init__(self, enabled=False, outfile='results/profile.csv', profile_iteration=-1, profile_dir='results', backend='cprofile'):
+        """
+        enabled - if False, all timers and counters are no-ops
+        outfile - per-iteration breakdown, written as JSON lines if the name ends in .json, else as CSV
+        profile_iteration - outer iteration to capture with a full profiler, -1 for none
+        profile_dir - directory for the captured profile of profile_iteration
+        backend - 'cprofile' or 'pyinstrument'
+        """
+        self.enabled = enabled
+        self.outfile = outfile
+        self.profile_iteration = profile_iteration
+        self.profile_dir = profile_dir
+        self.backend = backend
+
+        self.iteration = -1
+        # map from timer name to total seconds and number of calls in current iteration
+        self.totals = {}
+        self.counts = {}
+        # map from counter name to value in current iteration
+        self.counters = {}
+        self.capture = None
+        # columns of the CSV file, extended when a later iteration has new timers or counters
+        self.columns = []
+        # rows written so far, to rewrite the CSV file when columns are added
+        self.rows = []
+
+    def timer(self, name):
+        """
+        Returns a context manager that accumulates wall time under name
+        """
+        if not self.enabled:
+            return _NULL_TIMER
+        return _timer(self.totals, self.counts, name)
+
+    def count(self, name, n=1):
+        """
+        Adds n to the counter called name
+        """
+        if self.enabled:
+            self.counters[name] = self.counters.get(name, 0) + n
+
+    def start_iteration(self, iteration):
+        """
+        Clears all timers and counters and begins a full profile
+        capture if iteration == self.profile_iteration
+        """
+        if not self.enabled:
+            return
+        self.iteration = iteration
+        self.totals = {}
+        self.counts = {}
+        self.counters = {}
+        if iteration == self.profile_iteration:
+            self.start_capture()
+        self.t_iteration = time.perf_counter()
+
+    def end_iteration(self):
+        """
+        Writes the breakdown of the current iteration to self.outfile
+        """
+        if not self.enabled:
+            return
+        self.totals['iteration'] = time.perf_counter() - self.t_iteration
+        self.counts['iteration'] = 1
+        if self.capture is not None:
+            self.stop_capture()
+        self.write_iteration()
+
+    def summary(self):
+        """
+        Returns dict with the timers and counters of the current iteration
+        """
+        row = {'iteration': self.iteration}
+        for name in sorted(self.totals):
+            row['time/' + name] = self.totals[name]
+            row['calls/' + name] = self.counts[name]
+        for name in sorted(self.counters):
+            row['count/' + name] = self.counters[name]
+        return row
+
+    def write_iteration(self):
+        row = self.summary()
+        if self.outfile.endswith('.json'):
+            with open(self.outfile, 'a') as f:
+                f.write(json.dumps(row) + '\n')
+            return
+        self.rows.append(row)
+        new_columns = [col for col in row if col not in self.columns]
+        if not self.columns or new_columns:
+            # a timer or counter appeared for the first time, rewrite the
+            # file with the extended header, earlier rows get 0 in new columns
+            self.columns += new_columns
+            with open(self.outfile, 'w') as f:
+                f.write(','.join(self.columns) + '\n')
+                for prev in self.rows:
+                    f.write(','.join([str(prev.get(col, 0)) for col in self.columns]) + '\n')
+            return
+        with open(self.outfile, 'a') as f:
+            f.write(','.join([str(row.get(col, 0)) for col in self.columns]) + '\n')
+
+    def start_capture(self):
+        if self.backend == 'pyinstrument':
+            try:
+                import pyinstrument
+            except ImportError:
+                print("pyinstrument is not installed, falling back to cProfile")
+                self.backend = 'cprofile'
+            else:
+                self.capture = pyinstrument.Profiler()
+                self.capture.start()
+                return
+        self.capture = cProfile.Profile()
+        self.capture.enable()
+
+    def stop_capture(self):
+        path = os.path.join(self.profile_dir, 'profile_iter%d' % self.iteration)
+        if self.backend == 'pyinstrument':
+            self.capture.stop()
+            with open(path + '.html', 'w') as f:
+                f.write(self.capture.output_html())
+        else:
+            self.capture.disable()
+            self.capture.dump_stats(path + '.prof')
+            with open(path + '.txt', 'w') as f:
+                stats = pstats.Stats(self.capture, stream=f)
+                stats.sort_stats('cumulative').print_stats(50)
+        self.capture = None
@@ -0,0 +1,364 @@
+"""
+Rollout workers over TCP.
+
+A worker process listens on a port and serves one coordinator at a time. The
+coordinator sends the start states and root seed once ('config'), or for
+workers it started on this host a shared_data handle of the start states, then the
+current policy ('policy': theta, shift, alpha_scale and optionally the reward
+network weights), and requests trajectories by index ('rollout'). Trajectory
+idx is drawn from streams.rollout(idx) exactly as in rollout.generate_trajectory,
+so the result does not depend on which worker, or how many, produced it.
+With score=True the worker also evaluates its copy of the reward network on
+every transition and returns the rewards, i.e. the per-step rewards and the
+return of each episode under the current policy.
+
+Every message on the wire is
+
+    MAGIC | uint32 JSON length | uint64 payload length | JSON header | payload
+
+The JSON header holds the message kind, small values, and the name, dtype and
+shape of each array; the payload is the raw bytes of the arrays in that order.
+States and actions are sent as float64, so trajectories from the workers are
+identical to those of rollout.generate_trajectory in the coordinator's process.
+
+The protocol has no authentication, so workers listen on localhost by default.
+A worker on another host of a trusted network is started with
+    python remote.py --host 0.0.0.0 --port 5000
+and spawn_local() starts workers on localhost for testing.
+"""
+
+import argparse
+import json
+import multiprocessing
+import socket
+import struct
+
+import numpy as np
+
+import rng
+import rollout
+import shared_data
+
+
+MAGIC = b'MFGR'
+HEADER = struct.Struct('<4sIQ')
+
+
+def recv_exact(sock, num_bytes):
+    """
+    Reads exactly num_bytes from sock, raises ConnectionError if the peer closes first
+    """
+    buf = bytearray(num_bytes)
+    view = memoryview(buf)
+    pos = 0
+    while pos < num_bytes:
+        n = sock.recv_into(view[pos:], num_bytes - pos)
+        if n == 0:
+            raise ConnectionError("Connection closed after %d of %d bytes" % (pos, num_bytes))
+        pos += n
+
+    return buf
+
+
+def send_message(sock, kind, meta=None, arrays=None):
+    """
+    Sends one message
+
+    kind - message type, e.g. 'config', 'policy', 'rollout'
+    meta - dict of JSON-serializable values
+    arrays - dict of name to np.ndarray
+    """
+    list_info = []
+    list_bytes = []
+    for name, array in (arrays or {}).items():
+        array = np.ascontiguousarray(array)
+        list_info.append( {'name':name, 'dtype':array.dtype.str, 'shape':list(array.shape)} )
+        list_bytes.append(array.tobytes())
+    header = json.dumps({'kind':kind, 'meta':meta or {}, 'arrays':list_info}).encode('utf-8')
+    payload_len = sum(len(b) for b in list_bytes)
+    sock.sendall(HEADER.pack(MAGIC, len(header), payload_len) + header)
+    for b in list_bytes:
+        sock.sendall(b)
+
+
+def recv_message(sock):
+    """
+    Receives one message sent by send_message
+
+    Returns kind, meta, dict of arrays
+    """
+    magic, header_len, payload_len = HEADER.unpack(recv_exact(sock, HEADER.size))
+    if magic != MAGIC:
+        raise ValueError("Bad message magic %r" % magic)
+    header = json.loads(recv_exact(sock, header_len).decode('utf-8'))
+    payload = recv_exact(sock, payload_len)
+    arrays = {}
+    pos = 0
+    for info in header['arrays']:
+        dtype = np.dtype(info['dtype'])
+        count = int(np.prod(info['shape']))
+        arrays[info['name']] = np.frombuffer(payload, dtype=dtype, count=count, offset=pos).reshape(info['shape'])
+        pos += count * dtype.itemsize
+
+    return header['kind'], header['meta'], arrays
+
+
+class reward_evaluator:
+
+    def __init__(self, net_config):
+        """
+        Builds the reward network of AC_IRL in a separate graph and session
+
+        net_config - dict of keyword arguments of networks.reward_net
+        """
+        # only workers that score trajectories need tensorflow
+        import tensorflow as tf
+        import networks
+        d = net_config['d']
+        self.graph = tf.Graph()
+        with self.graph.as_default():
+            self.states = tf.placeholder(tf.float32, shape=[None, d])
+            self.actions = tf.placeholder(tf.float32, shape=[None, d, d])
+            with tf.variable_scope("reward"):
+                out = networks.reward_net(self.states, self.actions, **net_config)
+            # rewards [N], mean over members for an ensemble
+            if net_config.get('ensemble_size', 1) > 1:
+                out = tf.reduce_mean(out, axis=0)
+            self.reward = out[:, 0]
+            # assign ops to load weights by variable name
+            self.assign = {}
+            for var in tf.global_variables():
+                value = tf.placeholder(var.dtype.base_dtype, shape=var.get_shape())
+                self.assign[var.op.name] = (value, tf.assign(var, value))
+            self.sess = tf.Session(graph=self.graph)
+            self.sess.run(tf.global_variables_initializer())
+
+    def set_weights(self, weights):
+        """
+        weights - dict of variable name to value, as returned by AC_IRL.get_reward_weights
+        """
+        list_ops = []
+        feed_dict = {}
+        for name, value in weights.items():
+            placeholder, op = self.assign[name]
+            list_ops.append(op)
+            feed_dict[placeholder] = value
+        self.sess.run(list_ops, feed_dict=feed_dict)
+
+    def evaluate(self, states, actions):
+        return self.sess.run(self.reward, feed_dict={self.states:states, self.actions:actions})
+
+
+class rollout_server:
+
+    def __init__(self):
+        self.config = None
+        self.streams = None
+        self.evaluator = None
+        self.theta = None
+        self.shift = None
+        self.alpha_scale = None
+        self.version = -1
+
+    def handle(self, kind, meta, arrays):
+        """
+        Processes one request, returns the reply as (kind, meta, arrays)
+        """
+        if kind == 'config':
+            self.config = meta
+            if 'shared' in meta:
+                arrays = shared_data.attach(meta['shared'])
+                self.mat_pi0 = {'train':arrays['mat_pi0'], 'test':arrays['mat_pi0_test']}
+            else:
+                self.mat_pi0 = {'train':np.array(arrays['mat_pi0']), 'test':np.array(arrays['mat_pi0_test'])}
+            self.streams = rng.rng_manager(meta['seed'])
+            self.evaluator = None
+            return 'ok', {}, {}
+        elif kind == 'policy':
+            self.theta = meta['theta']
+            self.shift = meta['shift']
+            self.alpha_scale = meta['alpha_scale']
+            self.version = meta['version']
+            if arrays:
+                if self.evaluator is None:
+                    self.evaluator = reward_evaluator(self.config['net_config'])
+                self.evaluator.set_weights(arrays)
+            return 'ok', {'version':self.version}, {}
+        elif kind == 'rollout':
+            return 'trajectories', {'version':self.version}, self.rollout(meta['idx_start'], meta['n'], meta['split'], meta['score'])
+        else:
+            raise ValueError("Unknown request %s" % kind)
+
+    def rollout(self, idx_start, n, split='train', score=False):
+        """
+        Generates trajectories idx_start, ..., idx_start+n-1 from the current policy
+
+        Returns dict of states [n, num_steps, d], actions [n, num_steps, d, d]
+        and, if score, rewards [n, num_steps]
+        """
+        num_steps = self.config['num_steps']
+        list_trajectories = rollout.generate_trajectories(range(idx_start, idx_start+n), self.mat_pi0[split], self.theta, self.shift, self.alpha_scale, self.streams, num_steps, self.config['sampler'], self.config['threshold'])
+        states = np.array([[pair[0] for pair in traj] for traj in list_trajectories])
+        actions = np.array([[pair[1] for pair in traj] for traj in list_trajectories])
+        reply = {'states':states, 'actions':actions}
+        if score:
+            d = states.shape[2]
+            rewards = self.evaluator.evaluate(states.reshape(-1, d), actions.reshape(-1, d, d))
+            reply['rewards'] = rewards.reshape(n, num_steps)
+
+        return reply
+
+
+def serve(host='127.0.0.1', port=5000, port_queue=None):
+    """
+    Runs a rollout worker, serving one coordinator connection after another
+
+    host - interface to listen on, '0.0.0.0' for all. The protocol has no
+    authentication, so only listen on all interfaces in a trusted network
+    port - 0 to let the OS choose a free port
+    port_queue - if not None, the bound port is put on this queue
+    """
+    listener = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
+    listener.setsockopt(socket.SOL_SOCKET, socket.SO_REUSEADDR, 1)
+    listener.bind((host, port))
+    listener.listen(1)
+    if port_queue is not None:
+        port_queue.put(listener.getsockname()[1])
+    server = rollout_server()
+    while True:
+        conn, _ = listener.accept()
+        conn.setsockopt(socket.IPPROTO_TCP, socket.TCP_NODELAY, 1)
+        with conn:
+            try:
+                while True:
+                    kind, meta, arrays = recv_message(conn)
+                    if kind == 'stop':
+                        send_message(conn, 'ok')
+                        listener.close()
+                        return
+                    try:
+                        reply = server.handle(kind, meta, arrays)
+                    except Exception as e:
+                        reply = ('error', {'message':'%s: %s' % (type(e).__name__, e)}, {})
+                    send_message(conn, *reply)
+            except ConnectionError:
+                # coordinator went away, wait for the next one
+                continue
+
+
+def spawn_local(num_workers, host='127.0.0.1'):
+    """
+    Starts num_workers rollout workers on localhost, each on a free port
+
+    Returns list of processes and list of (host, port) addresses
+    """
+    # the caller may hold a tensorflow session and workers may build their own,
+    # which is not safe in forked processes
+    ctx = multiprocessing.get_context('spawn')
+    port_queue = ctx.Queue()
+    list_processes = []
+    for idx in range(num_workers):
+        p = ctx.Process(target=serve, args=(host, 0, port_queue))
+        p.daemon = True
+        p.start()
+        list_processes.append(p)
+    list_addresses = [(host, port_queue.get(timeout=60)) for _ in range(num_workers)]
+
+    return list_processes, list_addresses
+
+
+class rollout_coordinator:
+
+    def __init__(self, list_addresses, mat_pi0, mat_pi0_test, seed, net_config, num_steps=15, sampler='exact', threshold=rollout.NORMAL_THRESHOLD, shared=None):
+        """
+        Connects to the workers at list_addresses and sends them the configuration
+
+        mat_pi0, mat_pi0_test - matrices of start states of the train and test sets
+        seed - entropy of the coordinator's rng.rng_manager
+        net_config - dict of keyword arguments of networks.reward_net
+        sampler, threshold - see rollout.sample_dirichlet
+        shared - if not None, handle of shared_data.shared_arrays holding 'mat_pi0' and
+        'mat_pi0_test', which all workers attach to instead of receiving copies.
+        Only for workers started by this process, e.g. by spawn_local
+        """
+        self.version = 0
+        self.list_socks = []
+        for host, port in list_addresses:
+            sock = socket.create_connection((host, port))
+            sock.setsockopt(socket.IPPROTO_TCP, socket.TCP_NODELAY, 1)
+            self.list_socks.append(sock)
+        meta = {'seed':seed, 'net_config':net_config, 'num_steps':num_steps, 'sampler':sampler, 'threshold':threshold}
+        if shared is not None:
+            meta['shared'] = {name:shared[name] for name in ['mat_pi0', 'mat_pi0_test']}
+            self.broadcast('config', meta)
+        else:
+            self.broadcast('config', meta, {'mat_pi0':mat_pi0, 'mat_pi0_test':mat_pi0_test})
+
+    def reply(self, sock):
+        kind, meta, arrays = recv_message(sock)
+        if kind == 'error':
+            raise RuntimeError("Rollout worker %s:%d failed: %s" % (sock.getpeername() + (meta['message'],)))
+
+        return kind, meta, arrays
+
+    def broadcast(self, kind, meta=None, arrays=None):
+        """
+        Sends the same message to all workers, then waits for all replies
+        """
+        for sock in self.list_socks:
+            send_message(sock, kind, meta, arrays)
+
+        return [self.reply(sock) for sock in self.list_socks]
+
+    def publish(self, theta, shift, alpha_scale, weights=None):
+        """
+        Makes (theta, shift, alpha_scale) the policy of all workers
+
+        weights - dict of reward network weights, required before rollouts with score=True
+        """
+        self.version += 1
+        self.broadcast('policy', {'theta':float(theta), 'shift':float(shift), 'alpha_scale':float(alpha_scale), 'version':self.version}, weights)
+
+    def rollout(self, idx_start, n, split='train', score=False):
+        """
+        Generates trajectories idx_start, ..., idx_start+n-1, split into
+        contiguous ranges across workers, which run concurrently
+
+        Returns states [n, num_steps, d], actions [n, num_steps, d, d]
+        and rewards [n, num_steps] if score, else None
+        """
+        num_workers = len(self.list_socks)
+        bounds = np.linspace(0, n, num_workers + 1).astype(int)
+        list_active = []
+        for sock, lo, hi in zip(self.list_socks, bounds[:-1], bounds[1:]):
+            if hi > lo:
+                send_message(sock, 'rollout', {'idx_start':int(idx_start + lo), 'n':int(hi - lo), 'split':split, 'score':score})
+                list_active.append(sock)
+        list_replies = [self.reply(sock)[2] for sock in list_active]
+        states = np.concatenate([r['states'] for r in list_replies])
+        actions = np.concatenate([r['actions'] for r in list_replies])
+        rewards = np.concatenate([r['rewards'] for r in list_replies]) if score else None
+
+        return states, actions, rewards
+
+    def close(self, stop_workers=False):
+        """
+        Disconnects from all workers, and shuts them down if stop_workers
+        """
+        for sock in self.list_socks:
+            if stop_workers:
+                try:
+                    send_message(sock, 'stop')
+                    recv_message(sock)
+                except (ConnectionError, OSError):
+                    pass
+            sock.close()
+        self.list_socks = []
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Run a rollout worker")
+    parser.add_argument('--host', type=str, default='127.0.0.1')
+    parser.add_argument('--port', type=int, default=5000)
+    args = parser.parse_args()
+    serve(args.host, args.port)
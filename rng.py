@@ -0,0 +1,86 @@
+"""
+Reproducible random number streams.
+
+Every draw in training comes from a stream identified by a purpose and a
+counter, e.g. ('rollout', 17) for the 17th generated trajectory. Streams are
+derived from one root SeedSequence through its spawn_key and use the
+counter-based Philox bit generator, so the numbers drawn for a given
+(purpose, counter) do not depend on which process draws them or in which
+order. One worker and N workers therefore produce identical results, as long
+as the counters are assigned the same way.
+"""
+
+import numpy as np
+
+
+# Purpose codes used as the first element of the spawn key
+INIT = 0
+EPISODE = 1
+ROLLOUT = 2
+MINIBATCH = 3
+WORKER = 4
+EVAL = 5
+SUBSAMPLE = 6
+
+
+class rng_manager:
+
+    def __init__(self, seed=None):
+        """
+        seed - integer root seed, None to draw fresh entropy from the OS
+        """
+        self.root = np.random.SeedSequence(seed)
+        # record the entropy so that an unseeded run can be reproduced later
+        self.seed = self.root.entropy
+
+    def stream(self, purpose, *counters):
+        """
+        Returns an independent np.random.Generator for (purpose, *counters)
+
+        purpose - one of the purpose codes in this module
+        counters - non-negative integers, e.g. episode or trajectory index
+        """
+        seq = np.random.SeedSequence(self.seed, spawn_key=(purpose,) + tuple(int(c) for c in counters))
+        return np.random.Generator(np.random.Philox(seq))
+
+    def init(self):
+        """
+        Stream for parameter initialization
+        """
+        return self.stream(INIT)
+
+    def episode(self, idx):
+        """
+        Stream for forward training episode idx
+        """
+        return self.stream(EPISODE, idx)
+
+    def rollout(self, idx):
+        """
+        Stream for generated trajectory idx
+        """
+        return self.stream(ROLLOUT, idx)
+
+    def minibatch(self, idx):
+        """
+        Stream for reward learning minibatch idx
+        """
+        return self.stream(MINIBATCH, idx)
+
+    def worker(self, idx):
+        """
+        Stream for anything a worker process draws outside of episodes and rollouts
+        """
+        return self.stream(WORKER, idx)
+
+    def eval(self, idx=0):
+        """
+        Stream for evaluation rollouts
+        """
+        return self.stream(EVAL, idx)
+
+    def subsample(self, idx=0):
+        """
+        Stream for subsampling evaluation sets
+        """
+        return self.stream(SUBSAMPLE, idx)
@@ -0,0 +1,283 @@
+"""
+Policy rollouts that depend only on numpy, so they can run in worker
+processes that do not hold a tensorflow session.
+"""
+
+import numpy as np
+
+
+def calc_alpha(pi, theta, shift):
+    """
+    Input:
+    pi - population distribution as a row vector, or array [..., d] of them
+    theta, shift - policy parameters
+
+    Returns matrix of Dirichlet parameters, [..., d, d]
+    alpha^i_j = ln ( 1 + exp[ theta ( (pi_j - pi_i) - shift ) ] )
+    """
+    # temp[..., i, j] = pi_j - pi_i
+    temp = pi[..., np.newaxis, :] - pi[..., :, np.newaxis]
+
+    return np.log( 1 + np.exp( theta * (temp - shift)))
+
+
+# minimum Dirichlet parameter of an action for the normal approximation of sample_dirichlet
+NORMAL_THRESHOLD = 100.0
+
+
+def sample_dirichlet(mat_alpha, alpha_scale, rng=None, method='exact', threshold=NORMAL_THRESHOLD, z=None):
+    """
+    Samples from product of d d-dimensional Dirichlet distributions,
+    row i has parameters mat_alpha[i] * alpha_scale
+
+    rng - np.random.Generator, None to use the global np.random state
+    method - 'exact' to normalize gamma variates, 'normal' to use
+    sample_dirichlet_normal for rows whose smallest parameter is at least threshold,
+    the other rows are sampled exactly. The time of a single matrix is mostly
+    per-call numpy overhead, which the normal approximation does not reduce;
+    it pays off when many actions are sampled per call, see generate_trajectories
+    z - optional [d, d] standard normals for the normal approximation, drawn from rng if None
+    Returns an entire transition probability matrix
+    """
+    if rng is None:
+        rng = np.random
+    mat_shape = mat_alpha * alpha_scale
+    if method == 'normal':
+        rows_exact = np.min(mat_shape, axis=1) < threshold
+        if not np.any(rows_exact):
+            return sample_dirichlet_normal(mat_shape, rng, z)
+        if not np.all(rows_exact):
+            rows_normal = ~rows_exact
+            P = np.empty_like(mat_shape)
+            P[rows_normal] = sample_dirichlet_normal(mat_shape[rows_normal], rng, None if z is None else z[rows_normal])
+            P[rows_exact] = sample_dirichlet_gamma(mat_shape[rows_exact], rng)
+            return P
+    elif method != 'exact':
+        raise ValueError("Unknown Dirichlet sampler %s" % method)
+
+    return sample_dirichlet_gamma(mat_shape, rng)
+
+
+def sample_dirichlet_gamma(mat_shape, rng):
+    """
+    Exact sample of Dirichlet(mat_shape[i]) for each row i, by normalizing gamma variates
+    """
+    # Get y^i_1, ... y^i_d for all rows at once, drawn in the same order as row by row
+    try:
+        y = rng.gamma(shape=mat_shape, scale=1)
+    except ValueError:
+        print("ValueError!")
+        print(mat_shape)
+        raise
+    # replace zeros with dummy value
+    y[y == 0] = 1e-20
+
+    return y / np.sum(y, axis=1, keepdims=True)
+
+
+def sample_dirichlet_normal(mat_shape, rng, z=None):
+    """
+    Moment-matched normal approximation of Dirichlet(mat_shape[..., i, :]) for each row i.
+
+    With a = mat_shape[i], a0 = sum(a) and mean m = a / a0, a row is
+        x = m + (u - m * sum(u)) / sqrt(a0 + 1),   u_j = sqrt(m_j) z_j,  z ~ N(0, I)
+    whose mean m and covariance (diag(m) - m m^T) / (a0 + 1) equal those of
+    the Dirichlet exactly, and whose entries sum to 1 exactly.
+
+    Accuracy, for a row with smallest parameter a_min = min_j a_j:
+    - the marginals of the Dirichlet are Beta(a_j, a0 - a_j), whose skewness
+      is at most 2 / sqrt(a_min) in absolute value; the normal has none, so
+      the error in the third standardized moment is at most 2 / sqrt(a_min)
+      (0.2 at the default threshold of 100)
+    - an entry falls below 0 with probability at most Phi(-sqrt(a_min))
+      (below 1e-23 at a_min = 100). Such entries are projected back onto
+      the simplex by clipping to 1e-20, as zeros are in the exact sampler,
+      and renormalizing the row
+
+    The time is in the number of numpy calls rather than in the arithmetic,
+    so many matrices should be sampled in one call by stacking them along
+    leading axes. Each row only depends on its own parameters and normals.
+
+    mat_shape - [..., num_rows, d] Dirichlet parameters
+    z - optional standard normals of the same shape, drawn from rng if None
+    Returns [..., num_rows, d] rows on the simplex
+    """
+    if z is None:
+        z = rng.standard_normal(mat_shape.shape)
+    # scale vectors of row values where possible and work in place
+    a0 = mat_shape.sum(axis=-1)
+    m = mat_shape / a0[..., np.newaxis]
+    u = np.sqrt(m)
+    u *= z
+    c = 1 / np.sqrt(a0 + 1)
+    # m + (u - m * sum(u)) * c
+    P = u * c[..., np.newaxis]
+    P += m * (1 - u.sum(axis=-1) * c)[..., np.newaxis]
+    rows_clip = P.min(axis=-1) <= 0
+    if rows_clip.any():
+        rows = np.maximum(P[rows_clip], 1e-20)
+        P[rows_clip] = rows / np.sum(rows, axis=-1, keepdims=True)
+
+    return P
+
+
+def generate_trajectory(idx_traj, mat_pi0, theta, shift, alpha_scale, streams, num_steps=15, sampler='exact', threshold=NORMAL_THRESHOLD, deterministic=False):
+    """
+    Generates trajectory number idx_traj, i.e. a list of num_steps (state, action) pairs.
+    The start state and every action are drawn from streams.rollout(idx_traj),
+    so the result depends only on idx_traj and the policy, not on the calling process.
+    With sampler='normal' the standard normals of all steps are drawn right after
+    the start state, and steps that fall back to exact sampling draw gamma variates after them.
+
+    mat_pi0 - matrix of start states, one per row
+    streams - rng.rng_manager
+    sampler, threshold - method and threshold of sample_dirichlet
+    deterministic - if True, every action is the mean action, only the start state is drawn
+    """
+    rng_traj = streams.rollout(idx_traj)
+    # Sample start state
+    idx_row = rng_traj.integers(mat_pi0.shape[0])
+    pi = mat_pi0[idx_row, :] # row vector
+    d = mat_pi0.shape[1]
+    if sampler == 'normal' and not deterministic:
+        tensor_z = rng_traj.standard_normal((num_steps, d, d))
+
+    trajectory = []
+    for hour in range(num_steps):
+        if deterministic:
+            P = mean_action(calc_alpha(pi, theta, shift))
+        elif sampler == 'normal':
+            P = sample_dirichlet(calc_alpha(pi, theta, shift), alpha_scale, rng_traj, sampler, threshold, tensor_z[hour])
+        else:
+            P = sample_dirichlet(calc_alpha(pi, theta, shift), alpha_scale, rng_traj, sampler, threshold)
+        trajectory.append( (pi, P) )
+        pi = np.transpose(P).dot(pi)
+
+    return trajectory
+
+
+def generate_trajectories(list_idx, mat_pi0, theta, shift, alpha_scale, streams, num_steps=15, sampler='exact', threshold=NORMAL_THRESHOLD, deterministic=False):
+    """
+    Returns [generate_trajectory(idx_traj, ...) for idx_traj in list_idx], with the same results.
+
+    With sampler='normal' the trajectories advance in lockstep, so that each hour
+    computes the Dirichlet parameters and the normal approximation of all of them
+    in one set of numpy calls. Only the draws from each trajectory's stream, the
+    exact fallback and the transition P^T pi remain per trajectory.
+    """
+    if sampler != 'normal' or deterministic:
+        return [generate_trajectory(idx_traj, mat_pi0, theta, shift, alpha_scale, streams, num_steps, sampler, threshold, deterministic) for idx_traj in list_idx]
+
+    d = mat_pi0.shape[1]
+    list_rng = [streams.rollout(idx_traj) for idx_traj in list_idx]
+    # start states and standard normals, drawn in the order of generate_trajectory
+    mat_pi = np.zeros([len(list_idx), d])
+    tensor_z = np.zeros([len(list_idx), num_steps, d, d])
+    for k, rng_traj in enumerate(list_rng):
+        mat_pi[k] = mat_pi0[rng_traj.integers(mat_pi0.shape[0])]
+        tensor_z[k] = rng_traj.standard_normal((num_steps, d, d))
+
+    tensor_states = np.zeros([len(list_idx), num_steps, d])
+    tensor_actions = np.zeros([len(list_idx), num_steps, d, d])
+    for hour in range(num_steps):
+        tensor_states[:, hour] = mat_pi
+        tensor_shape = calc_alpha(mat_pi, theta, shift) * alpha_scale
+        # rows below the threshold are sampled exactly, one gamma call per trajectory that has any
+        tensor_rows_exact = tensor_shape.min(axis=2) < threshold
+        if tensor_rows_exact.any():
+            tensor_rows_normal = ~tensor_rows_exact
+            tensor_P = np.empty_like(tensor_shape)
+            tensor_P[tensor_rows_normal] = sample_dirichlet_normal(tensor_shape[tensor_rows_normal], None, tensor_z[:, hour][tensor_rows_normal])
+        else:
+            tensor_P = sample_dirichlet_normal(tensor_shape, None, tensor_z[:, hour])
+        for k in np.nonzero(tensor_rows_exact.any(axis=1))[0]:
+            rows_exact = tensor_rows_exact[k]
+            tensor_P[k, rows_exact] = sample_dirichlet_gamma(tensor_shape[k, rows_exact], list_rng[k])
+        tensor_actions[:, hour] = tensor_P
+        # P^T pi of each trajectory, with the same operation as generate_trajectory
+        mat_pi = np.array([np.transpose(P).dot(pi) for P, pi in zip(tensor_P, mat_pi)])
+
+    list_trajectories = [list(zip(states, actions)) for states, actions in zip(tensor_states, tensor_actions)]
+
+    return list_trajectories
+
+
+def mean_action(mat_alpha):
+    """
+    Mean of the product of Dirichlet distributions with parameters mat_alpha * alpha_scale,
+    row i is mat_alpha[i] / sum(mat_alpha[i]), independent of alpha_scale.
+    Works on any array [..., d, d]
+    """
+    return mat_alpha / np.sum(mat_alpha, axis=-1, keepdims=True)
+
+
+def calc_alpha_batch(tensor_pi, vec_theta, vec_shift):
+    """
+    calc_alpha for many states under many policies, computed as
+    logaddexp(0, x) = ln(1 + exp(x)), which does not overflow for large x
+
+    tensor_pi - [num_settings, num_states, d] population distributions
+    vec_theta, vec_shift - [num_settings] policy parameters
+
+    Returns [num_settings, num_states, d, d]
+    """
+    # temp[k, s, i, j] = pi_j - pi_i
+    temp = tensor_pi[:, :, None, :] - tensor_pi[:, :, :, None]
+    vec_theta = np.asarray(vec_theta, dtype=np.float64).reshape(-1, 1, 1, 1)
+    vec_shift = np.asarray(vec_shift, dtype=np.float64).reshape(-1, 1, 1, 1)
+
+    return np.logaddexp(0, vec_theta * (temp - vec_shift))
+
+
+def mean_trajectories(mat_pi0, vec_theta, vec_shift, total_hours=16):
+    """
+    Deterministic rollouts with the mean action, batched over start states
+    and policies, one set of tensor operations per hour. alpha_scale does not
+    change the mean action, so one rollout covers every alpha_scale.
+
+    mat_pi0 - [num_states, d] start states
+    vec_theta, vec_shift - [num_settings] policy parameters
+
+    Returns [num_settings, num_states, total_hours, d], including the start state
+    """
+    mat_pi0 = np.asarray(mat_pi0, dtype=np.float64)
+    d = mat_pi0.shape[1]
+    pi = np.repeat(mat_pi0[None], len(vec_theta), axis=0)
+    tensor_traj = np.zeros(pi.shape[:2] + (total_hours, d))
+    tensor_traj[:, :, 0] = pi
+    for hour in range(1, total_hours):
+        P = mean_action(calc_alpha_batch(pi, vec_theta, vec_shift))
+        # pi_next = P^T pi for every setting and state
+        pi = np.einsum('ksi,ksij->ksj', pi, P)
+        tensor_traj[:, :, hour] = pi
+
+    return tensor_traj
+
+
+def drift_report(mat_pi0, theta, shift, alpha_scale, rng, total_hours=16, num_samples=20, sampler='exact', threshold=NORMAL_THRESHOLD):
+    """
+    Compares the mean-action trajectory from each start state with
+    num_samples stochastic rollouts from the same start state
+
+    Returns dict of arrays [total_hours], averaged over start states:
+    'l1_sample' - mean L1 distance between the deterministic and a stochastic trajectory
+    'l1_max' - largest such distance
+    'l1_bias' - L1 distance between the deterministic trajectory and the average stochastic trajectory
+    """
+    mat_pi0 = np.asarray(mat_pi0, dtype=np.float64)
+    num_states = mat_pi0.shape[0]
+    mat_det = mean_trajectories(mat_pi0, [theta], [shift], total_hours)[0]
+    tensor_sto = np.zeros([num_states, num_samples, total_hours, mat_pi0.shape[1]])
+    for s in range(num_states):
+        for n in range(num_samples):
+            pi = mat_pi0[s]
+            tensor_sto[s, n, 0] = pi
+            for hour in range(1, total_hours):
+                P = sample_dirichlet(calc_alpha(pi, theta, shift), alpha_scale, rng, sampler, threshold)
+                pi = np.transpose(P).dot(pi)
+                tensor_sto[s, n, hour] = pi
+    # [num_states, num_samples, total_hours]
+    l1 = np.sum(np.abs(tensor_sto - mat_det[:, None]), axis=3)
+    l1_bias = np.sum(np.abs(np.mean(tensor_sto, axis=1) - mat_det), axis=2)
+
+    return {'l1_sample':np.mean(l1, axis=(0, 1)), 'l1_max':np.max(l1, axis=(0, 1)), 'l1_bias':np.mean(l1_bias, axis=0)}
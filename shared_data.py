@@ -0,0 +1,79 @@
+"""
+Read-only numpy arrays in shared memory for worker processes.
+
+The parent process copies each array once into a multiprocessing.shared_memory
+block with shared_arrays(). Its handle, a small picklable dict of block names,
+shapes and dtypes, is passed to worker processes, which map the same blocks
+with attach() instead of receiving pickled copies or re-reading files. Memory
+use and startup time of a worker therefore do not grow with the size of the data.
+
+attach() is meant for processes started by the publishing process, which share
+its resource tracker, so the blocks are unlinked only once, by close() in the parent.
+"""
+
+from multiprocessing import shared_memory
+
+import numpy as np
+
+
+class shared_arrays:
+
+    def __init__(self, arrays):
+        """
+        Copies each array of the dict arrays into its own shared memory block
+        """
+        self.blocks = []
+        self.handle = {}
+        self.arrays = {}
+        for name, array in arrays.items():
+            array = np.ascontiguousarray(array)
+            # blocks cannot be empty
+            shm = shared_memory.SharedMemory(create=True, size=max(array.nbytes, 1))
+            view = np.ndarray(array.shape, dtype=array.dtype, buffer=shm.buf)
+            view[...] = array
+            view.flags.writeable = False
+            self.blocks.append(shm)
+            self.arrays[name] = view
+            self.handle[name] = (shm.name, array.shape, array.dtype.str)
+
+    def close(self):
+        """
+        Releases and removes all blocks. Workers must be done with them
+        """
+        self.arrays = {}
+        for shm in self.blocks:
+            try:
+                shm.close()
+            except BufferError:
+                # views of the block are still referenced, the mapping is released when they are
+                pass
+            shm.unlink()
+        self.blocks = []
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *args):
+        self.close()
+        return False
+
+
+# blocks attached by this process, by name, kept open for the lifetime of the process
+_attached = {}
+
+
+def attach(handle):
+    """
+    Maps the blocks of a shared_arrays handle in this process
+
+    Returns dict of name to read-only array
+    """
+    arrays = {}
+    for name, (shm_name, shape, dtype) in handle.items():
+        if shm_name not in _attached:
+            _attached[shm_name] = shared_memory.SharedMemory(name=shm_name)
+        view = np.ndarray(shape, dtype=np.dtype(dtype), buffer=_attached[shm_name].buf)
+        view.flags.writeable = False
+        arrays[name] = view
+
+    return arrays
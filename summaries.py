@@ -0,0 +1,66 @@
+"""
+Scheduling of TensorBoard summaries.
+
+Histogram summaries of every variable and gradient are expensive to evaluate
+and to serialize, so they are not run on every training step. A
+summary_scheduler decides when the next step should also evaluate the merged
+summary op: every every_steps steps, or once every_secs seconds have passed
+since the last summary, whichever comes first. The merged op is then fetched
+in the same sess.run as the training op, so the gradients computed for the
+update are the ones that are summarized.
+"""
+
+import time
+
+import tensorflow as tf
+
+
+class summary_scheduler:
+
+    def __init__(self, every_steps=100, every_secs=None):
+        """
+        every_steps - summarize on every step that is a multiple of this, None to disable
+        every_secs - summarize when this many seconds have passed since the last summary, None to disable
+        """
+        self.every_steps = every_steps
+        self.every_secs = every_secs
+        self.t_last = time.time()
+        self.num_written = 0
+
+    def due(self, step):
+        """
+        Returns True if step should evaluate summaries
+        """
+        if self.every_steps and step % self.every_steps == 0:
+            return True
+        if self.every_secs is not None and time.time() - self.t_last >= self.every_secs:
+            return True
+
+        return False
+
+    def mark(self):
+        """
+        Records that a summary was just written
+        """
+        self.t_last = time.time()
+        self.num_written += 1
+
+
+def create_writer(log_dir, graph=None, max_queue=100, flush_secs=120):
+    """
+    FileWriter whose events are queued and written to disk by a background thread.
+    add_summary only enqueues, and the queue is flushed when it holds max_queue
+    events or every flush_secs seconds
+    """
+    return tf.summary.FileWriter(log_dir, graph, max_queue=max_queue, flush_secs=flush_secs)
+
+
+def add_histograms(list_grads_and_vars):
+    """
+    Creates histogram summaries of each variable and of its gradient,
+    reusing the gradients returned by optimizer.compute_gradients
+    """
+    for grad, var in list_grads_and_vars:
+        tf.summary.histogram(var.op.name, var)
+        if grad is not None:
+            tf.summary.histogram(var.op.name + '/gradients', grad)
@@ -0,0 +1,61 @@
+import numpy as np
+
+import codec
+
+
+def test_uint16_sub_stochastic():
+    """
+    Rows of demonstration actions are blocks of larger matrices, so they may
+    sum to less than 1. Decoding restores the row sums and the entries to
+    the resolution of the codec, and all-zero rows stay zero
+    """
+    P = np.array([[0.5, 0.3, 0.0],
+                  [0.0, 0.0, 0.0],
+                  [1e-3, 0.2, 0.79]])
+    codes, scales = codec.encode(P, 'uint16')
+    decoded = codec.decode(codes, 'uint16', np.float64, scales)
+    assert np.allclose(np.sum(decoded, axis=1), np.sum(P, axis=1))
+    # at most one unit of the row, plus float32 rounding of the scale
+    assert np.max(np.abs(decoded - P)) <= np.max(np.sum(P, axis=1)) / codec.UINT16_SCALE + 1e-7
+    assert np.all(decoded[1] == 0)
+
+
+def test_store_round_trip(d=4, num_steps=3, num_traj=5):
+    """
+    A trajectory_store returns the sub-stochastic actions it was given,
+    after drop_first and through fetch, for every codec
+    """
+    rng = np.random.default_rng(0)
+    list_trajectories = [[(rng.dirichlet(np.ones(d)), 0.8 * rng.dirichlet(np.ones(d), size=d)) for _ in range(num_steps)] for _ in range(num_traj)]
+    actions = np.array([[pair[1] for pair in traj] for traj in list_trajectories])
+    for method, atol in [('uint16', 1e-4), ('float16', 1e-3), ('none', 0)]:
+        store = codec.trajectory_store(d, num_steps, method, list_trajectories)
+        store.drop_first(1)
+        _, fetched = store.fetch()
+        assert np.allclose(fetched, actions[1:].reshape(-1, d, d), atol=atol)
+        assert np.allclose(store[0][1][1], actions[1, 1], atol=atol)
+
+
+def test_stochastic_store(d=15, num_steps=3, num_traj=4):
+    """
+    A stochastic store keeps no row scales, takes 2 d^2 bytes per action and
+    decodes rows that sum to 1, also through from_arrays
+    """
+    rng = np.random.default_rng(1)
+    list_trajectories = [[(rng.dirichlet(np.ones(d)), rng.dirichlet(np.ones(d), size=d)) for _ in range(num_steps)] for _ in range(num_traj)]
+    actions = np.array([[pair[1] for pair in traj] for traj in list_trajectories])
+    store = codec.trajectory_store(d, num_steps, 'uint16', list_trajectories, stochastic=True)
+    assert store.scales.shape == (num_traj, num_steps, 0)
+    assert store.codes.nbytes + store.scales.nbytes == actions.nbytes // 4
+    _, fetched = store.fetch()
+    assert np.allclose(fetched, actions.reshape(-1, d, d), atol=1e-4)
+    assert np.allclose(np.sum(fetched, axis=2), 1, atol=1e-5)
+    copy = codec.from_arrays(store.states, store.codes, store.scales, 'uint16')
+    assert copy.stochastic
+    assert np.array_equal(copy.fetch()[1], fetched)
+
+
+if __name__ == "__main__":
+    test_uint16_sub_stochastic()
+    test_store_round_trip()
+    test_stochastic_store()
@@ -0,0 +1,25 @@
+import numpy as np
+import pytest
+
+
+def test_jsd_batch(num_rows=6, d=20):
+    """
+    AC_IRL.JSD_batch equals AC_IRL.JSD row by row, for unnormalized
+    histograms that contain zeros
+    """
+    pytest.importorskip('tensorflow')
+    import ac_irl
+    rng = np.random.default_rng(0)
+    P = rng.integers(0, 5, size=(num_rows, d)).astype(np.float64)
+    Q = rng.integers(0, 5, size=(num_rows, d)).astype(np.float64)
+    Q[0] = P[0]
+    batch = ac_irl.AC_IRL.JSD_batch(None, P, Q)
+    assert batch.shape == (num_rows,)
+    # JSD replaces zeros in place
+    for idx in range(num_rows):
+        assert np.isclose(batch[idx], ac_irl.AC_IRL.JSD(None, P[idx].copy(), Q[idx].copy()), rtol=1e-10, atol=1e-12)
+    assert abs(batch[0]) < 1e-12
+
+
+if __name__ == "__main__":
+    test_jsd_batch()
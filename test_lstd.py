@@ -0,0 +1,44 @@
+import numpy as np
+import pytest
+
+import lstd
+
+
+def test_recursive_matches_batch(num_features=6, num_batches=3, batch_size=15, reg=1e-2, gamma=0.9):
+    """
+    Sherman-Morrison updates of the recursive solver give the weights of
+    np.linalg.solve on the accumulated statistics, for every batch and decay.
+    The recursive solver decays the regularizer along with A
+    """
+    for decay in [1.0, 0.5]:
+        rng = np.random.default_rng(0)
+        solver = lstd.lstd_solver(num_features, reg=reg, decay=decay, recursive=True)
+        M = reg * np.eye(num_features)
+        b = np.zeros([num_features, 1])
+        for _ in range(num_batches):
+            for _ in range(batch_size):
+                features = rng.standard_normal(num_features)
+                features_next = rng.standard_normal(num_features)
+                reward = rng.standard_normal()
+                solver.add(features, features_next, reward, gamma)
+                M += np.outer(features, features - gamma * features_next)
+                b += features.reshape(-1, 1) * reward
+            w = solver.solve()
+            assert np.allclose(w, np.linalg.solve(M, b), rtol=1e-8, atol=1e-10)
+            M *= decay
+            b *= decay
+
+
+def test_recursive_decay():
+    """
+    The recursive solver rejects decays it cannot apply to A^{-1}
+    """
+    for decay in [0, -0.5, 1.5]:
+        with pytest.raises(ValueError):
+            lstd.lstd_solver(4, decay=decay, recursive=True)
+    lstd.lstd_solver(4, decay=0, recursive=False)
+
+
+if __name__ == "__main__":
+    test_recursive_matches_batch()
+    test_recursive_decay()
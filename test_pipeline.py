@@ -0,0 +1,38 @@
+import numpy as np
+import pytest
+
+import pipeline
+
+
+def test_worker_error(d=15):
+    """
+    An exception in a rollout worker is raised by collect() instead of blocking it
+    """
+    mat_pi0 = np.random.default_rng(0).dirichlet(np.ones(d), size=10)
+    pipe = pipeline.rollout_pipeline(mat_pi0, 1234, 8.64, 0.5, 1e4, num_workers=2, sampler='unknown')
+    pipe.start()
+    try:
+        with pytest.raises(RuntimeError, match="Unknown Dirichlet sampler"):
+            pipe.collect(5)
+    finally:
+        pipe.stop()
+
+
+def test_collect(d=15, n=6):
+    """
+    collect() returns n trajectories ordered by index
+    """
+    mat_pi0 = np.random.default_rng(0).dirichlet(np.ones(d), size=10)
+    pipe = pipeline.rollout_pipeline(mat_pi0, 1234, 8.64, 0.5, 1e4, num_workers=2)
+    pipe.start()
+    try:
+        list_trajectories = pipe.collect(n)
+    finally:
+        pipe.stop()
+    assert len(list_trajectories) == n
+    assert all(len(traj) == 15 for traj in list_trajectories)
+
+
+if __name__ == "__main__":
+    test_worker_error()
+    test_collect()
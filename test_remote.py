@@ -0,0 +1,93 @@
+import numpy as np
+import pytest
+
+import remote
+import rng
+import rollout
+import shared_data
+
+
+def test_matches_local(num_workers=2, idx_start=3, n=5, d=15, shared=False):
+    """
+    Trajectories generated by rollout workers on localhost are identical to
+    those of rollout.generate_trajectory with the same indices, for both splits
+
+    shared - if True, workers attach to the start states in shared memory
+    """
+    rng_data = np.random.default_rng(0)
+    mat_pi0 = rng_data.dirichlet(np.ones(d), size=10)
+    mat_pi0_test = rng_data.dirichlet(np.ones(d), size=7)
+    streams = rng.rng_manager(1234)
+    theta, shift, alpha_scale = 8.64, 0.5, 1e4
+
+    arrays = shared_data.shared_arrays({'mat_pi0':mat_pi0, 'mat_pi0_test':mat_pi0_test}) if shared else None
+    list_processes, list_addresses = remote.spawn_local(num_workers)
+    coordinator = remote.rollout_coordinator(list_addresses, mat_pi0, mat_pi0_test, streams.seed, {'d':d}, shared=arrays.handle if shared else None)
+    try:
+        coordinator.publish(theta, shift, alpha_scale)
+        for split, mat in [('train', mat_pi0), ('test', mat_pi0_test)]:
+            states, actions, rewards = coordinator.rollout(idx_start, n, split)
+            assert rewards is None
+            assert states.shape == (n, 15, d)
+            for idx in range(n):
+                trajectory = rollout.generate_trajectory(idx_start + idx, mat, theta, shift, alpha_scale, streams)
+                assert np.array_equal(states[idx], np.array([pair[0] for pair in trajectory]))
+                assert np.array_equal(actions[idx], np.array([pair[1] for pair in trajectory]))
+    finally:
+        coordinator.close(stop_workers=True)
+        for p in list_processes:
+            p.join(timeout=10)
+        if shared:
+            arrays.close()
+
+
+def test_shared_start_states():
+    """
+    Same as test_matches_local, with the start states in shared memory
+    """
+    test_matches_local(shared=True)
+
+
+def test_reward_weights(num_workers=2, n=4, d=15):
+    """
+    Reward network variables collected as in AC_IRL.create_network, before an
+    optimizer adds its slot variables under the same scope, load into the
+    workers' reward_evaluator, which then returns the rewards of the local network
+    """
+    tf = pytest.importorskip('tensorflow')
+    import networks
+    net_config = {'reg':'none', 'arch':'conv', 'ensemble_size':1, 'n_fc3':8, 'n_fc4':4, 'd':d}
+    mat_pi0 = np.random.default_rng(0).dirichlet(np.ones(d), size=10)
+    streams = rng.rng_manager(1234)
+
+    graph = tf.Graph()
+    with graph.as_default():
+        ph_states = tf.placeholder(tf.float32, shape=[None, d])
+        ph_actions = tf.placeholder(tf.float32, shape=[None, d, d])
+        with tf.variable_scope('reward'):
+            reward = networks.reward_net(ph_states, ph_actions, **net_config)[:, 0]
+        reward_vars = tf.get_collection(tf.GraphKeys.GLOBAL_VARIABLES, scope='reward/')
+        tf.train.AdamOptimizer(1e-3).minimize(-tf.reduce_mean(reward))
+        # the slots are named after their variables, e.g. reward/out/weights/Adam
+        assert any(var.op.name.endswith('/Adam') for var in tf.get_collection(tf.GraphKeys.GLOBAL_VARIABLES, scope='reward/'))
+        sess = tf.Session(graph=graph)
+        sess.run(tf.global_variables_initializer())
+    weights = {var.op.name: value for var, value in zip(reward_vars, sess.run(reward_vars))}
+
+    list_processes, list_addresses = remote.spawn_local(num_workers)
+    coordinator = remote.rollout_coordinator(list_addresses, mat_pi0, mat_pi0, streams.seed, net_config)
+    try:
+        coordinator.publish(8.64, 0.5, 1e4, weights)
+        states, actions, rewards = coordinator.rollout(0, n, score=True)
+        local = sess.run(reward, feed_dict={ph_states:states.reshape(-1, d), ph_actions:actions.reshape(-1, d, d)})
+        assert np.allclose(rewards.reshape(-1), local, atol=1e-6)
+    finally:
+        coordinator.close(stop_workers=True)
+        for p in list_processes:
+            p.join(timeout=10)
+
+
+if __name__ == "__main__":
+    test_matches_local()
+    test_shared_start_states()
+    test_reward_weights()
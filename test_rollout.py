@@ -0,0 +1,117 @@
+import numpy as np
+
+import rng
+import rollout
+
+
+def sample_rows(mat_alpha, alpha_scale, method, num_samples, seed=0):
+    """
+    Returns [num_samples, d, d] actions drawn with sample_dirichlet
+    """
+    rng = np.random.default_rng(seed)
+    return np.array([rollout.sample_dirichlet(mat_alpha, alpha_scale, rng, method) for _ in range(num_samples)])
+
+
+def test_normal_moments(d=15, alpha_scale=1e4, num_samples=4000):
+    """
+    Mean and covariance of every row from the normal approximation match
+    the exact sampler and the Dirichlet formulas, within sampling error
+    """
+    pi = np.random.default_rng(1).dirichlet(np.ones(d))
+    mat_alpha = rollout.calc_alpha(pi, theta=8.64, shift=0)
+    mat_shape = mat_alpha * alpha_scale
+    assert np.min(mat_shape) >= rollout.NORMAL_THRESHOLD
+
+    exact = sample_rows(mat_alpha, alpha_scale, 'exact', num_samples)
+    normal = sample_rows(mat_alpha, alpha_scale, 'normal', num_samples)
+
+    a0 = np.sum(mat_shape, axis=1, keepdims=True)
+    mean = mat_shape / a0
+    std = np.sqrt(mean * (1 - mean) / (a0 + 1))
+    # standard error of the sample mean and of the sample std
+    se_mean = std / np.sqrt(num_samples)
+    se_std = std / np.sqrt(2 * num_samples)
+    for samples in [exact, normal]:
+        err_mean = np.max(np.abs(np.mean(samples, axis=0) - mean) / se_mean)
+        err_std = np.max(np.abs(np.std(samples, axis=0) - std) / se_std)
+        # d*d entries, so allow 5 standard errors
+        assert err_mean < 5
+        assert err_std < 5
+
+    # covariance between two entries of a row, -m_i m_j / (a0 + 1)
+    cov_formula = -mean[0, 0] * mean[0, 1] / (a0[0, 0] + 1)
+    cov_exact = np.cov(exact[:, 0, 0], exact[:, 0, 1])[0, 1]
+    cov_normal = np.cov(normal[:, 0, 0], normal[:, 0, 1])[0, 1]
+    assert abs(cov_normal - cov_formula) < 5 * std[0, 0] * std[0, 1] / np.sqrt(num_samples)
+
+    # rows are on the simplex
+    assert np.all(normal > 0)
+    assert np.allclose(np.sum(normal, axis=2), 1)
+
+
+def test_threshold(d=15):
+    """
+    Rows with a parameter below the threshold are sampled exactly, so with a
+    threshold above every parameter the normal mode reproduces the exact sampler
+    """
+    pi = np.random.default_rng(2).dirichlet(np.ones(d))
+    mat_alpha = rollout.calc_alpha(pi, theta=8.64, shift=0.5)
+    P_exact = rollout.sample_dirichlet(mat_alpha, 1e4, np.random.default_rng(3), 'exact')
+    P_normal = rollout.sample_dirichlet(mat_alpha, 1e4, np.random.default_rng(3), 'normal', threshold=np.inf)
+    assert np.array_equal(P_exact, P_normal)
+
+
+def test_batch_matches_single(n=6, d=15):
+    """
+    generate_trajectories returns the trajectories of generate_trajectory with
+    the same indices, for both samplers and with some rows below the threshold
+    """
+    rng_data = np.random.default_rng(5)
+    mat_pi0 = rng_data.dirichlet(np.ones(d), size=10)
+    streams = rng.rng_manager(1234)
+    list_idx = range(3, 3 + n)
+    for sampler in ['exact', 'normal']:
+        for shift in [0, 0.5]:
+            batch = rollout.generate_trajectories(list_idx, mat_pi0, 8.64, shift, 1e4, streams, sampler=sampler)
+            for idx, trajectory in zip(list_idx, batch):
+                single = rollout.generate_trajectory(idx, mat_pi0, 8.64, shift, 1e4, streams, sampler=sampler)
+                for (pi, P), (pi_single, P_single) in zip(trajectory, single):
+                    assert np.array_equal(pi, pi_single)
+                    assert np.array_equal(P, P_single)
+
+
+def test_mean_trajectories(d=15, total_hours=16):
+    """
+    Batched mean-action rollouts equal a loop of mean_action and calc_alpha
+    for every policy and start state
+    """
+    mat_pi0 = np.random.default_rng(6).dirichlet(np.ones(d), size=4)
+    vec_theta = [8.64, 2.0, 15.0]
+    vec_shift = [0, 0.5, 0.2]
+    tensor_traj = rollout.mean_trajectories(mat_pi0, vec_theta, vec_shift, total_hours)
+    assert tensor_traj.shape == (len(vec_theta), len(mat_pi0), total_hours, d)
+    for k, (theta, shift) in enumerate(zip(vec_theta, vec_shift)):
+        for s, pi in enumerate(mat_pi0):
+            for hour in range(total_hours):
+                assert np.allclose(tensor_traj[k, s, hour], pi, rtol=1e-10, atol=1e-14)
+                pi = np.transpose(rollout.mean_action(rollout.calc_alpha(pi, theta, shift))).dot(pi)
+
+
+def test_drift_report(d=15, total_hours=16):
+    """
+    Stochastic rollouts concentrate on the mean-action trajectory as alpha_scale grows,
+    so every L1 distance of drift_report is near zero at a very large alpha_scale
+    """
+    mat_pi0 = np.random.default_rng(7).dirichlet(np.ones(d), size=3)
+    report = rollout.drift_report(mat_pi0, 8.64, 0.5, 1e12, np.random.default_rng(8), total_hours, num_samples=5)
+    for key in ['l1_sample', 'l1_max', 'l1_bias']:
+        assert report[key].shape == (total_hours,)
+        assert np.max(report[key]) < 1e-4
+
+
+if __name__ == "__main__":
+    test_normal_moments()
+    test_threshold()
+    test_batch_matches_single()
+    test_mean_trajectories()
+    test_drift_report()
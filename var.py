@@ -11,19 +11,73 @@ from statsmodels.tsa.base.datetools import dates_from_str
 from statsmodels.tsa.stattools import adfuller
 
 import argparse
+import hashlib
+
+import dataset
+
+
+def forecast_var(coefs, intercept, y, steps):
+    """
+    Forecast recursion of a VAR(p) with constant term, same as VARResults.forecast
+    y_t = intercept + sum_{i=1}^p coefs[i-1] y_{t-i}
+
+    coefs - [p, k, k] lag coefficient matrices
+    intercept - [k] constant term
+    y - [>= p, k] prior observations, only the last p rows are used
+    steps - number of future points to generate
+
+    Returns array [steps, k]
+    """
+    p = coefs.shape[0]
+    prior = np.array(y[len(y)-p:], dtype=np.float64)
+    future = np.zeros([steps, len(intercept)])
+    for h in range(steps):
+        y_next = np.array(intercept, dtype=np.float64)
+        for i in range(p):
+            y_next += coefs[i].dot(prior[-1-i])
+        future[h] = y_next
+        if p > 0:
+            prior = np.vstack([prior[1:], y_next])
+
+    return future
+
+
+class var_results():
+
+    def __init__(self, coefs, intercept, fittedvalues):
+        """
+        The parts of a fitted statsmodels VARResults used in this module,
+        which can be saved and restored without refitting
+
+        coefs - [k_ar, k, k] lag coefficient matrices
+        intercept - [k] constant term
+        fittedvalues - DataFrame of in-sample fitted values
+        """
+        self.coefs = coefs
+        self.intercept = intercept
+        self.k_ar = coefs.shape[0]
+        self.fittedvalues = fittedvalues
+
+    def forecast(self, y, steps):
+        return forecast_var(self.coefs, self.intercept, y, steps)
+
 
 class var():
 
     #def __init__(self, train='train_normalized', test='test_normalized', d=21):
-    def __init__(self, d=15):
+    def __init__(self, d=15, cache_dir=None):
         """
         Arguments:
         d - number to topics to use (includes the null topic at index 0)
+        cache_dir - if not None, fitted models are also saved to and loaded from this directory
         """
         self.d = d
+        self.cache_dir = cache_dir
+        # fitted models by (max_lag, ic, fingerprint of training data)
+        self.cache = {}
 
 
-    def read_data(self, train='train_normalized_round2', train_start=1, train_end=18, test='test_normalized_round2', test_start=19, test_end=24, old_format=False):
+    def read_data(self, train='train_normalized_round2', train_start=1, train_end=18, test='test_normalized_round2', test_start=19, test_end=24, old_format=False, dataset_file=None):
         """
         Arguments:
         train - directory that holds normalized training data
@@ -33,7 +87,23 @@ class var():
         test_start - the smallest day number among test files
         test_end - the largest day number among test files
         old_format - if True, then use filename "trend_distribution_day%d_reordered.csv"
+        dataset_file - if not None, take days train_start to train_end of the train split
+        and test_start to test_end of the test split of this dataset instead of the directories
         """
+        if dataset_file:
+            ds = dataset.open_dataset(dataset_file)
+            list_df = []
+            idx = 0
+            for split, day_start, day_end in [('train', train_start, train_end), ('test', test_start, test_end)]:
+                states = ds.states(split, day_start, day_end)[:, :, 0:self.d]
+                num_rows = states.shape[0] * states.shape[1]
+                df = pd.DataFrame(np.array(states).reshape(num_rows, self.d), index=np.arange(idx, idx+num_rows), columns=range(self.d))
+                df.index = pd.to_datetime(df.index, unit="D")
+                list_df.append(df)
+                idx += num_rows
+            self.df_train, self.df_test = list_df
+            return self.df_train, self.df_test
+
         print("Reading train files")
         list_df = []
         idx = 0
@@ -99,11 +169,66 @@ class var():
         print(dfoutput)
 
         
-    def train(self, max_lag, df_train):
+    def fingerprint(self, df_train):
+        """
+        Returns hash of the values and index of df_train
+        """
+        h = hashlib.sha1()
+        h.update(str(df_train.shape).encode('utf-8'))
+        h.update(np.ascontiguousarray(df_train.values, dtype=np.float64).tobytes())
+        h.update(np.ascontiguousarray(df_train.index.asi8).tobytes())
 
-        self.model = VAR(df_train)
-        
-        self.results = self.model.fit(maxlags=max_lag, ic='aic')
+        return h.hexdigest()
+
+
+    def cache_path(self, key):
+        max_lag, ic, fingerprint = key
+        return os.path.join(self.cache_dir, 'var_lag%d_%s_%s.npz' % (max_lag, ic, fingerprint))
+
+
+    def save_results(self, key, results):
+        """
+        Writes fitted coefficients and fitted values to the cache directory
+        """
+        if not os.path.isdir(self.cache_dir):
+            os.makedirs(self.cache_dir)
+        path = self.cache_path(key)
+        path_tmp = path + '.tmp.npz'
+        np.savez(path_tmp, coefs=results.coefs, intercept=results.intercept, fitted=results.fittedvalues.values, fitted_index=results.fittedvalues.index.asi8, columns=np.array(results.fittedvalues.columns))
+        os.replace(path_tmp, path)
+
+
+    def load_results(self, key):
+        """
+        Returns var_results read from the cache directory, or None if not cached
+        """
+        path = self.cache_path(key)
+        if not os.path.isfile(path):
+            return None
+        with np.load(path) as data:
+            fittedvalues = pd.DataFrame(data['fitted'], index=pd.to_datetime(data['fitted_index']), columns=data['columns'])
+            return var_results(data['coefs'], data['intercept'], fittedvalues)
+
+
+    def train(self, max_lag, df_train, ic='aic'):
+        """
+        Fits VAR to df_train with lag order chosen by ic up to max_lag.
+        Fitted models are cached in memory, and on disk if self.cache_dir is set,
+        so the same model is not refit for the same training data
+        """
+        key = (max_lag, ic, self.fingerprint(df_train))
+        if key not in self.cache and self.cache_dir:
+            results = self.load_results(key)
+            if results is not None:
+                self.cache[key] = results
+        if key not in self.cache:
+            self.model = VAR(df_train)
+            results = self.model.fit(maxlags=max_lag, ic=ic)
+            self.cache[key] = var_results(np.asarray(results.coefs), np.asarray(results.intercept), results.fittedvalues)
+            if self.cache_dir:
+                self.save_results(key, self.cache[key])
+
+        self.results = self.cache[key]
 
 
     def cross_validation(self, lag_range=range(1,21), validation_size=5, repetitions=5):